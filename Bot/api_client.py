@@ -0,0 +1,145 @@
+# api_client.py
+"""
+HTTP-клиент бота к API (main.py): одна долгоживущая aiohttp-сессия на процесс.
+- пул соединений с keep-alive (API_POOL_LIMIT / API_POOL_LIMIT_PER_HOST) — без TCP-рукопожатия на каждое сообщение
+- таймауты по эндпоинтам (TIMEOUTS)
+- повторы с джиттером на временных сбоях: обрыв соединения, 502/503/504 (Retry-After учитывается)
+  POST /chat не идемпотентен (пишет историю) — его повторяем, только если запрос точно не дошёл
+  (не удалось подключиться) или сервер ответил 503 (занят, запрос не принят)
+- поток (/compare/stream) повторяется только до первого байта ответа
+"""
+import asyncio
+import os
+import random
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+API_URL = os.getenv("API_URL", "http://localhost:8000")
+API_POOL_LIMIT = int(os.getenv("API_POOL_LIMIT", "100"))  # всего соединений
+API_POOL_LIMIT_PER_HOST = int(os.getenv("API_POOL_LIMIT_PER_HOST", "50"))
+API_KEEPALIVE = float(os.getenv("API_KEEPALIVE", "30"))  # сек. простоя соединения в пуле
+API_RETRIES = int(os.getenv("API_RETRIES", "3"))  # повторов сверх первой попытки
+API_RETRY_BASE = float(os.getenv("API_RETRY_BASE", "0.3"))  # сек., растёт экспоненциально
+API_RETRY_MAX = float(os.getenv("API_RETRY_MAX", "5"))
+
+TIMEOUTS = {
+    "codes": aiohttp.ClientTimeout(total=30),
+    "similar": aiohttp.ClientTimeout(total=30),
+    "search": aiohttp.ClientTimeout(total=10),
+    "chat": aiohttp.ClientTimeout(total=120),
+    "viz": aiohttp.ClientTimeout(total=120),
+    # генерация может идти долго — ограничиваем паузу между кусками, а не всё время
+    "compare_stream": aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=120),
+}
+RETRY_STATUSES = {502, 503, 504}
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, detail: str):
+        super().__init__(f"{status}: {detail}")
+        self.status = status
+        self.detail = detail
+
+
+def _backoff(attempt: int, retry_after: str | None = None) -> float:
+    """Полный джиттер: случайная пауза до base * 2^attempt, но не меньше Retry-After."""
+    delay = random.uniform(0, min(API_RETRY_MAX, API_RETRY_BASE * 2 ** attempt))
+    if retry_after:
+        try:
+            delay = max(delay, min(float(retry_after), API_RETRY_MAX))
+        except ValueError:
+            pass
+    return delay
+
+
+class ApiClient:
+    def __init__(self, base_url: str = API_URL):
+        self.base_url = base_url.rstrip("/")
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # создаётся лениво — внутри запущенного event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=API_POOL_LIMIT,
+                limit_per_host=API_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=API_KEEPALIVE,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @asynccontextmanager
+    async def _open(self, method: str, path: str, endpoint: str, idempotent: bool, **kwargs):
+        """Ответ с уже прочитанными заголовками; повторы — только пока тело не начали читать."""
+        for attempt in range(API_RETRIES + 1):
+            last = attempt == API_RETRIES
+            try:
+                resp = await self.session.request(method, f"{self.base_url}{path}", timeout=TIMEOUTS[endpoint], **kwargs)
+            except aiohttp.ClientConnectorError:
+                if last:
+                    raise
+                await asyncio.sleep(_backoff(attempt))  # не подключились — запрос точно не ушёл
+                continue
+            except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError, asyncio.TimeoutError):
+                if last or not idempotent:
+                    raise
+                await asyncio.sleep(_backoff(attempt))
+                continue
+            if resp.status in RETRY_STATUSES and not last and (idempotent or resp.status == 503):
+                retry_after = resp.headers.get("Retry-After")
+                resp.release()
+                await asyncio.sleep(_backoff(attempt, retry_after))
+                continue
+            try:
+                yield resp
+            finally:
+                resp.release()
+            return
+
+    async def request(self, method: str, path: str, endpoint: str, *, idempotent: bool = True, **kwargs):
+        """JSON ответа; ApiError, если статус не 2xx."""
+        async with self._open(method, path, endpoint, idempotent, **kwargs) as resp:
+            if resp.status >= 400:
+                try:
+                    detail = (await resp.json()).get("detail", resp.reason)
+                except (aiohttp.ContentTypeError, ValueError):
+                    detail = resp.reason
+                raise ApiError(resp.status, str(detail))
+            return await resp.json()
+
+    @asynccontextmanager
+    async def stream(self, method: str, path: str, endpoint: str, **kwargs):
+        """Ответ для чтения потоком (resp.content). Статус проверяет вызывающий."""
+        async with self._open(method, path, endpoint, True, **kwargs) as resp:
+            yield resp
+
+    #---эндпоинты API---
+    async def codes(self) -> list[str]:
+        return (await self.request("GET", "/codes", "codes")).get("codes", [])
+
+    async def similar(self, code: str, k: int = 5) -> dict:
+        return await self.request("GET", f"/similar/{code}", "similar", params={"k": k})
+
+    async def search(self, query: str, k: int = 3) -> dict:
+        return await self.request("GET", "/search", "search", params={"q": query, "k": k})
+
+    async def chat(self, message: str, user_id: str) -> str:
+        # дедлайн для очереди к LLM на сервере: не ждать дольше, чем мы сами готовы ждать ответа
+        headers = {"X-Request-Timeout": str(TIMEOUTS["chat"].total - 5)}
+        data = await self.request("POST", "/chat", "chat", idempotent=False, headers=headers,
+                                  json={"message": message, "user_id": user_id})
+        return data["response"]
+
+    async def viz_bundle(self, codes: list[str]) -> dict:
+        return await self.request("POST", "/viz/bundle", "viz", json={"codes": codes})
+
+    def compare_stream(self, codes: list[str], user_id: str | None = None):
+        # /compare идемпотентен: ответ кэшируется, одинаковые запросы склеиваются
+        return self.stream("POST", "/compare/stream", "compare_stream", json={"codes": codes, "user_id": user_id})
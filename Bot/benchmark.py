@@ -0,0 +1,434 @@
+# benchmark.py
+"""
+Нагрузочный бенчмарк API (main.py) с поддельным Ollama (fake_ollama.py) вместо модели.
+
+Запускает fake_ollama и main:app отдельными процессами (история, кэш LLM — во временном каталоге)
+и гоняет сценарии:
+- sweep  — каждый эндпоинт отдельно при разной конкурентности (--concurrency 1,8,32)
+- mixed  — смесь запросов с весами, похожими на реальный трафик бота
+- burst  — «бот»: --burst-users пользователей одновременно присылают коды (2–5 одного уровня),
+           каждый читает /compare/stream и сразу просит /viz/bundle; --burst-rounds волн
+
+По каждому (сценарий, эндпоинт, конкурентность): p50/p95/p99 (только успешные ответы), время до
+первого куска потока, запросов в секунду, ошибки по статусам и пиковый RSS сервера (с дочерними
+процессами — рендер-пулом). Результат — JSON (--save); с --baseline сравнивается с сохранённым
+прогоном и завершается с кодом 1, если p95 вырос или пропускная способность упала больше --tolerance.
+Базовые прогоны зависят от машины — сохраняйте их (--save-baseline) там же, где будете сравнивать.
+
+Запуск (из Bot/):
+    python benchmark.py --save-baseline bench/baseline.json
+    python benchmark.py --baseline bench/baseline.json
+    python benchmark.py --scenarios sweep --endpoints codes,similar,search --concurrency 1,16,64
+    python benchmark.py --api-url http://localhost:8000 --scenarios mixed   # уже запущенный сервер
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+
+import httpx
+import numpy as np
+
+from codes import _level
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LLM_ENDPOINTS = {"compare", "compare_stream", "chat"}
+SEARCH_QUERIES = [
+    "хочу backend и базы данных", "программирование и разработка систем", "электроника и схемотехника",
+    "экономика и управление финансами", "машинное обучение и анализ данных", "строительство и архитектура",
+]
+# веса сценария mixed: примерно как ходит бот (сравнение + картинки, реже чат и служебные запросы)
+MIX_WEIGHTS = {
+    "compare_stream": 4, "viz_bundle": 4, "chat": 2, "similar": 2, "search": 2, "codes": 1,
+    "viz_position": 1, "viz_heatmap": 1, "viz_tfidf": 1, "viz_topics": 1, "compare": 1,
+}
+
+
+@dataclass
+class Sample:
+    latency: float
+    status: int
+    ttfb: float | None = None
+
+
+@dataclass
+class Workload:
+    codes: dict[int, list[str]]  # уровень -> коды
+    rng: random.Random
+    no_cache: bool = False
+
+    def code_set(self) -> list[str]:
+        """2–5 кодов одного уровня (уровень — с достаточным числом кодов)."""
+        levels = [lvl for lvl, codes in self.codes.items() if len(codes) >= 2]
+        pool = self.codes[self.rng.choice(levels)]
+        return self.rng.sample(pool, self.rng.randint(2, min(5, len(pool))))
+
+    def code(self) -> str:
+        return self.rng.choice([c for codes in self.codes.values() for c in codes])
+
+    def user(self) -> str:
+        return f"bench-{self.rng.randint(0, 49)}"
+
+    def request(self, endpoint: str, user: str | None = None) -> tuple[str, str, dict | None, bool]:
+        """(метод, путь, json, поток?) для эндпоинта."""
+        user = user or self.user()
+        if endpoint == "codes":
+            return "GET", "/codes", None, False
+        if endpoint == "similar":
+            return "GET", f"/similar/{self.code()}?k=5", None, False
+        if endpoint == "search":
+            return "GET", f"/search?q={self.rng.choice(SEARCH_QUERIES)}", None, False
+        if endpoint == "chat":
+            return "POST", "/chat", {"message": self.rng.choice(SEARCH_QUERIES), "user_id": user}, False
+        if endpoint == "viz_tfidf":
+            return "GET", f"/viz/tfidf/{self.code()}.png", None, False
+        if endpoint == "viz_topics":
+            return "GET", f"/viz/topics/{self.code()}.png", None, False
+        body = {"codes": self.code_set()}
+        if endpoint in ("compare", "compare_stream"):
+            body.update(user_id=user, no_cache=self.no_cache)
+        paths = {"compare": "/compare", "compare_stream": "/compare/stream", "viz_bundle": "/viz/bundle",
+                 "viz_position": "/viz/position.png", "viz_heatmap": "/viz/heatmap.png"}
+        return "POST", paths[endpoint], body, endpoint == "compare_stream"
+
+
+async def send(client: httpx.AsyncClient, method: str, path: str, body: dict | None, stream: bool) -> Sample:
+    started = time.perf_counter()
+    try:
+        if not stream:
+            resp = await client.request(method, path, json=body)
+            return Sample(time.perf_counter() - started, resp.status_code)
+        ttfb, status = None, None
+        async with client.stream(method, path, json=body) as resp:
+            async for line in resp.aiter_lines():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+                # поток всегда 200: очередь переполнена / генерация упала — событие error в NDJSON
+                if status is None and resp.status_code == 200 and '"error"' in line:
+                    event = json.loads(line)
+                    if event.get("type") == "error":
+                        status = event.get("status", 0)
+            return Sample(time.perf_counter() - started, resp.status_code if status is None else status, ttfb)
+    except httpx.HTTPError:
+        return Sample(time.perf_counter() - started, 0)  # 0 — сетевая ошибка / таймаут (и error без статуса в потоке)
+
+
+def _children(pid: int) -> list[int]:
+    out = []
+    try:
+        for tid in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                out += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    return out
+
+
+def rss_mb(pid: int) -> float | None:
+    """RSS процесса и всех его потомков (Linux /proc); None — если померить нельзя."""
+    total, stack, seen = 0, [pid], set()
+    while stack:
+        p = stack.pop()
+        if p in seen:
+            continue
+        seen.add(p)
+        try:
+            with open(f"/proc/{p}/status") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            if p == pid:
+                return None
+            continue
+        stack += _children(p)
+    return total / 1024
+
+
+@dataclass
+class Step:
+    scenario: str
+    concurrency: int
+    samples: dict[str, list[Sample]] = field(default_factory=dict)
+    rss_peak: float | None = None
+    elapsed: float = 0.0
+
+    def add(self, endpoint: str, sample: Sample):
+        self.samples.setdefault(endpoint, []).append(sample)
+
+    def _row(self, endpoint: str, samples: list[Sample]) -> dict:
+        ok = np.array([s.latency for s in samples if 200 <= s.status < 300]) * 1000
+        ttfb = np.array([s.ttfb for s in samples if s.ttfb is not None]) * 1000
+        statuses: dict[str, int] = {}
+        for s in samples:
+            statuses[str(s.status)] = statuses.get(str(s.status), 0) + 1
+        pct = np.percentile(ok, [50, 95, 99]).round(2).tolist() if len(ok) else [None] * 3
+        return {
+            "scenario": self.scenario, "endpoint": endpoint, "concurrency": self.concurrency,
+            "n": len(samples), "errors": len(samples) - len(ok), "statuses": statuses,
+            "rps": round(len(ok) / self.elapsed, 2) if self.elapsed else None,
+            "p50_ms": pct[0], "p95_ms": pct[1], "p99_ms": pct[2],
+            "ttfb_p50_ms": round(float(np.percentile(ttfb, 50)), 2) if len(ttfb) else None,
+            "rss_peak_mb": round(self.rss_peak, 1) if self.rss_peak is not None else None,
+        }
+
+    def rows(self) -> list[dict]:
+        out = [self._row(endpoint, samples) for endpoint, samples in sorted(self.samples.items())]
+        if self.scenario == "mixed" and len(self.samples) > 1:  # общая пропускная способность смеси
+            out.append(self._row("all", [s for samples in self.samples.values() for s in samples]))
+        return out
+
+
+async def _watch_rss(pid: int | None, step: Step, every: float = 0.2):
+    while pid is not None:
+        mb = rss_mb(pid)
+        if mb is not None:
+            step.rss_peak = max(step.rss_peak or 0.0, mb)
+        await asyncio.sleep(every)
+
+
+async def run_step(step: Step, pid: int | None, jobs):
+    """jobs — корутины-«пользователи»; пока они идут, пиковый RSS сервера снимается в фоне."""
+    watcher = asyncio.create_task(_watch_rss(pid, step))
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*jobs)
+    finally:
+        step.elapsed += time.perf_counter() - started  # паузы между волнами burst не считаются
+        watcher.cancel()
+
+
+def closed_loop(client, wl: Workload, step: Step, pick, total: int, concurrency: int):
+    """concurrency работников делят между собой total запросов; pick() выбирает эндпоинт."""
+    left = total
+
+    async def worker(i: int):
+        nonlocal left
+        user = f"bench-w{i}"  # у каждого работника своя история /chat
+        while left > 0:
+            left -= 1
+            endpoint = pick()
+            step.add(endpoint, await send(client, *wl.request(endpoint, user)))
+
+    return [worker(i) for i in range(concurrency)]
+
+
+async def scenario_sweep(client, wl: Workload, pid, args) -> list[Step]:
+    steps = []
+    for endpoint in args.endpoints:
+        for c in args.concurrency:
+            total = args.llm_requests if endpoint in LLM_ENDPOINTS else args.requests
+            step = Step("sweep", c)
+            await run_step(step, pid, closed_loop(client, wl, step, lambda: endpoint, max(total, c), c))
+            steps.append(step)
+            _print_rows(step.rows())
+    return steps
+
+
+async def scenario_mixed(client, wl: Workload, pid, args) -> list[Step]:
+    names, weights = zip(*MIX_WEIGHTS.items())
+    steps = []
+    for c in args.concurrency:
+        step = Step("mixed", c)
+        jobs = closed_loop(client, wl, step, lambda: wl.rng.choices(names, weights)[0], max(args.requests, c), c)
+        await run_step(step, pid, jobs)
+        steps.append(step)
+        _print_rows(step.rows())
+    return steps
+
+
+async def scenario_burst(client, wl: Workload, pid, args) -> list[Step]:
+    step = Step("burst", args.burst_users)
+
+    async def session(user: str):
+        method, path, body, stream = wl.request("compare_stream", user)
+        started = time.perf_counter()
+        sample = await send(client, method, path, body, stream)
+        step.add("compare_stream", sample)
+        if sample.status == 200:
+            step.add("viz_bundle", await send(client, "POST", "/viz/bundle", {"codes": body["codes"]}, False))
+        step.add("session", Sample(time.perf_counter() - started, sample.status))
+
+    for r in range(args.burst_rounds):
+        await run_step(step, pid, [session(f"bench-burst-{i}") for i in range(args.burst_users)])
+        if r + 1 < args.burst_rounds:
+            await asyncio.sleep(args.burst_pause)
+    _print_rows(step.rows())
+    return [step]
+
+
+SCENARIOS = {"sweep": scenario_sweep, "mixed": scenario_mixed, "burst": scenario_burst}
+
+
+def _print_rows(rows: list[dict]):
+    for r in rows:
+        print(
+            f"{r['scenario']:<6} {r['endpoint']:<15} c={r['concurrency']:<4} n={r['n']:<5} err={r['errors']:<4} "
+            f"rps={r['rps']!s:<8} p50={r['p50_ms']!s:<9} p95={r['p95_ms']!s:<9} p99={r['p99_ms']!s:<9} "
+            f"ttfb={r['ttfb_p50_ms']!s:<8} rss={r['rss_peak_mb']}MB"
+        )
+
+
+def compare_baseline(rows: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """Регрессии относительно базового прогона: p95 выше / rps ниже больше чем на tolerance, новые ошибки."""
+    base = {(r["scenario"], r["endpoint"], r["concurrency"]): r for r in baseline}
+    problems = []
+    for r in rows:
+        b = base.get((r["scenario"], r["endpoint"], r["concurrency"]))
+        if b is None:
+            continue
+        name = f"{r['scenario']}/{r['endpoint']}/c={r['concurrency']}"
+        # +5 мс — шумовой порог для быстрых эндпоинтов
+        if r["p95_ms"] and b["p95_ms"] and r["p95_ms"] > b["p95_ms"] * (1 + tolerance) + 5:
+            problems.append(f"{name}: p95 {b['p95_ms']} -> {r['p95_ms']} мс")
+        if r["rps"] and b["rps"] and r["rps"] < b["rps"] * (1 - tolerance):
+            problems.append(f"{name}: rps {b['rps']} -> {r['rps']}")
+        if r["errors"] / max(r["n"], 1) > b["errors"] / max(b["n"], 1) + 0.01:
+            problems.append(f"{name}: ошибок {b['errors']}/{b['n']} -> {r['errors']}/{r['n']}")
+    return problems
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _wait_ready(url: str, proc: subprocess.Popen, timeout: float = 180.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2) as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"процесс завершился с кодом {proc.returncode}: {' '.join(proc.args)}")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.3)
+    raise TimeoutError(f"{url} не ответил за {timeout:.0f} с")
+
+
+class Servers:
+    """fake_ollama + main:app в отдельных процессах, с чистыми историей и кэшами."""
+
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.TemporaryDirectory(prefix="bench-")
+        self.procs: list[subprocess.Popen] = []
+        self.api_url = ""
+        self.api_pid: int | None = None
+
+    def _spawn(self, cmd: list[str], env: dict) -> subprocess.Popen:
+        proc = subprocess.Popen(cmd, cwd=HERE, env=env)
+        self.procs.append(proc)
+        return proc
+
+    async def __aenter__(self):
+        a = self.args
+        ollama_port, api_port = _free_port(), _free_port()
+        env = dict(os.environ)
+        env.setdefault("PYTHONWARNINGS", "ignore::FutureWarning")  # предупреждения sklearn в рендере не нужны в выводе
+        fake = self._spawn([sys.executable, "fake_ollama.py", "--host", "127.0.0.1", "--port", str(ollama_port),
+                            "--tokens-per-sec", str(a.tokens_per_sec), "--ttft", str(a.ttft)], env)
+        await _wait_ready(f"http://127.0.0.1:{ollama_port}/api/tags", fake)
+        env.update(
+            OLLAMA_BASE_URL=f"http://127.0.0.1:{ollama_port}", OLLAMA_BASE_URLS="",
+            CHECKPOINT_DB_PATH=os.path.join(self.tmp.name, "checkpoints.sqlite3"),
+            LLM_CACHE_PATH=os.path.join(self.tmp.name, "llm_cache.sqlite3"),
+            PNG_CACHE_DIR="",
+        )
+        api = self._spawn([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                           "--port", str(api_port), "--log-level", "warning"], env)
+        self.api_url, self.api_pid = f"http://127.0.0.1:{api_port}", api.pid
+        await _wait_ready(f"{self.api_url}/codes", api)
+        return self
+
+    async def __aexit__(self, *exc):
+        for proc in reversed(self.procs):
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        self.tmp.cleanup()
+
+
+async def bench(args) -> list[dict]:
+    servers = None
+    if args.api_url:
+        api_url, pid = args.api_url, args.pid
+    else:
+        servers = await Servers(args).__aenter__()
+        api_url, pid = servers.api_url, servers.api_pid
+    try:
+        limits = httpx.Limits(max_connections=max(args.concurrency + [args.burst_users]) * 2)
+        async with httpx.AsyncClient(base_url=api_url, timeout=args.timeout, limits=limits) as client:
+            codes: dict[int, list[str]] = {}
+            for code in (await client.get("/codes")).json()["codes"]:
+                codes.setdefault(_level(code), []).append(code)
+            wl = Workload(codes, random.Random(args.seed), no_cache=args.no_llm_cache)
+            rows = []
+            for name in args.scenarios:
+                for step in await SCENARIOS[name](client, wl, pid, args):
+                    rows += step.rows()
+            return rows
+    finally:
+        if servers is not None:
+            await servers.__aexit__(None, None, None)
+
+
+def _save(path: str, rows: list[dict], args):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    meta = {k: v for k, v in vars(args).items() if k not in ("save", "baseline", "save_baseline")}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"created_at": time.time(), "params": meta, "rows": rows}, f, ensure_ascii=False, indent=1)
+
+
+def _csv_list(value: str) -> list[str]:
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк API с поддельным Ollama")
+    parser.add_argument("--scenarios", type=_csv_list, default=["sweep", "mixed", "burst"])
+    parser.add_argument("--endpoints", type=_csv_list, default=list(MIX_WEIGHTS), help="для sweep")
+    parser.add_argument("--concurrency", type=lambda v: [int(x) for x in _csv_list(v)], default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="запросов на шаг для быстрых эндпоинтов")
+    parser.add_argument("--llm-requests", type=int, default=30, help="запросов на шаг для /compare и /chat")
+    parser.add_argument("--burst-users", type=int, default=20)
+    parser.add_argument("--burst-rounds", type=int, default=3)
+    parser.add_argument("--burst-pause", type=float, default=2.0, help="сек. между волнами")
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0, help="скорость поддельного Ollama")
+    parser.add_argument("--ttft", type=float, default=0.1, help="сек. до первого токена у поддельного Ollama")
+    parser.add_argument("--no-llm-cache", action="store_true", help="/compare всегда идёт в LLM (no_cache)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--api-url", default=None, help="не запускать серверы, а бить в уже запущенный API")
+    parser.add_argument("--pid", type=int, default=None, help="PID уже запущенного API — для RSS")
+    parser.add_argument("--save", default="bench/last.json")
+    parser.add_argument("--baseline", default=None, help="сравнить с сохранённым прогоном")
+    parser.add_argument("--save-baseline", default=None, help="сохранить прогон как базовый")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS) or set(args.endpoints) - set(MIX_WEIGHTS)
+    if unknown:
+        parser.error(f"неизвестно: {', '.join(sorted(unknown))}")
+
+    rows = asyncio.run(bench(args))
+    _save(args.save, rows, args)
+    if args.save_baseline:
+        _save(args.save_baseline, rows, args)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare_baseline(rows, json.load(f)["rows"], args.tolerance)
+        for p in problems:
+            print("РЕГРЕССИЯ:", p)
+        print("Регрессий нет" if not problems else f"Регрессий: {len(problems)}")
+        sys.exit(1 if problems else 0)
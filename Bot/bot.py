@@ -1,30 +1,54 @@
+from dotenv import load_dotenv
+load_dotenv()  # до остальных импортов: api_client и shared_state читают env при импорте
 from aiogram import Bot, Dispatcher, Router
 from aiogram.types import Message, InputMediaPhoto, BufferedInputFile
-from aiogram.filters import CommandStart
-import aiohttp
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from aiohttp import web
 import asyncio
+import base64
+import json
 import os
 import re
-from dotenv import load_dotenv
-from utils import _level
-
-load_dotenv()
+import time
+from codes import CODE_RE, _level  # не utils: тот тянет FastAPI и langchain
+from api_client import ApiClient, ApiError
+from metrics import REGISTRY, CONTENT_TYPE, stage
+from shared_state import get_shared_state, busy_flag
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 API_URL = os.getenv("API_URL", "http://localhost:8000")
+CODES_REFRESH_INTERVAL = float(os.getenv("BOT_CODES_REFRESH", "300"))  # сек.
+BOT_METRICS_PORT = int(os.getenv("BOT_METRICS_PORT", "0"))  # 0 — не поднимать /metrics бота
+BOT_BUSY_TTL = float(os.getenv("BOT_BUSY_TTL", "60"))  # сек.: флаг упавшей реплики снимается сам, живой — продлевается
 
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
+api = ApiClient(API_URL)  # одна пуловая сессия на процесс бота
 
-# Регулярка для УГС/направлений/профилей: XX / XX.XX / XX.XX.XX
-CODE_RE = re.compile(r"\b\d{2}(?:\.\d{2})?(?:\.\d{2})?\b", re.U)
+
+# «хочу/интересует/подбери…» без кодов — это поиск программ (/search), а не вопрос для LLM
+INTEREST_RE = re.compile(r"\b(хоч|хотел|интерес|нрав|увлека|люблю|подбер|посовет|куда поступ|какое направление|какую программу)", re.I | re.U)
+SEARCH_ROUTING = os.getenv("BOT_SEARCH_ROUTING", "1") == "1"
+LEVEL_TITLES = {3: "Профили", 2: "Направления", 1: "УГС"}
+
+EDIT_INTERVAL = float(os.getenv("BOT_EDIT_INTERVAL", "1.5"))  # сек. между правками одного сообщения
+VIZ_RETRY_DELAY = float(os.getenv("BOT_VIZ_RETRY_DELAY", "2"))  # сек. перед повтором /viz/bundle с недостроенными картинками
+TG_MESSAGE_LIMIT = 4096
 
 # Глобальные состояния
-user_busy: dict[str, bool] = {}
+# «ответ ещё готовится» по пользователю; SHARED_STATE=sqlite — общий для нескольких реплик бота (см. shared_state.py)
+USER_BUSY = get_shared_state()
 KNOWN_CODES: set[str] = set()
 
+# Метрики бота (этапы — stage_seconds{stage}: compare_stream, viz_bundle, send_media, chat, search)
+MESSAGES = REGISTRY.counter("bot_messages_total", "Сообщения пользователей по тому, куда они ушли", ["route"])
+COMPARE_TTFT = REGISTRY.histogram("bot_compare_ttft_seconds", "От отправки /compare/stream до первого токена")
+BUSY_STATS = {"users": 0}  # обновляется при снятии /metrics: у SQLite-бэкенда это запрос к базе — в потоке
+REGISTRY.gauge("bot_users_busy", "Пользователи, чей ответ ещё готовится", fn=lambda: [((), BUSY_STATS["users"])])
+
 def _filter_codes_local(text: str) -> list[str]:
     """
     Достаём до 5 кодов из текста, фильтруем по KNOWN_CODES и одному уровню.
@@ -47,120 +71,244 @@ def _filter_codes_local(text: str) -> list[str]:
         return []
     return uniq
 
+def _format_search(data: dict) -> str | None:
+    """Ответ /search текстом: профили, направления, УГС; None — если ничего не нашлось."""
+    blocks, hint = [], ""
+    for lvl in sorted(data.get("levels", []), key=lambda l: -l["level"]):
+        if not hint and len(lvl["results"]) >= 2:
+            hint = f"\n\nСравнить: «Сравни {lvl['results'][0]['code']} и {lvl['results'][1]['code']}»"
+        lines = [
+            f"{r['code']}" + (f" ({', '.join(r['matched'])})" if r.get("matched") else "")
+            for r in lvl["results"]
+        ]
+        if lines:
+            blocks.append(f"{LEVEL_TITLES.get(lvl['level'], lvl['level'])}:\n" + "\n".join(lines))
+    if not blocks:
+        return None
+    return "🔎 Подходящие программы\n\n" + "\n\n".join(blocks) + hint
+
+class LiveMessage:
+    """
+    Сообщение, которое дописывается по мере прихода токенов.
+    Правки не чаще EDIT_INTERVAL (лимиты Telegram на edit), при RetryAfter — откладываем следующую правку,
+    при переполнении 4096 символов — продолжаем в новом сообщении.
+    """
+    def __init__(self, message: Message):
+        self.message = message
+        self.sent: Message | None = None
+        self.text = ""
+        self.offset = 0  # начало текста, который показывается в self.sent
+        self.shown = ""
+        self.next_edit = 0.0
+
+    async def start(self):
+        self.sent = await self.message.answer("⏳ Сравниваю…")
+        self.next_edit = time.monotonic() + EDIT_INTERVAL
+
+    async def status(self, text: str):
+        """Служебный текст вместо заглушки (например, позиция в очереди), пока не пришёл ответ."""
+        if not self.text and time.monotonic() >= self.next_edit:
+            await self._show(text, final=False)
+
+    async def append(self, chunk: str):
+        self.text += chunk
+        if time.monotonic() >= self.next_edit:
+            await self._flush(final=False)
+
+    async def finish(self, empty_text: str = ""):
+        if not self.text.strip() and empty_text:
+            self.text = empty_text
+        await self._flush(final=True)
+
+    async def _flush(self, final: bool):
+        while len(self.text) - self.offset > TG_MESSAGE_LIMIT:
+            # текущее сообщение заполнено — дописываем его до лимита и начинаем новое
+            if not await self._show(self.text[self.offset:self.offset + TG_MESSAGE_LIMIT], final=True):
+                return
+            self.offset += TG_MESSAGE_LIMIT
+            self.sent, self.shown = None, ""
+        await self._show(self.text[self.offset:], final)
+
+    async def _show(self, text: str, final: bool) -> bool:
+        if not text.strip() or text == self.shown:
+            return True
+        while True:
+            try:
+                if self.sent is None:
+                    self.sent = await self.message.answer(text)
+                else:
+                    await self.sent.edit_text(text)
+                self.shown = text
+                self.next_edit = time.monotonic() + EDIT_INTERVAL
+                return True
+            except TelegramRetryAfter as e:
+                if not final:
+                    self.next_edit = time.monotonic() + e.retry_after
+                    return False
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest:
+                # "message is not modified" и т.п. — не повод ронять ответ
+                return True
+
 @router.message(CommandStart())
 async def on_start(message: Message):
     await message.answer(
         "Привет! Я помогу сравнить направления/профили/УГС.\n"
         "Например: «Сравни 09.03.01 и 09.03.02».\n"
-        "Важно: сравнивать можно только объекты одного уровня (профили с профилями, направления с направлениями, УГС с УГС)."
+        "Важно: сравнивать можно только объекты одного уровня (профили с профилями, направления с направлениями, УГС с УГС).\n"
+        "Похожие программы: /similar 09.03.01\n"
+        "Поиск по интересам: /search базы данных и backend"
     )
 
+@router.message(Command("similar"))
+async def on_similar(message: Message, command: CommandObject):
+    code = (command.args or "").strip()
+    if not CODE_RE.fullmatch(code):
+        await message.answer("Укажите код: /similar 09.03.01")
+        return
+    try:
+        data = await api.similar(code, k=5)
+    except ApiError as e:
+        await message.answer(f"Нет данных для: {code}" if e.status == 404 else f"Ошибка: {e.detail}")
+        return
+    except Exception as e:
+        await message.answer(f"Ошибка: {e}")
+        return
+    lines = [f"{n['code']} — {n['score']:.3f} ({n['label']})" for n in data.get("neighbours", [])]
+    await message.answer(f"Ближайшие к {code}:\n" + ("\n".join(lines) or "ничего не найдено"))
+
+@router.message(Command("search"))
+async def on_search(message: Message, command: CommandObject):
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Опишите, что интересно: /search базы данных и backend")
+        return
+    MESSAGES.inc(route="search_command")
+    try:
+        with stage("search"):
+            text = _format_search(await api.search(query))
+    except Exception as e:
+        await message.answer(f"Ошибка: {e}")
+        return
+    await message.answer(text or "Ничего не найдено — попробуйте другие слова.")
+
 @router.message()
 async def handle_message(message: Message):
     user_id = str(message.from_user.id)
 
-    if user_busy.get(user_id, False):
-        await message.answer("⏳ Дождитесь окончания прошлого ответа")
-        return
-    user_busy[user_id] = True
+    async with busy_flag(USER_BUSY, f"busy:{user_id}", BOT_BUSY_TTL) as acquired:
+        if not acquired:
+            MESSAGES.inc(route="busy")
+            await message.answer("⏳ Дождитесь окончания прошлого ответа")
+            return
+        await _answer(message, user_id)
 
+async def _answer(message: Message, user_id: str):
     try:
         # 1) Пытаемся вытащить валидные коды из текста (локально, по whitelist)
         codes_hint = _filter_codes_local(message.text)
 
-        async with aiohttp.ClientSession() as session:
-            if codes_hint:
-                # 2А) Если нашли валидные коды — сравнение
-                async with session.post(
-                    f"{API_URL}/compare",
-                    json={"codes": codes_hint},
-                    timeout=120
-                ) as resp:
-                    if resp.status == 200:
-                        payload = await resp.json()
-                        text = payload.get("text", "Готово.")
-                        final_codes = payload.get("codes", [])
-
-                        # отправляем текст
-                        await message.answer(text)
-
-                        # отправляем визуализации ТОЛЬКО для final_codes
-                        if len(final_codes) >= 2:
-                            media = []
-
-                            # 2D проекция
-                            await message.chat.do("upload_photo")
-                            r = await session.post(f"{API_URL}/viz/position.png", json={"codes": final_codes})
-                            png_bytes = await r.read()
-                            if r.status == 200:
-                                media.append(
-                                    InputMediaPhoto(
-                                        media=BufferedInputFile(png_bytes, filename="position.png"),
-                                        caption="2D‑проекция"
-                                    )
-                                )
-
-                            # Тепловая карта
-                            await message.chat.do("upload_photo")
-                            r = await session.post(f"{API_URL}/viz/heatmap.png", json={"codes": final_codes})
-                            png_bytes = await r.read()
-                            if r.status == 200:
-                                media.append(
-                                    InputMediaPhoto(
-                                        media=BufferedInputFile(png_bytes, filename="heatmap.png"),
-                                        caption="Косинусная близость"
-                                    )
-                                )
-
-                            # По каждому коду — TF‑IDF и темы
-                            for code in final_codes:
-                                await message.chat.do("upload_photo")
-                                tf = await session.get(f"{API_URL}/viz/tfidf/{code}.png")
-                                tf_bytes = await tf.read()
-                                if tf.status == 200:
-                                    media.append(
-                                        InputMediaPhoto(
-                                            media=BufferedInputFile(tf_bytes, f"tfidf_{code}.png"),
-                                            caption=f"TF‑IDF — {code}"
-                                        )
-                                    )
-
-                                tp = await session.get(f"{API_URL}/viz/topics/{code}.png")
-                                tp_bytes = await tp.read()
-                                if tp.status == 200:
-                                    media.append(
-                                        InputMediaPhoto(
-                                            media=BufferedInputFile(tp_bytes, f"topics_{code}.png"),
-                                            caption=f"BERTopic — {code}"
-                                        )
-                                    )
-
-                            if media:
-                                await message.answer_media_group(media[:10])
-                    else:
-                        # если /compare вернул ошибку — fallback в чат
-                        await message.answer("Не удалось сравнить коды, попробую ответить в общем режиме…")
-                        async with session.post(
-                            f"{API_URL}/chat",
-                            json={"message": message.text, "user_id": user_id},
-                            timeout=120
-                        ) as r2:
-                            data = await r2.json()
-                            await message.answer(data["response"])
+        if codes_hint:
+            # 2А) Если нашли валидные коды — сравнение; текст приходит потоком и дописывается в одно сообщение
+            MESSAGES.inc(route="compare")
+            sent = time.perf_counter()
+            with stage("compare_stream"):
+                async with api.compare_stream(codes_hint, user_id) as resp:
+                    compared = resp.status == 200
+                    if compared:
+                        live = LiveMessage(message)
+                        await live.start()
+                        final_codes = []
+                        first_token = True
+                        async for raw in resp.content:
+                            if not raw.strip():
+                                continue
+                            event = json.loads(raw)
+                            if event["type"] == "meta":
+                                final_codes = event.get("codes", [])
+                            elif event["type"] == "queue" and event["position"] > 0:
+                                await live.status(f"⏳ В очереди: {event['position']}")
+                            elif event["type"] == "token":
+                                if first_token:
+                                    COMPARE_TTFT.observe(time.perf_counter() - sent)
+                                    first_token = False
+                                await live.append(event["text"])
+                            elif event["type"] == "error":
+                                await live.finish()
+                                raise RuntimeError(event.get("detail", "генерация прервана"))
+                        await live.finish("Готово.")
+
+            if compared:
+                # отправляем визуализации ТОЛЬКО для final_codes — одним запросом /viz/bundle
+                if len(final_codes) >= 2:
+                    await _send_viz(message, final_codes)
             else:
-                # 2Б) Кодов не нашли — обычный чат
-                async with session.post(
-                    f"{API_URL}/chat",
-                    json={"message": message.text, "user_id": user_id},
-                    timeout=120
-                ) as resp:
-                    data = await resp.json()
-                    await message.answer(data["response"])
+                # если /compare вернул ошибку — fallback в чат
+                await message.answer("Не удалось сравнить коды, попробую ответить в общем режиме…")
+                MESSAGES.inc(route="chat_fallback")
+                await message.answer(await _chat(message.text, user_id))
+        else:
+            # 2Б) Кодов не нашли: «хочу …» — быстрый поиск программ, иначе (или если поиск пуст) — обычный чат
+            found = None
+            if SEARCH_ROUTING and message.text and INTEREST_RE.search(message.text):
+                try:
+                    with stage("search"):
+                        found = _format_search(await api.search(message.text))
+                except ApiError:
+                    found = None
+            MESSAGES.inc(route="search" if found else "chat")
+            await message.answer(found or await _chat(message.text, user_id))
 
     except Exception as e:
         await message.answer(f"Ошибка: {e}")
-    finally:
-        user_busy[user_id] = False
+
+async def _viz_bundle(codes: list[str]) -> dict:
+    """/viz/bundle; если часть картинок не построилась из-за перегрузки рендера (503) — ещё один запрос (готовые уже в кэше)."""
+    with stage("viz_bundle"):
+        bundle = await api.viz_bundle(codes)
+        if any(e["status"] == 503 for e in bundle.get("errors", [])):
+            await asyncio.sleep(VIZ_RETRY_DELAY)
+            bundle = await api.viz_bundle(codes)
+    return bundle
+
+async def _send_viz(message: Message, codes: list[str]):
+    await message.chat.do("upload_photo")
+    try:
+        bundle = await _viz_bundle(codes)
+    except ApiError as e:
+        await message.answer(f"⚠️ Графики не построены: {e.detail}")
+        return
+    media = [
+        InputMediaPhoto(
+            media=BufferedInputFile(base64.b64decode(img["png"]), filename=img["name"]),
+            caption=img["caption"]
+        )
+        for img in bundle.get("images", [])
+    ]
+    with stage("send_media"):
+        for i in range(0, len(media), 10):  # в одном альбоме Telegram не больше 10 фото
+            await message.answer_media_group(media[i:i + 10])
+    errors = bundle.get("errors", [])
+    if errors:
+        names = ", ".join(e["name"] for e in errors)
+        await message.answer(f"⚠️ Не удалось построить графики ({len(errors)}): {names}. Повторите сравнение позже.")
+
+async def _chat(text: str, user_id: str) -> str:
+    with stage("chat"):
+        return await api.chat(text, user_id)
+
+async def _metrics(_request: web.Request) -> web.Response:
+    BUSY_STATS["users"] = await asyncio.to_thread(USER_BUSY.count, "busy:")
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+async def _start_metrics_server(port: int) -> web.AppRunner:
+    """Отдельный HTTP-порт с /metrics бота (у бота нет своего веб-сервера — только polling)."""
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    return runner
 
 async def _refresh_known_codes():
     """Фоновая задача: периодически подтягивать белый список кодов с бэкенда."""
@@ -168,21 +316,28 @@ async def _refresh_known_codes():
     await asyncio.sleep(1.0)
     while True:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{API_URL}/codes", timeout=30) as resp:
-                    if resp.status == 200:
-                        data = await resp.json()
-                        codes = set(data.get("codes", []))
-                        if codes:
-                            KNOWN_CODES = codes
+            codes = set(await api.codes())
+            if codes:
+                KNOWN_CODES = codes
         except Exception:
             pass
-        await asyncio.sleep(60000)  # каждые 5 минут
+        await asyncio.sleep(CODES_REFRESH_INTERVAL)
+
+async def _on_shutdown():
+    # polling уже остановлен и обработчики дождались ответов — закрываем пул соединений к API
+    await api.close()
 
 async def main():
     # первичная загрузка KNOWN_CODES
-    asyncio.create_task(_refresh_known_codes())
-    await dp.start_polling(bot)
+    refresh = asyncio.create_task(_refresh_known_codes())
+    dp.shutdown.register(_on_shutdown)
+    metrics_runner = await _start_metrics_server(BOT_METRICS_PORT) if BOT_METRICS_PORT else None
+    try:
+        await dp.start_polling(bot)
+    finally:
+        refresh.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
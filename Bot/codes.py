@@ -0,0 +1,12 @@
+# codes.py
+"""
+Коды программ: XX (УГС) / XX.XX (направление) / XX.XX.XX (профиль).
+Без тяжёлых зависимостей — нужен и боту, и API, и офлайн-скриптам (utils.py тянет FastAPI и langchain).
+"""
+import re
+
+CODE_RE = re.compile(r"\b\d{2}(?:\.\d{2})?(?:\.\d{2})?\b")
+
+
+def _level(code: str) -> int:
+    return len(code.split("."))  # 1 part -> УГС, 2 parts -> направление, 3 parts -> профиль
@@ -1,13 +1,9 @@
 from typing import Dict, List
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
-import pickle
+from profile_store import load_profile_store
+from similarity import get_similarity_engine, NO_EMBEDDING_LABEL
+from precompute import get_precomputed, code_fragments
 
-with open("ABS_FULL.pkl", "rb") as f:
-    profile_data = pickle.load(f)
-
-def cosine_sim(a, b):
-    return cosine_similarity([a], [b])[0][0]
+profile_data = load_profile_store()
 
 def compare_codes(codes: List[str]) -> Dict:
     """
@@ -22,10 +18,7 @@ def compare_codes(codes: List[str]) -> Dict:
         "similarities": {}
     }
 
-    # Список для embeddings (в порядке codes)
-    valid_codes = []
-    embeddings = []
-
+    known_codes = []
     for code in codes:
         item = profile_data.get(code)
         if not item:
@@ -35,35 +28,41 @@ def compare_codes(codes: List[str]) -> Dict:
         results["tfidf"][code] = item["tfidf"]
         results["topics"][code] = item["topics"]
         results["summaries"][code] = item.get("summary", "").strip() or "Описание отсутствует."  # если пусто — подсказка
+        known_codes.append(code)
 
-        # Только если есть embedding, добавляем в сравнение
-        if "embedding" in item and item["embedding"] is not None:
-            embeddings.append(item["embedding"])
-            valid_codes.append(code)
-        else:
-            # Если нет embedding, считаем, что не можем сравнивать
-            results["similarities"][f"{code} vs ?"] = "Нет данных для сравнения (embedding)"
-
-    # Сравнение по cosine similarity между embedding
-    sim_matrix = {}
-    for i in range(len(valid_codes)):
-        for j in range(i + 1, len(valid_codes)):
-            code1, code2 = valid_codes[i], valid_codes[j]
-            sim = cosine_sim(embeddings[i], embeddings[j])
-
-            pair = f"{code1} vs {code2}"
-            if sim <= 0.93:
-                sim_matrix[pair] = "Очень сильно отличаются"
-            elif sim <= 0.95:
-                sim_matrix[pair] = "Отличаются"
-            elif sim <= 0.99:
-                sim_matrix[pair] = "Похожи, но с разными акцентами"
-            else:  # sim > 0.99
-                sim_matrix[pair] = "Идентичны"
-
-    results["similarities"].update(sim_matrix)
+    # Сравнение по cosine similarity между embedding — одно матричное произведение на весь набор
+    sim = get_similarity_engine().compare(tuple(known_codes))
+    for code in sim["missing"]:
+        # Если нет embedding, считаем, что не можем сравнивать
+        results["similarities"][f"{code} vs ?"] = NO_EMBEDDING_LABEL
+    results["similarities"].update(sim["labels"])
+    results["matrix"] = sim["matrix"]  # сырые значения для heatmap/2D-проекции
 
     return results
 
+def prompt_fields(result: Dict) -> Dict[str, str]:
+    """
+    Поля для prompt_codes по результату compare_codes.
+    Строки по каждому коду берутся из офлайн-предрасчёта (precompute.py build), если он есть.
+    """
+    pre = get_precomputed()
+    fragments = {}
+    for code in result["tfidf"]:
+        if pre is not None and code in pre.fragments:
+            fragments[code] = pre.fragments[code]
+        else:
+            fragments[code] = code_fragments(code, {
+                "tfidf": result["tfidf"][code],
+                "topics": result["topics"][code],
+                "summary": result["summaries"][code],
+            })
+    return {
+        "codes": ", ".join(result["codes"]),
+        "similarities": "\n".join([f"{k}: {v}" for k, v in result["similarities"].items()]),
+        "tfidf": "\n".join(f["tfidf"] for f in fragments.values()),
+        "topics": "\n".join(f["topics"] for f in fragments.values()),
+        "summaries": "\n".join(f["summary"] for f in fragments.values()),
+    }
+
 #if __name__ == "__main__":
-#    print(compare_codes(["15.03.01", "09.03.02", "09.03.01"])["summaries"])
\ No newline at end of file
+#    print(compare_codes(["15.03.01", "09.03.02", "09.03.01"])["summaries"])
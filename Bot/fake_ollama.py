@@ -0,0 +1,92 @@
+# fake_ollama.py
+"""
+Поддельный сервер Ollama для локальной проверки пула LLM (llm_pool.py) без GPU и моделей.
+Отвечает на /api/chat (NDJSON-поток, как настоящий Ollama) и /api/tags (health check).
+Ответ — фиксированный текст, выдаваемый по словам со скоростью --tokens-per-sec.
+
+Запуск (из Bot/), например, два «сервера»:
+    python fake_ollama.py --port 11501 &
+    python fake_ollama.py --port 11502 --fail-rate 0.3 &
+    OLLAMA_BASE_URLS=http://localhost:11501,http://localhost:11502 python main.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from datetime import datetime, timezone
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+FAKE_TOKENS_PER_SEC = float(os.getenv("FAKE_TOKENS_PER_SEC", "50"))
+FAKE_TTFT = float(os.getenv("FAKE_TTFT", "0.2"))  # сек. до первого токена
+FAKE_FAIL_RATE = float(os.getenv("FAKE_FAIL_RATE", "0"))  # доля запросов, отвечающих 500
+FAKE_ANSWER = (
+    "1. Краткое описание направлений\n   - Первое направление ближе к программированию.\n"
+    "   - Второе направление ближе к анализу данных.\n2. Заключение\n   Направления похожи, "
+    "различаются акцентами. Рекомендация: если тебе ближе разработка — выбирай первое."
+)
+
+app = FastAPI()
+stats = {"requests": 0, "failed": 0, "in_flight": 0}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [{"name": os.getenv("OLLAMA_MODEL", "llama2:latest")}]}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+@app.post("/api/chat")
+async def chat(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    if random.random() < FAKE_FAIL_RATE:
+        stats["failed"] += 1
+        raise HTTPException(500, "fake failure")
+    model = body.get("model", "fake")
+    words = FAKE_ANSWER.split(" ")
+
+    async def gen():
+        stats["in_flight"] += 1
+        started = time.perf_counter_ns()
+        try:
+            await asyncio.sleep(FAKE_TTFT)
+            for i, word in enumerate(words):
+                text = word if i == 0 else " " + word
+                yield json.dumps({"model": model, "created_at": _now(),
+                                  "message": {"role": "assistant", "content": text}, "done": False}) + "\n"
+                await asyncio.sleep(1 / FAKE_TOKENS_PER_SEC)
+            yield json.dumps({
+                "model": model, "created_at": _now(), "message": {"role": "assistant", "content": ""},
+                "done": True, "done_reason": "stop", "total_duration": time.perf_counter_ns() - started,
+                "prompt_eval_count": sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4,
+                "eval_count": len(words),
+            }) + "\n"
+        finally:
+            stats["in_flight"] -= 1
+
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Поддельный Ollama для проверки пула LLM")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--tokens-per-sec", type=float, default=FAKE_TOKENS_PER_SEC)
+    parser.add_argument("--ttft", type=float, default=FAKE_TTFT)
+    parser.add_argument("--fail-rate", type=float, default=FAKE_FAIL_RATE)
+    args = parser.parse_args()
+    FAKE_TOKENS_PER_SEC, FAKE_TTFT, FAKE_FAIL_RATE = args.tokens_per_sec, args.ttft, args.fail_rate
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
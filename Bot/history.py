@@ -0,0 +1,109 @@
+# history.py
+"""
+Сжатие истории /chat по бюджету токенов (а не только по числу сообщений).
+- системный промпт ([PROMPT_V1]) всегда остаётся первым
+- старые реплики отбрасываются целыми ходами (с сообщения пользователя), пока история не влезет в бюджет
+- отброшенное (по желанию) кратко дописывается в закреплённое системное сообщение [SUMMARY]
+
+Токены оцениваются эвристикой без токенизатора модели: кириллица у llama-подобных
+токенизаторов дробится мельче латиницы, поэтому считаем их по-разному.
+"""
+import math
+import os
+import re
+
+from langchain_core.messages import SystemMessage
+
+# Контекстное окно по семейству модели (OLLAMA_MODEL без тега после ":"); самый длинный совпавший префикс
+MODEL_CONTEXT = {
+    "llama2": 4096,
+    "llama3": 8192,
+    "llama3.1": 131072,
+    "llama3.2": 131072,
+    "mistral": 32768,
+    "qwen2": 32768,
+    "qwen2.5": 32768,
+    "gemma2": 8192,
+    "phi3": 4096,
+}
+DEFAULT_CONTEXT = 4096
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "0"))  # 0 — половина окна модели
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "extractive")  # extractive | off
+SUMMARY_TAG = "[SUMMARY]"
+SUMMARY_ID = "history-summary"
+_CYRILLIC_RE = re.compile(r"[Ѐ-ӿ]")
+_MESSAGE_OVERHEAD = 4  # роль и служебные токены шаблона чата
+
+
+def context_window(model: str) -> int:
+    name = model.split(":")[0].lower()
+    matches = [k for k in MODEL_CONTEXT if name.startswith(k)]
+    return MODEL_CONTEXT[max(matches, key=len)] if matches else DEFAULT_CONTEXT
+
+
+def estimate_tokens(text: str) -> int:
+    cyr = len(_CYRILLIC_RE.findall(text))
+    return math.ceil(cyr / 2.5 + (len(text) - cyr) / 4)
+
+
+def message_tokens(m) -> int:
+    content = m.content if isinstance(m.content, str) else str(m.content)
+    return estimate_tokens(content) + _MESSAGE_OVERHEAD
+
+
+def _is_summary(m) -> bool:
+    return getattr(m, "type", None) == "system" and isinstance(m.content, str) and m.content.startswith(SUMMARY_TAG)
+
+
+def _brief(text: str, limit: int = 160) -> str:
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+class HistoryCompactor:
+    def __init__(self, budget: int | None = None, max_messages: int = 15,
+                 summarize: bool = True, summary_budget: int = 400):
+        self.budget = budget  # None — без ограничения по токенам
+        self.max_messages = max_messages
+        self.summarize = summarize
+        self.summary_budget = summary_budget
+
+    @classmethod
+    def for_model(cls, model: str, max_messages: int = 15) -> "HistoryCompactor":
+        budget = HISTORY_TOKEN_BUDGET or context_window(model) // 2
+        return cls(budget=budget, max_messages=max_messages, summarize=HISTORY_SUMMARY != "off")
+
+    def compact(self, msgs: list) -> list:
+        pinned = [m for m in msgs if getattr(m, "type", None) == "system" and not _is_summary(m)]
+        summary = next((m for m in msgs if _is_summary(m)), None)
+        tail = [m for m in msgs if getattr(m, "type", None) != "system"]
+
+        # последний ход (с последнего сообщения пользователя) оставляем всегда, даже если он больше бюджета
+        last_turn = max((i for i, m in enumerate(tail) if getattr(m, "type", None) == "human"), default=max(len(tail) - 1, 0))
+        keep_from = min(max(0, len(tail) - self.max_messages), last_turn)
+        if self.budget is not None:
+            fixed = sum(message_tokens(m) for m in pinned) + (self.summary_budget if self.summarize else 0)
+            used = fixed + sum(message_tokens(m) for m in tail[keep_from:])
+            while used > self.budget and keep_from < last_turn:
+                used -= message_tokens(tail[keep_from])
+                keep_from += 1
+        # ход начинается с сообщения пользователя: не оставляем «висящие» ответы/результаты инструментов
+        while keep_from < last_turn and getattr(tail[keep_from], "type", None) != "human":
+            keep_from += 1
+
+        dropped, tail = tail[:keep_from], tail[keep_from:]
+        if dropped and self.summarize:
+            summary = self._summary(summary, dropped)
+        return pinned + ([summary] if summary is not None else []) + tail
+
+    def _summary(self, previous, dropped: list) -> SystemMessage:
+        lines = previous.content.split("\n")[2:] if previous is not None else []
+        for m in dropped:
+            role = {"human": "Пользователь", "ai": "Ассистент"}.get(getattr(m, "type", None))
+            if role and m.content:
+                lines.append(f"- {role}: {_brief(m.content)}")
+        # rolling: самые старые строки уходят первыми
+        while lines and sum(estimate_tokens(line) + 1 for line in lines) > self.summary_budget:
+            lines.pop(0)
+        header = f"{SUMMARY_TAG}\nКраткое содержание более ранней части диалога:"
+        return SystemMessage(content="\n".join([header, *lines]), id=SUMMARY_ID)
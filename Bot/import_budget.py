@@ -0,0 +1,85 @@
+# import_budget.py
+"""
+Проверка бюджета времени импорта: сколько стоит `import main` (воркер API) и `import bot`, и не протащил ли
+кто-то на старт тяжёлые модули, которые должны подгружаться лениво (в прогреве main._warmup или при первом вызове).
+
+Каждый модуль импортируется в чистом процессе с `python -X importtime`; печатаются общее время и самые дорогие
+пакеты верхнего уровня. Код выхода 1 — бюджет превышен или найден запрещённый модуль.
+Секунды зависят от машины (--budget-main / --budget-bot); список запрещённых модулей — нет.
+Бюджет бота — без пакета aiogram (EXCLUDED): он один занимает секунды, и бюджет на его фоне ничего бы не проверял.
+
+Запуск (из Bot/):
+    python import_budget.py
+    python import_budget.py --budget-main 1.0 --top 15
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# модули, которых не должно быть в импорте при старте процесса
+FORBIDDEN = {
+    "main": ("sklearn", "matplotlib", "scipy", "langgraph.prebuilt", "langchain_ollama", "langchain_google_genai",
+             "langchain_core.prompts", "langchain_chroma", "langchain_huggingface", "torch"),
+    "bot": ("fastapi", "langchain_core", "langgraph", "numpy"),
+}
+# прямые импорты, чьё время вычитается из бюджета: их не ускорить, а наш код на их фоне не виден
+EXCLUDED = {
+    "bot": ("aiogram",),
+}
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(module: str) -> tuple[float, dict[str, float], set[str]]:
+    """(общее время, сек. по пакетам верхнего уровня, все импортированные модули) для `import module`."""
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", "0:import-budget")  # bot.py создаёт Bot(token) при импорте; сеть не нужна
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=HERE, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} упал:\n{proc.stderr[-2000:]}")
+    total, packages, modules = 0.0, {}, set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip())) // 2  # importtime сдвигает вложенные импорты на 2 пробела
+        name = name.strip()
+        modules.add(name)
+        seconds = int(cumulative) / 1e6
+        if name == module:
+            total = seconds
+        elif depth == 1:  # прямые импорты модуля: именно они и складываются в его время
+            packages[name] = packages.get(name, 0.0) + seconds
+    return total, packages, modules
+
+
+def check(module: str, budget: float, top: int) -> list[str]:
+    total, packages, modules = measure(module)
+    excluded = {name: seconds for name, seconds in packages.items()
+                if any(name == e or name.startswith(e + ".") for e in EXCLUDED.get(module, ()))}
+    own = total - sum(excluded.values())
+    note = f", без {', '.join(excluded)}: {own:.3f} с" if excluded else ""
+    print(f"import {module}: {total:.3f} с{note} (бюджет {budget:.2f} с)")
+    for name, seconds in sorted(packages.items(), key=lambda kv: -kv[1])[:top]:
+        print(f"  {seconds:7.3f} с  {name}{'  (не в бюджете)' if name in excluded else ''}")
+    problems = [f"import {module}: {own:.3f} с > {budget:.2f} с"] if own > budget else []
+    for name in FORBIDDEN.get(module, ()):
+        if any(m == name or m.startswith(name + ".") for m in modules):
+            problems.append(f"import {module} тянет {name} — его нужно импортировать лениво")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бюджет времени импорта API и бота")
+    parser.add_argument("--budget-main", type=float, default=float(os.getenv("IMPORT_BUDGET_MAIN", "1.5")))
+    parser.add_argument("--budget-bot", type=float, default=float(os.getenv("IMPORT_BUDGET_BOT", "0.5")),
+                        help="без aiogram (EXCLUDED)")
+    parser.add_argument("--top", type=int, default=10, help="сколько самых дорогих импортов показать")
+    args = parser.parse_args()
+
+    problems = check("main", args.budget_main, args.top) + check("bot", args.budget_bot, args.top)
+    for p in problems:
+        print("ПРЕВЫШЕНИЕ:", p)
+    print("Бюджет соблюдён" if not problems else f"Нарушений: {len(problems)}")
+    sys.exit(1 if problems else 0)
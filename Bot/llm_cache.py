@@ -0,0 +1,174 @@
+# llm_cache.py
+"""
+Постоянный кэш ответов LLM для /compare (локальный SQLite).
+Промпт /compare целиком определяется набором кодов, поэтому ключ —
+(отсортированный набор кодов, хэш шаблона prompt_codes, модель, temperature, версия датасета).
+Вытеснение: TTL по времени создания + LRU по last_access сверх LLM_CACHE_MAX_ENTRIES.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))  # сек.
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+LLM_CACHE_FLUSH_EVERY = float(os.getenv("LLM_CACHE_FLUSH_EVERY", "30"))  # сек. между записями статистики запросов
+
+
+def normalize_codes(codes: list[str]) -> list[str]:
+    return sorted({c.strip() for c in codes})
+
+
+def llm_cache_key(codes: list[str], template: str, model: str, temperature: float, dataset_version: str = "") -> str:
+    raw = json.dumps({
+        "codes": normalize_codes(codes),
+        "template": hashlib.sha256(template.encode("utf-8")).hexdigest(),
+        "model": model,
+        "temperature": temperature,
+        "dataset": dataset_version,
+    }, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl: float = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # статистика запросов копится в памяти и пишется пачкой (flush_requests) — не запись в SQLite на каждый /compare
+        self._pending: dict[str, list] = {}  # "коды,через,запятую" -> [число запросов, время последнего]
+        self._pending_lock = threading.Lock()  # отдельный от _lock: record_request не ждёт идущую запись в базу
+        self._conn: sqlite3.Connection | None = None
+        self._pid = None
+
+    def _db(self) -> sqlite3.Connection:
+        # соединение открывается лениво и заново после fork (serve.py импортирует main до запуска воркеров)
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    codes TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache(last_access)")
+            # статистика запросов по наборам кодов — для прогрева (precompute.py warmup)
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS compare_requests (
+                    codes TEXT PRIMARY KEY,
+                    count INTEGER NOT NULL,
+                    last_at REAL NOT NULL
+                )"""
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT text, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            db.execute("UPDATE llm_cache SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, codes: list[str], text: str):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, codes, text, created_at, last_access, hits) VALUES (?, ?, ?, ?, ?, 0)",
+                (key, ",".join(normalize_codes(codes)), text, now, now),
+            )
+            self._evict(db, now)
+
+    def _evict(self, db: sqlite3.Connection, now: float):
+        db.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+        (count,) = db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        if count > self.max_entries:
+            db.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def record_request(self, codes: list[str]):
+        """Учёт запроса для прогрева — только в памяти, в базу попадает при flush_requests."""
+        joined = ",".join(normalize_codes(codes))
+        with self._pending_lock:
+            row = self._pending.get(joined)
+            if row is None:
+                self._pending[joined] = [1, time.time()]
+            else:
+                row[0] += 1
+                row[1] = time.time()
+
+    def flush_requests(self) -> int:
+        """Пишет накопленную статистику одной транзакцией. Возвращает число наборов кодов."""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.executemany(
+                    "INSERT INTO compare_requests (codes, count, last_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(codes) DO UPDATE SET count = count + excluded.count, "
+                    "last_at = max(last_at, excluded.last_at)",
+                    [(codes, n, last) for codes, (n, last) in pending.items()],
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                self._restore(pending)
+                raise
+        return len(pending)
+
+    def _restore(self, pending: dict[str, list]):
+        # пачка не записалась — возвращаем её к накопленному за это время, следующий flush попробует снова
+        with self._pending_lock:
+            for codes, (n, last) in pending.items():
+                row = self._pending.setdefault(codes, [0, last])
+                row[0] += n
+                row[1] = max(row[1], last)
+
+    def top_requested(self, k: int) -> list[list[str]]:
+        self.flush_requests()
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT codes FROM compare_requests ORDER BY count DESC, last_at DESC LIMIT ?", (k,)
+            ).fetchall()
+        return [r[0].split(",") for r in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            (entries,) = self._db().execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "entries": entries,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0}
+
+    #---async API: SQLite блокирующий (busy_timeout при записи соседнего воркера), выносим в поток---
+    async def aget(self, key: str) -> str | None:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, codes: list[str], text: str):
+        return await asyncio.to_thread(self.put, key, codes, text)
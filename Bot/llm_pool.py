@@ -0,0 +1,158 @@
+# llm_pool.py
+"""
+Несколько серверов Ollama за одним API (OLLAMA_BASE_URLS="http://h1:11434,http://h2:11434").
+- маршрутизация: sticky по user_id (rendezvous hashing — при выпадении сервера переезжают только его
+  пользователи), чтобы сервер переиспользовал KV-кэш диалога; если «свой» сервер заметно загружен
+  сильнее остальных (LLM_STICKY_SLACK) или недоступен — наименее загруженный (least outstanding requests)
+- health check: фоновый GET /api/tags раз в LLM_HEALTH_INTERVAL сек.
+- circuit breaker: после LLM_BREAKER_FAILURES ошибок подряд сервер выключается на LLM_BREAKER_COOLDOWN сек.,
+  затем пропускается один пробный запрос (half-open): успех — сервер снова в строю, ошибка — снова пауза
+- клиенты LLM и агенты создаются при первом обращении (backend.llm / backend.agent): импорт langchain_ollama
+  и langgraph не задерживает старт процесса, их подгружает прогрев в main.py уже после открытия порта
+"""
+import asyncio
+import hashlib
+import os
+import random
+import time
+from collections.abc import Callable
+from contextlib import asynccontextmanager
+
+import httpx
+
+LLM_STICKY_SLACK = int(os.getenv("LLM_STICKY_SLACK", "2"))  # на сколько запросов «свой» сервер может быть загружен сильнее
+LLM_HEALTH_INTERVAL = float(os.getenv("LLM_HEALTH_INTERVAL", "10"))  # сек.
+LLM_HEALTH_TIMEOUT = float(os.getenv("LLM_HEALTH_TIMEOUT", "3"))  # сек.
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))  # сек.
+
+
+def backend_urls(default: str) -> list[str]:
+    """OLLAMA_BASE_URLS (через запятую), иначе один OLLAMA_BASE_URL."""
+    raw = os.getenv("OLLAMA_BASE_URLS", "")
+    urls = [u.strip().rstrip("/") for u in raw.split(",") if u.strip()]
+    return urls or [default.rstrip("/")]
+
+
+class NoBackend(Exception):
+    pass
+
+
+class Backend:
+    def __init__(self, url: str, make_llm: Callable[[str], object], make_agent: Callable[[object], object] | None = None):
+        self.url = url
+        self._make_llm = make_llm
+        self._make_agent = make_agent
+        self._llm = None
+        self._agent = None
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0  # ошибок подряд
+        self.open_until = 0.0  # circuit breaker открыт до (time.monotonic())
+        self.probing = False  # half-open: пробный запрос уже идёт
+        self.served = 0
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            self._llm = self._make_llm(self.url)
+        return self._llm
+
+    @property
+    def agent(self):
+        if self._agent is None and self._make_agent is not None:
+            self._agent = self._make_agent(self.llm)
+        return self._agent
+
+    def available(self, now: float) -> bool:
+        if not self.healthy:
+            return False
+        if self.failures < LLM_BREAKER_FAILURES:
+            return True
+        return now >= self.open_until and not self.probing  # half-open: один пробный запрос
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        breaker = "closed" if self.failures < LLM_BREAKER_FAILURES else ("open" if now < self.open_until else "half-open")
+        return {"url": self.url, "healthy": self.healthy, "breaker": breaker,
+                "outstanding": self.outstanding, "served": self.served}
+
+
+def _rendezvous(user_id: str, url: str) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{user_id}|{url}".encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class LLMPool:
+    def __init__(self, urls: list[str], make_llm: Callable[[str], object], make_agent: Callable[[object], object] | None = None):
+        self.backends = [Backend(url, make_llm, make_agent) for url in urls]
+        self._health_task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    def pick(self, user_id: str | None = None, exclude: tuple = ()) -> Backend:
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b.available(now) and b not in exclude]
+        if not candidates:
+            raise NoBackend("нет доступных серверов LLM")
+        least = min(b.outstanding for b in candidates)
+        if user_id is not None:
+            sticky = max(candidates, key=lambda b: _rendezvous(user_id, b.url))
+            if sticky.outstanding - least <= LLM_STICKY_SLACK:
+                return sticky
+        return random.choice([b for b in candidates if b.outstanding == least])
+
+    @asynccontextmanager
+    async def use(self, user_id: str | None = None, exclude: tuple = ()):
+        """Сервер на время запроса; исключение внутри блока считается ошибкой сервера (для breaker)."""
+        backend = self.pick(user_id, exclude)
+        probe = backend.failures >= LLM_BREAKER_FAILURES
+        backend.probing = backend.probing or probe
+        backend.outstanding += 1
+        try:
+            yield backend
+        except asyncio.CancelledError:
+            raise  # клиент ушёл — сервер не виноват
+        except Exception:
+            self._failure(backend)
+            raise
+        else:
+            backend.failures = 0
+            backend.served += 1
+        finally:
+            backend.outstanding -= 1
+            if probe:
+                backend.probing = False
+
+    def _failure(self, backend: Backend):
+        backend.failures += 1
+        if backend.failures >= LLM_BREAKER_FAILURES:
+            backend.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN
+
+    #---health check---
+    async def check_health(self):
+        async with httpx.AsyncClient(timeout=LLM_HEALTH_TIMEOUT) as client:
+            async def probe(backend: Backend):
+                try:
+                    backend.healthy = (await client.get(f"{backend.url}/api/tags")).status_code == 200
+                except httpx.HTTPError:
+                    backend.healthy = False
+            await asyncio.gather(*(probe(b) for b in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(LLM_HEALTH_INTERVAL)
+
+    def start(self):
+        # с одним сервером проверять нечего: выбора всё равно нет
+        if len(self.backends) > 1 and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+
+    def stats(self) -> list[dict]:
+        return [b.stats() for b in self.backends]
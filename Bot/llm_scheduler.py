@@ -0,0 +1,251 @@
+# llm_scheduler.py
+"""
+Допуск запросов к LLM (Ollama): не больше max_in_flight генераций одновременно (в main.py —
+LLM_MAX_IN_FLIGHT на каждый сервер пула), остальные ждут в очереди.
+- приоритет: короткий /chat обслуживается раньше длинного /compare, но не больше LLM_CHAT_BURST
+  /chat подряд, пока ждёт /compare (чтобы сравнения не голодали)
+- честность: внутри приоритета пользователи обслуживаются по кругу (round-robin),
+  один пользователь с пачкой запросов не занимает всю очередь
+- позиция в очереди доступна ожидающему (Ticket.positions) — её видно боту
+- дедлайн: если по оценке (EWMA времени обслуживания) запрос не дождётся своей очереди до дедлайна,
+  он отклоняется сразу (QueueTimeout -> 503 + Retry-After), а не висит до таймаута клиента
+- отменённый ожидающий (клиент отключился) уходит из очереди и не занимает слот
+
+Очередь — в памяти процесса. При нескольких процессах API (serve.py --workers N, SHARED_STATE=sqlite)
+лимит общий: запрос, получивший слот в своём воркере, дополнительно занимает один из max_in_flight слотов
+в shared_state (shared_state.SharedSlots) и ждёт его до того же дедлайна, так что в Ollama уходит не больше
+лимита генераций на все воркеры. Честность, позиции в очереди и оценка дедлайна — в пределах воркера:
+пользователь, чьи запросы попали в разные воркеры, получает долю в каждом.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from shared_state import LockTimeout, SharedSlots
+
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "2"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "100"))  # сек., меньше таймаута бота (120)
+LLM_CHAT_BURST = int(os.getenv("LLM_CHAT_BURST", "4"))
+LLM_RETRY_AFTER = int(os.getenv("LLM_RETRY_AFTER", "5"))  # сек., для ответа 503
+
+CHAT, COMPARE = 0, 1  # приоритеты: меньше — раньше
+_INITIAL_SERVICE_TIME = {CHAT: 5.0, COMPARE: 30.0}  # сек., стартовая оценка до первых замеров
+_EWMA_ALPHA = 0.2
+
+
+class QueueFull(Exception):
+    pass
+
+
+class QueueTimeout(Exception):
+    pass
+
+
+class ClientGone(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, scheduler: "LLMScheduler", user_id: str, priority: int, deadline: float):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.priority = priority
+        self.deadline = deadline  # time.monotonic()
+        self.granted = False
+        self.released = False
+        self.started = 0.0
+        self.shared_slot: tuple[str, str] | None = None  # (ключ, владелец) в scheduler.shared
+
+    @property
+    def position(self) -> int:
+        """1 — следующий на обслуживание, 0 — уже обслуживается."""
+        return 0 if self.granted else self.scheduler._positions.get(self, 0)
+
+    async def positions(self):
+        """Позиция в очереди при каждом её изменении; итерация заканчивается, когда слот выдан."""
+        last = None
+        while not self.granted:
+            if self.position != last:
+                last = self.position
+                yield last
+            changed = self.scheduler._changed
+            timeout = self.deadline - time.monotonic()
+            if timeout <= 0:
+                raise QueueTimeout("не дождались очереди к LLM")
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        shared = self.scheduler.shared
+        if shared is not None and self.shared_slot is None:
+            # слот воркера выдан — теперь общий на все процессы, до того же дедлайна
+            try:
+                self.shared_slot = await shared.acquire(self.deadline - time.monotonic())
+            except LockTimeout:
+                raise QueueTimeout("не дождались очереди к LLM")
+            self.started = time.monotonic()
+
+    async def wait(self):
+        async for _ in self.positions():
+            pass
+
+    def release(self):
+        self.scheduler._release(self)
+
+
+class LLMScheduler:
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, max_queue: int = LLM_MAX_QUEUE,
+                 queue_timeout: float = LLM_QUEUE_TIMEOUT, chat_burst: int = LLM_CHAT_BURST,
+                 shared: SharedSlots | None = None):
+        self.max_in_flight = max_in_flight
+        self.shared = shared  # общий для процессов лимит (None — один процесс)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.chat_burst = chat_burst
+        self.in_flight = 0
+        self.service_time = dict(_INITIAL_SERVICE_TIME)
+        self.rejected = 0
+        # приоритет -> пользователь -> его ожидающие (порядок пользователей = порядок круга)
+        self._queues: dict[int, OrderedDict[str, deque[Ticket]]] = {CHAT: OrderedDict(), COMPARE: OrderedDict()}
+        self._chat_streak = 0
+        self._positions: dict[Ticket, int] = {}
+        self._changed = asyncio.Event()
+
+    def waiting(self) -> int:
+        return len(self._positions)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "waiting": self.waiting(),
+            "rejected": self.rejected,
+            "service_time": {("chat" if p == CHAT else "compare"): round(t, 2) for p, t in self.service_time.items()},
+        }
+
+    def enqueue(self, user_id: str, priority: int, timeout: float | None = None) -> Ticket:
+        """Ставит запрос в очередь (или сразу выдаёт слот). QueueFull/QueueTimeout — отказ без ожидания."""
+        timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        ticket = Ticket(self, user_id, priority, time.monotonic() + timeout)
+        if self.waiting() >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull("очередь к LLM переполнена")
+        self._queues[priority].setdefault(user_id, deque()).append(ticket)
+        self._dispatch()
+        if not ticket.granted and self.estimated_wait(ticket) > timeout:
+            self._remove(ticket)
+            self._recompute_positions()
+            self._notify()
+            self.rejected += 1
+            raise QueueTimeout("LLM перегружена: ответ не успеет до дедлайна")
+        return ticket
+
+    def estimated_wait(self, ticket: Ticket) -> float:
+        ahead = [t for t, pos in self._positions.items() if pos <= self._positions.get(ticket, 0)]
+        return sum(self.service_time[t.priority] for t in ahead) / self.max_in_flight
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, priority: int, timeout: float | None = None):
+        ticket = self.enqueue(user_id, priority, timeout)
+        try:
+            await ticket.wait()
+            yield ticket
+        finally:
+            ticket.release()
+
+    #---внутреннее---
+    def _pop_next(self) -> Ticket | None:
+        chats, compares = self._queues[CHAT], self._queues[COMPARE]
+        if chats and not (compares and self._chat_streak >= self.chat_burst):
+            queue, self._chat_streak = chats, self._chat_streak + 1
+        elif compares:
+            queue, self._chat_streak = compares, 0
+        else:
+            return None
+        user_id, tickets = next(iter(queue.items()))
+        ticket = tickets.popleft()
+        if tickets:
+            queue.move_to_end(user_id)  # следующий раз — очередь другого пользователя
+        else:
+            del queue[user_id]
+        return ticket
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight:
+            ticket = self._pop_next()
+            if ticket is None:
+                break
+            ticket.granted = True
+            ticket.started = time.monotonic()
+            self.in_flight += 1
+        self._recompute_positions()
+        self._notify()
+
+    def _recompute_positions(self):
+        # порядок обслуживания оставшихся — прогоном того же алгоритма на копии очередей
+        saved_queues = self._queues
+        saved_streak = self._chat_streak
+        self._queues = {p: OrderedDict((u, deque(ts)) for u, ts in q.items()) for p, q in saved_queues.items()}
+        positions = {}
+        while (ticket := self._pop_next()) is not None:
+            positions[ticket] = len(positions) + 1
+        self._queues, self._chat_streak = saved_queues, saved_streak
+        self._positions = positions
+
+    def _remove(self, ticket: Ticket):
+        tickets = self._queues[ticket.priority].get(ticket.user_id)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del self._queues[ticket.priority][ticket.user_id]
+        self._positions.pop(ticket, None)
+
+    def _release(self, ticket: Ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.granted:
+            self.in_flight -= 1
+            if ticket.shared_slot is not None:
+                self.shared.release(*ticket.shared_slot)
+            if self.shared is None or ticket.shared_slot is not None:  # не дождавшийся общего слота не генерировал
+                took = time.monotonic() - ticket.started
+                old = self.service_time[ticket.priority]
+                self.service_time[ticket.priority] = (1 - _EWMA_ALPHA) * old + _EWMA_ALPHA * took
+        else:
+            self._remove(ticket)  # ушёл из очереди, не дождавшись (отмена, дедлайн)
+        self._dispatch()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+
+def retry_after(scheduler: LLMScheduler) -> int:
+    """Подсказка клиенту, через сколько секунд пробовать снова."""
+    busy = scheduler.waiting() * min(scheduler.service_time.values()) / scheduler.max_in_flight
+    return max(LLM_RETRY_AFTER, math.ceil(busy))
+
+
+async def cancel_on_disconnect(request, coro, poll: float = 0.5):
+    """
+    Выполняет coro, пока клиент на связи. FastAPI не отменяет обычный (не потоковый) обработчик,
+    когда клиент ушёл, — опрашиваем request.is_disconnected() и отменяем работу сами.
+    Возвращает результат coro; ClientGone — если клиент отключился.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise ClientGone()
+    finally:
+        if not task.done():
+            task.cancel()
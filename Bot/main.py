@@ -1,21 +1,38 @@
+import time
+_IMPORT_STARTED = time.perf_counter()  # для /ready и метрик: сколько занимает импорт main
 from dotenv import load_dotenv
+load_dotenv()  # до остальных импортов: модули (rag, shared_state, llm_scheduler…) читают env при импорте
 from fastapi import FastAPI
 from langchain_core.messages import HumanMessage
-from langgraph.prebuilt import create_react_agent
-from langchain_google_genai import ChatGoogleGenerativeAI
 import uvicorn
-from memory import CappingMemorySaver
+from memory import CappingMemorySaver, CappingSqliteSaver
+from history import HistoryCompactor
 import asyncio
-from fastapi.responses import StreamingResponse
-import io, pickle, numpy as np
-from utils_viz import project_2d, plot_positions_2d, plot_tfidf_bars, plot_topics_text, plot_similarity_heatmap
+import base64
+import json
+from contextlib import asynccontextmanager, aclosing
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from png_cache import PngCache, png_cache_key, etag_for, etag_matches
+from utils_viz import plot_tfidf_bars, plot_topics_text, render_position, render_heatmap, preload
+from llm_cache import LLMCache, llm_cache_key, LLM_CACHE_FLUSH_EVERY
+from singleflight import SingleFlight
+from llm_pool import LLMPool, NoBackend, backend_urls
+from llm_scheduler import LLMScheduler, LLM_MAX_IN_FLIGHT, QueueFull, QueueTimeout, ClientGone, CHAT, COMPARE, retry_after, cancel_on_disconnect
+from render_pool import RenderPool, RenderBusy, RenderTimeout, RENDER_RETRY_AFTER
 from models import CodesIn, Input
-from utils import _cfg, ensure_system_prompt, _validate_codes, _level
+from utils import _cfg, ensure_system_prompt, _validate_codes, _level, UserLocks
+from profile_store import load_profile_store
 from fastapi import HTTPException
-from compare_codes import compare_codes
+from compare_codes import compare_codes, prompt_fields
+from similarity import get_similarity_engine, similarity_label
+from neighbours import get_neighbour_index, SIMILAR_TOP_K
+from search import get_search_index, SEARCH_MAX_K
+from metrics import REGISTRY, CONTENT_TYPE, MetricsMiddleware, InFlight, stage
+from shared_state import SHARED_STATE, SharedSlots, get_shared_state
 from prompts import prompt_codes
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_ollama import ChatOllama
+from rag import rag_available, get_retriever, extract_codes
+import functools
 import os
 
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
@@ -23,97 +40,514 @@ OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama2:latest")
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.7"))
 
 #---LLM, AGENTS, TOOLS---
-load_dotenv()
-app = FastAPI()
-#llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", temperature=1)
-llm = ChatOllama(model=OLLAMA_MODEL, base_url=OLLAMA_BASE_URL, temperature=LLM_TEMPERATURE)
-tools = []
-check = CappingMemorySaver()
-agent = create_react_agent(model=llm, tools=tools, checkpointer=check)
-_user_locks: dict[str, asyncio.Lock] = {}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    LLM_POOL.start()
+    # тяжёлое (индексы, клиенты LLM, процессы рендера, модель эмбеддингов) — в фоне: порт открывается сразу,
+    # готовность видна по /ready; запросы до конца прогрева тоже работают, просто первые медленнее
+    warmup = asyncio.create_task(_warmup())
+    flusher = asyncio.create_task(_flush_requests())
+    yield
+    warmup.cancel()
+    flusher.cancel()
+    await asyncio.to_thread(LLM_CACHE.flush_requests)  # последняя пачка статистики запросов
+    await LLM_POOL.close()
+    RENDER_POOL.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)  # /metrics: время и статусы по маршрутам, Server-Timing в ответах
+
+def _rag_tools() -> list:
+    """Поиск по аннотациям (RAG) — только если включён и есть база; нужна модель с tool calling."""
+    if not rag_available():
+        return []
+    from tools import search_annotations  # langchain_core.tools — только когда инструмент нужен
+    return [search_annotations]
+
+tools = _rag_tools()
+# sqlite — история на диске (переживает рестарт, общая для воркеров), memory — как раньше, в памяти процесса
+CHECKPOINT_BACKEND = os.getenv("CHECKPOINT_BACKEND", "sqlite")
+# история режется по бюджету токенов окна OLLAMA_MODEL, отброшенное — в закреплённое [SUMMARY]
+compactor = HistoryCompactor.for_model(OLLAMA_MODEL, max_messages=15)
+check = CappingSqliteSaver(compactor=compactor) if CHECKPOINT_BACKEND == "sqlite" else CappingMemorySaver(compactor=compactor)
+# один или несколько серверов Ollama (OLLAMA_BASE_URLS); у каждого свой агент, история — общая (check)
+def _make_llm(url: str):
+    from langchain_ollama import ChatOllama  # ~1 с импорта — в прогреве или при первом запросе к LLM
+    return ChatOllama(model=OLLAMA_MODEL, base_url=url, temperature=LLM_TEMPERATURE)
+
+def _make_agent(llm):
+    from langgraph.prebuilt import create_react_agent
+    return create_react_agent(model=llm, tools=tools, checkpointer=check)
+
+LLM_POOL = LLMPool(backend_urls(OLLAMA_BASE_URL), make_llm=_make_llm, make_agent=_make_agent)
+# замки пользователей и слоты LLM — общие для воркеров serve.py через SHARED_STATE (sqlite)
+SHARED = get_shared_state()
+# все вызовы LLM (/chat и /compare) проходят через общую очередь; LLM_MAX_IN_FLIGHT — на каждый сервер,
+# при общем SHARED_STATE лимит один на все процессы (слоты llm:slot:i), честность — в пределах воркера
+_llm_limit = LLM_MAX_IN_FLIGHT * len(LLM_POOL)
+LLM_SCHEDULER = LLMScheduler(
+    max_in_flight=_llm_limit,
+    shared=SharedSlots(SHARED, "llm:slot", _llm_limit) if SHARED_STATE != "local" else None,
+)
+# замок + отметка «промпт на месте» на пользователя, простаивающие выкидываются; история — через check
+_user_locks = UserLocks(shared=SHARED)
 #---DATA---
-with open("ABS_FULL.pkl", "rb") as f:
-    PROFILE_DATA = pickle.load(f)  # { code: {"embedding": np.ndarray, "tfidf": [(word,score)], "topics": [...] } }
+# mmap-хранилище, общее с compare_codes.py (тот же объект) и со всеми воркерами (page cache)
+PROFILE_DATA = load_profile_store()  # { code: {"embedding": np.ndarray, "tfidf": [(word,score)], "topics": [...] } }
 KNOWN_CODES = set(PROFILE_DATA.keys())
+# индексы строятся один раз на процесс (lru_cache в get_*), в фоне при старте — см. _warmup:
+# get_similarity_engine() — матрица на набор кодов кэшируется и общая для /compare и /viz
+# get_neighbour_index()   — top-K соседей каждого кода для /similar
+# get_search_index()      — BM25 по словам профилей (+ семантика через Chroma, если есть) для /search
+#------
+
+#---Metrics---
+LLM_QUEUE_WAIT = REGISTRY.histogram("llm_queue_wait_seconds", "Ожидание слота в очереди LLM", ["kind"])
+LLM_TTFT = REGISTRY.histogram("llm_ttft_seconds", "От получения слота до первого токена LLM", ["kind"])
+LLM_TOTAL = REGISTRY.histogram("llm_generation_seconds", "Генерация LLM целиком (после очереди)", ["kind", "outcome"])
+RENDER_SECONDS = REGISTRY.histogram("render_seconds", "Рендер картинки в RENDER_POOL (с ожиданием процесса)", ["chart"])
+USER_IN_FLIGHT = InFlight()  # запросы к LLM в работе по пользователям
+CHECKPOINT_STATS = {"threads": 0, "bytes": 0}  # обновляется при снятии /metrics (SQLite — в потоке)
 #------
 
 #---Visualization---
+PNG_CACHE = PngCache()
+RENDER_FLIGHT = SingleFlight()  # одинаковые одновременные рендеры -> один процесс-рендер
+RENDER_POOL = RenderPool(initializer=preload)  # matplotlib (и MDS) — в отдельных процессах, не в event loop
+
+async def _render_png(endpoint: str, codes: list[str], fn, *args) -> tuple[str, bytes]:
+    """
+    PNG из кэша, иначе рендер fn(*args) в RENDER_POOL с сохранением в кэш.
+    Ключ = эндпоинт + отсортированный набор кодов + версия датасета, он же ETag.
+    """
+    key = png_cache_key(endpoint, codes, PROFILE_DATA.version)
+    with stage(f"viz_{endpoint}"):
+        png = PNG_CACHE.get(key)
+        if png is None:
+            png = await RENDER_FLIGHT.do(key, lambda: _render_to_cache(endpoint, key, fn, *args))
+    return key, png
+
+async def _render_to_cache(chart: str, key: str, fn, *args) -> bytes:
+    try:
+        with RENDER_SECONDS.time(chart=chart):
+            png = await RENDER_POOL.submit(fn, *args)
+    except RenderBusy:
+        raise HTTPException(503, "Сервер визуализаций перегружен, попробуйте позже.",
+                            headers={"Retry-After": str(RENDER_RETRY_AFTER)})
+    except RenderTimeout:
+        raise HTTPException(504, "Визуализация не успела построиться.")
+    PNG_CACHE.put(key, png)
+    return png
+
+async def _png_response(request: Request, endpoint: str, codes: list[str], fn, *args) -> Response:
+    """То же, что _render_png, но с поддержкой If-None-Match (304 без рендера)."""
+    etag = etag_for(png_cache_key(endpoint, codes, PROFILE_DATA.version))
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    _, png = await _render_png(endpoint, codes, fn, *args)
+    return Response(content=png, media_type="image/png", headers=headers)
+
 @app.post("/viz/position.png")
-async def viz_position(data: CodesIn):
+async def viz_position(data: CodesIn, request: Request):
     codes = [c.strip() for c in data.codes]
     _validate_codes(codes, KNOWN_CODES)
-    embs = np.vstack([np.array(PROFILE_DATA[c]["embedding"]) for c in codes])
-    coords = project_2d(embs)
-    png = plot_positions_2d(coords, codes)
-    return StreamingResponse(io.BytesIO(png), media_type="image/png")
+    codes = sorted(codes)  # картинка не зависит от порядка кодов в запросе — один ключ кэша
+    sim = get_similarity_engine().compare(tuple(codes))
+    return await _png_response(request, "position", codes, render_position, sim["codes"], sim["matrix"])
 @app.post("/viz/heatmap.png")
-async def viz_heatmap(data: CodesIn):
+async def viz_heatmap(data: CodesIn, request: Request):
     codes = [c.strip() for c in data.codes]
     _validate_codes(codes, KNOWN_CODES)
-    embs = np.vstack([np.array(PROFILE_DATA[c]["embedding"]) for c in codes])
-    png = plot_similarity_heatmap(codes, embs)
-    return StreamingResponse(io.BytesIO(png), media_type="image/png")
+    codes = sorted(codes)
+    sim = get_similarity_engine().compare(tuple(codes))
+    return await _png_response(request, "heatmap", codes, render_heatmap, sim["codes"], sim["matrix"])
 @app.get("/viz/tfidf/{code}.png")
-async def viz_tfidf(code: str):
+async def viz_tfidf(code: str, request: Request):
     code = code.strip()
     if code not in PROFILE_DATA:
         raise HTTPException(404, f"Нет данных для: {code}")
-    png = plot_tfidf_bars(PROFILE_DATA[code]["tfidf"], code)
-    return StreamingResponse(io.BytesIO(png), media_type="image/png")
+    return await _png_response(request, "tfidf", [code], plot_tfidf_bars, PROFILE_DATA[code]["tfidf"], code)
 @app.get("/viz/topics/{code}.png")
-async def viz_topics(code: str):
+async def viz_topics(code: str, request: Request):
     code = code.strip()
     if code not in PROFILE_DATA:
         raise HTTPException(404, f"Нет данных для: {code}")
-    png = plot_topics_text(PROFILE_DATA[code]["topics"], code)
-    return StreamingResponse(io.BytesIO(png), media_type="image/png")
+    return await _png_response(request, "topics", [code], plot_topics_text, PROFILE_DATA[code]["topics"], code)
+@app.post("/viz/bundle")
+async def viz_bundle(data: CodesIn):
+    """
+    Все картинки для сравнения одним ответом: 2D-проекция, тепловая карта, затем TF-IDF и темы по каждому коду.
+    Рендер идёт параллельно в RENDER_POOL, но не больше RENDER_POOL.workers задач бандла сразу: submit отказывает
+    без ожидания, и бандл (2 + 2N картинок) иначе сам переполнял бы очередь пула и возвращал часть картинок.
+    PNG в base64. Картинки, которые не удалось построить, попадают в errors.
+    """
+    codes = [c.strip() for c in data.codes]
+    _validate_codes(codes, KNOWN_CODES)
+    sorted_codes = sorted(codes)
+    sim = get_similarity_engine().compare(tuple(sorted_codes))
+    jobs = [
+        ("position.png", "2D‑проекция", ("position", sorted_codes, render_position, sim["codes"], sim["matrix"])),
+        ("heatmap.png", "Косинусная близость", ("heatmap", sorted_codes, render_heatmap, sim["codes"], sim["matrix"])),
+    ]
+    for code in codes:
+        item = PROFILE_DATA[code]
+        jobs.append((f"tfidf_{code}.png", f"TF‑IDF — {code}", ("tfidf", [code], plot_tfidf_bars, item["tfidf"], code)))
+        jobs.append((f"topics_{code}.png", f"BERTopic — {code}", ("topics", [code], plot_topics_text, item["topics"], code)))
+
+    slots = asyncio.Semaphore(RENDER_POOL.workers)
+
+    async def render(args):
+        async with slots:
+            return await _render_png(*args)
+
+    rendered = await asyncio.gather(*(render(args) for _, _, args in jobs), return_exceptions=True)
+    images, errors = [], []
+    for (name, caption, _), res in zip(jobs, rendered):
+        if isinstance(res, HTTPException):
+            errors.append({"name": name, "status": res.status_code, "detail": res.detail})
+            continue
+        if isinstance(res, BaseException):
+            raise res
+        key, png = res
+        images.append({"name": name, "caption": caption, "etag": etag_for(key),
+                       "png": base64.b64encode(png).decode("ascii")})
+    if not images and errors:
+        raise HTTPException(errors[0]["status"], errors[0]["detail"],
+                            headers={"Retry-After": str(RENDER_RETRY_AFTER)} if errors[0]["status"] == 503 else None)
+    return {"codes": codes, "images": images, "errors": errors}
 #------
 
 #---Just Chat---
+def _llm_busy(e: Exception) -> HTTPException:
+    return HTTPException(503, str(e), headers={"Retry-After": str(retry_after(LLM_SCHEDULER))})
+
+def _request_timeout(request: Request) -> float | None:
+    """Сколько клиент готов ждать ответа (X-Request-Timeout, сек.) — дедлайн для очереди к LLM."""
+    try:
+        return float(request.headers["X-Request-Timeout"])
+    except (KeyError, ValueError):
+        return None
+
 @app.post("/chat")
-async def chat(data: Input):
-    await ensure_system_prompt(data.user_id, agent, _user_locks)
-    result = await agent.ainvoke(
-        {"messages": [HumanMessage(content=data.message)]},
-        config=_cfg(data.user_id)
-    )
+async def chat(data: Input, request: Request):
+    with stage("ensure_prompt"):
+        # для операций с историей подходит агент любого сервера — история общая (check)
+        await ensure_system_prompt(data.user_id, LLM_POOL.backends[0].agent, _user_locks)
+
+    config = _cfg(data.user_id)
+    # коды из сообщения — инструменту search_annotations (фильтр поиска), даже если модель их не передаст
+    config["configurable"]["request_codes"] = extract_codes(data.message, KNOWN_CODES)
+
+    async def run():
+        queued = time.perf_counter()
+        async with LLM_SCHEDULER.slot(data.user_id, CHAT, _request_timeout(request)):
+            LLM_QUEUE_WAIT.observe(time.perf_counter() - queued, kind="chat")
+            try:
+                # sticky: тот же сервер для того же пользователя — его KV-кэш помнит начало диалога
+                async with LLM_POOL.use(data.user_id) as backend:
+                    # ответ агента не потоковый — для /chat есть только полное время, без TTFT
+                    started, outcome = time.perf_counter(), "error"
+                    try:
+                        with stage("llm"):
+                            result = await backend.agent.ainvoke(
+                                {"messages": [HumanMessage(content=data.message)]},
+                                config=config
+                            )
+                        outcome = "ok"
+                        return result
+                    finally:
+                        LLM_TOTAL.observe(time.perf_counter() - started, kind="chat", outcome=outcome)
+            except NoBackend:
+                raise
+            except Exception as e:
+                # сервер LLM / агент упал (breaker это уже учёл) — 502, как у /compare, а не 500 с трейсбеком
+                raise HTTPException(502, f"LLM: {e}") from e
+    try:
+        with USER_IN_FLIGHT.track(data.user_id):
+            result = await cancel_on_disconnect(request, run())
+    except (QueueFull, QueueTimeout, NoBackend) as e:
+        raise _llm_busy(e)
+    except ClientGone:
+        return Response(status_code=499)  # клиент ушёл — ответ никто не прочтёт
     return {"response": result["messages"][-1].content}
+
+@app.get("/llm/queue")
+async def llm_queue():
+    return {**LLM_SCHEDULER.stats(), "backends": LLM_POOL.stats()}
 #------
 
 #---SystemEndPoint---
+WARMUP = {"ready": False, "steps": {}, "errors": {}}  # шаг -> секунды; ошибка шага не мешает готовности
+
+def _warm_retriever():
+    if tools or get_search_index().semantic:
+        get_retriever()  # модель эмбеддингов и Chroma — нужны инструменту /chat и семантике /search
+
+async def _warmup():
+    """Прогрев после старта: всё, что иначе строилось бы при первом запросе к соответствующему эндпоинту."""
+    steps = [
+        ("similarity", lambda: asyncio.to_thread(get_similarity_engine)),
+        ("neighbours", lambda: asyncio.to_thread(get_neighbour_index)),
+        ("search", lambda: asyncio.to_thread(get_search_index)),
+        ("prompt", lambda: asyncio.to_thread(_compare_template)),
+        ("llm", lambda: asyncio.to_thread(lambda: [b.agent for b in LLM_POOL.backends])),  # langchain_ollama, langgraph
+        ("render_pool", RENDER_POOL.warmup),  # процессы + matplotlib/sklearn в каждом
+        ("retriever", lambda: asyncio.to_thread(_warm_retriever)),
+    ]
+    for name, run in steps:
+        started = time.perf_counter()
+        try:
+            await run()
+        except Exception as e:
+            WARMUP["errors"][name] = repr(e)
+        WARMUP["steps"][name] = round(time.perf_counter() - started, 3)
+    WARMUP["ready"] = True
+
+@app.get("/ready")
+async def ready():
+    """Готовность для балансировщика: 200 после прогрева, до этого 503 (процесс жив, но первые запросы медленные)."""
+    body = {**WARMUP, "import_seconds": round(IMPORT_SECONDS, 3)}
+    return JSONResponse(body, status_code=200 if WARMUP["ready"] else 503)
+
 @app.get("/codes")
 async def get_codes():
     return {"codes": sorted(KNOWN_CODES)}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {
+        "llm": await asyncio.to_thread(LLM_CACHE.stats),
+        "png": {"hits": PNG_CACHE.hits, "misses": PNG_CACHE.misses, "entries": len(PNG_CACHE._items), "bytes": PNG_CACHE.size},
+    }
+
+def _cache_counts():
+    return {"llm": (LLM_CACHE.hits, LLM_CACHE.misses), "png": (PNG_CACHE.hits, PNG_CACHE.misses)}
+
+# состояние, которое уже ведут свои объекты (очередь, пул, кэши), читается в момент снятия /metrics
+REGISTRY.gauge("cache_hits_total", "Попадания в кэш", ["cache"], kind="counter",
+               fn=lambda: [((name,), h) for name, (h, _) in _cache_counts().items()])
+REGISTRY.gauge("cache_misses_total", "Промахи кэша", ["cache"], kind="counter",
+               fn=lambda: [((name,), m) for name, (_, m) in _cache_counts().items()])
+REGISTRY.gauge("cache_hit_ratio", "Доля попаданий в кэш с момента старта", ["cache"],
+               fn=lambda: [((name,), h / (h + m) if h + m else 0.0) for name, (h, m) in _cache_counts().items()])
+REGISTRY.gauge("llm_queue_waiting", "Запросы в очереди к LLM", fn=lambda: [((), LLM_SCHEDULER.waiting())])
+REGISTRY.gauge("llm_in_flight", "Запросы к LLM в работе", fn=lambda: [((), LLM_SCHEDULER.in_flight)])
+REGISTRY.gauge("llm_queue_rejected_total", "Отказы очереди LLM (503)", kind="counter",
+               fn=lambda: [((), LLM_SCHEDULER.rejected)])
+REGISTRY.gauge("llm_backend_outstanding", "Запросы на сервере Ollama", ["backend"],
+               fn=lambda: [((b["url"],), b["outstanding"]) for b in LLM_POOL.stats()])
+REGISTRY.gauge("llm_backend_healthy", "Сервер Ollama доступен и breaker не открыт", ["backend"],
+               fn=lambda: [((b["url"],), int(b["healthy"] and b["breaker"] != "open")) for b in LLM_POOL.stats()])
+REGISTRY.gauge("render_in_flight", "Картинки в рендере и в очереди RENDER_POOL", fn=lambda: [((), RENDER_POOL.in_flight)])
+REGISTRY.gauge("llm_users_in_flight", "Пользователи с запросами к LLM в работе", fn=lambda: [((), len(USER_IN_FLIGHT.by_user))])
+REGISTRY.gauge("llm_user_requests_in_flight", "Запросы к LLM в работе у пользователя (top-10)", ["user"],
+               fn=lambda: [((u,), n) for u, n in USER_IN_FLIGHT.top(10)])
+REGISTRY.gauge("checkpoint_threads", "Диалоги в хранилище истории", fn=lambda: [((), CHECKPOINT_STATS["threads"])])
+REGISTRY.gauge("startup_import_seconds", "Время импорта main (до открытия порта)", fn=lambda: [((), IMPORT_SECONDS)])
+REGISTRY.gauge("warmup_ready", "Фоновый прогрев завершён", fn=lambda: [((), int(WARMUP["ready"]))])
+REGISTRY.gauge("checkpoint_bytes", "Размер хранилища истории (SQLite + WAL)", fn=lambda: [((), CHECKPOINT_STATS["bytes"])])
+
+@app.get("/metrics")
+async def metrics():
+    if hasattr(check, "stats"):  # только у SQLite-хранилища; запрос к базе — не в event loop
+        CHECKPOINT_STATS.update(await asyncio.to_thread(check.stats))
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+#------
+
+#---SimilarPrograms---
+@app.get("/similar/{code}")
+async def similar(code: str, k: int = 5):
+    code = code.strip()
+    if not (1 <= k <= SIMILAR_TOP_K):
+        raise HTTPException(400, f"k должно быть от 1 до {SIMILAR_TOP_K}.")
+    if code not in KNOWN_CODES:
+        raise HTTPException(404, f"Нет данных для: {code}")
+    neighbours = [
+        {"code": c, "score": round(s, 4), "label": similarity_label(s)}
+        for c, s in get_neighbour_index().query(code, k)
+    ]
+    return {"code": code, "level": _level(code), "neighbours": neighbours}
+
+@app.get("/search")
+async def search(q: str, k: int = 3, level: int | None = None):
+    query = " ".join(q.lower().split())  # регистр и пробелы не влияют на кэш
+    if not query or len(query) > 500:
+        raise HTTPException(400, "Запрос должен быть непустым и не длиннее 500 символов.")
+    if not (1 <= k <= SEARCH_MAX_K):
+        raise HTTPException(400, f"k должно быть от 1 до {SEARCH_MAX_K}.")
+    if level is not None and level not in (1, 2, 3):
+        raise HTTPException(400, "level: 1 (УГС), 2 (направление) или 3 (профиль).")
+    started = time.perf_counter()
+    index = get_search_index()
+    # эмбеддинг запроса и Chroma блокируют — вне event loop; BM25-часть и так занимает доли миллисекунды
+    levels = await asyncio.to_thread(index.search, query, k, level) if index.semantic else index.search(query, k, level)
+    return {
+        "query": q,
+        "semantic": index.semantic,
+        "levels": list(levels),
+        "took_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
 #------
 
 #---VersusDirections---
+@functools.lru_cache(maxsize=None)
+def _compare_template():
+    from langchain_core.prompts import ChatPromptTemplate  # ~0.5 с импорта — в прогреве, а не при старте
+    return ChatPromptTemplate.from_template(prompt_codes)  # шаблон один — разбираем его один раз
+
+def _compare_prompt(codes: list[str]):
+    """Считает метрики только по этим кодам и формирует промпт строго на их основе (без распознавания кодов)."""
+    with stage("compare_codes"):
+        result = compare_codes(codes)
+    with stage("prompt"):
+        prompt_msgs = _compare_template().format_messages(**prompt_fields(result))
+    return result, prompt_msgs
+
+LLM_CACHE = LLMCache()
+LLM_FLIGHT = SingleFlight()  # одинаковые одновременные /compare -> одна генерация
+
+async def _flush_requests():
+    """Фоновая запись статистики запросов /compare (для precompute.py warmup) — пачкой раз в LLM_CACHE_FLUSH_EVERY."""
+    while True:
+        await asyncio.sleep(LLM_CACHE_FLUSH_EVERY)
+        try:
+            await asyncio.to_thread(LLM_CACHE.flush_requests)
+        except Exception:
+            pass  # база занята — пачка осталась в памяти (LLMCache._restore), запишется в следующий раз
+
+def _compare_cache_key(codes: list[str]) -> str:
+    return llm_cache_key(codes, prompt_codes, OLLAMA_MODEL, LLM_TEMPERATURE, PROFILE_DATA.version)
+
+async def _generate(key: str, codes: list[str], prompt_msgs, user_id: str):
+    """
+    Генерация ответа LLM как поток событий {"type": "queue"|"token"|"error"|"done"}.
+    Один источник на ключ кэша: одновременные одинаковые запросы (и /compare, и /compare/stream)
+    читают одну и ту же генерацию через LLM_FLIGHT. Пока генерация ждёт очереди LLM_SCHEDULER,
+    идут события {"type": "queue", "position"}.
+    """
+    queued = time.perf_counter()
+    try:
+        ticket = LLM_SCHEDULER.enqueue(user_id, COMPARE)
+    except (QueueFull, QueueTimeout) as e:
+        yield {"type": "error", "detail": str(e), "status": 503}
+        return
+    parts = []
+    started, outcome = None, "cancelled"  # cancelled — все клиенты ушли, генерацию закрыли
+    try:
+        async for position in ticket.positions():
+            yield {"type": "queue", "position": position}
+        started = time.perf_counter()
+        LLM_QUEUE_WAIT.observe(started - queued, kind="compare")
+        failed = ()
+        while True:
+            # пока не пришло ни одного токена, упавший сервер можно заменить другим
+            try:
+                async with LLM_POOL.use(user_id, exclude=failed) as backend:
+                    async for chunk in backend.llm.astream(prompt_msgs):
+                        if chunk.content:
+                            if not parts:
+                                LLM_TTFT.observe(time.perf_counter() - started, kind="compare")
+                            parts.append(chunk.content)
+                            yield {"type": "token", "text": chunk.content}
+                break
+            except NoBackend:
+                raise
+            except Exception:
+                if parts or len(failed) + 1 >= len(LLM_POOL):
+                    raise
+                failed += (backend,)
+        outcome = "ok"
+    except (QueueTimeout, NoBackend) as e:
+        outcome = "busy"
+        yield {"type": "error", "detail": str(e), "status": 503}
+        return
+    except Exception as e:
+        outcome = "error"
+        yield {"type": "error", "detail": str(e)}
+        return
+    finally:
+        ticket.release()
+        if started is not None:
+            LLM_TOTAL.observe(time.perf_counter() - started, kind="compare", outcome=outcome)
+    await LLM_CACHE.aput(key, codes, "".join(parts))  # в кэш — только полностью сгенерированный ответ
+    yield {"type": "done"}
+
+def _compare_flight(key: str, result: dict, prompt_msgs, user_id: str):
+    # никто не ждёт (все клиенты отключились) — генерация отменяется и освобождает очередь
+    return LLM_FLIGHT.stream(key, lambda: _generate(key, result["codes"], prompt_msgs, user_id), cancel_orphaned=True)
+
+def _fairness_key(payload: CodesIn, request: Request) -> str:
+    return payload.user_id or (request.client.host if request.client else "anonymous")
+
 @app.post("/compare")
-async def compare(payload: CodesIn):
+async def compare(payload: CodesIn, request: Request):
+    codes = [c.strip() for c in payload.codes]
+    _validate_codes(codes, KNOWN_CODES)
+
+    result, prompt_msgs = _compare_prompt(codes)
+    key = _compare_cache_key(result["codes"])
+    LLM_CACHE.record_request(result["codes"])  # в памяти; в SQLite — фоновой пачкой (_flush_requests)
+    with stage("llm_cache"):
+        text = None if payload.no_cache else await LLM_CACHE.aget(key)
+    cached = text is not None
+    if not cached:
+        async def collect():
+            parts = []
+            async for event in _compare_flight(key, result, prompt_msgs, _fairness_key(payload, request)):
+                if event["type"] == "token":
+                    parts.append(event["text"])
+                elif event["type"] == "error" and event.get("status") == 503:
+                    raise _llm_busy(Exception(event["detail"]))
+                elif event["type"] == "error":
+                    raise HTTPException(502, f"LLM: {event['detail']}")
+            return "".join(parts)
+        try:
+            with USER_IN_FLIGHT.track(_fairness_key(payload, request)), stage("llm"):
+                text = await cancel_on_disconnect(request, collect())
+        except ClientGone:
+            return Response(status_code=499)
+    return {"text": text, "codes": result["codes"], "level": _level(result["codes"][0]), "cached": cached}
+
+def _ndjson(obj: dict) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+@app.post("/compare/stream")
+async def compare_stream(payload: CodesIn, request: Request):
+    """
+    То же, что /compare, но ответ LLM отдаётся по мере генерации (application/x-ndjson):
+    {"type": "meta", "codes", "level"} -> {"type": "queue", "position"}... -> {"type": "token", "text"}...
+    -> {"type": "done"} (или {"type": "error", "detail"}, если генерация оборвалась или очередь переполнена).
+    """
     codes = [c.strip() for c in payload.codes]
     _validate_codes(codes, KNOWN_CODES)
+    result, prompt_msgs = _compare_prompt(codes)
+    key = _compare_cache_key(result["codes"])
+    LLM_CACHE.record_request(result["codes"])  # в памяти; в SQLite — фоновой пачкой (_flush_requests)
+    with stage("llm_cache"):
+        cached_text = None if payload.no_cache else await LLM_CACHE.aget(key)
+
+    async def gen():
+        meta = {"type": "meta", "codes": result["codes"], "level": _level(result["codes"][0]), "cached": cached_text is not None}
+        yield _ndjson(meta)
+        if cached_text is not None:
+            yield _ndjson({"type": "token", "text": cached_text})
+            yield _ndjson({"type": "done"})
+            return
+        # aclosing: при отключении клиента подписка закрывается сразу, а не при сборке мусора
+        user_id = _fairness_key(payload, request)
+        with USER_IN_FLIGHT.track(user_id):
+            async with aclosing(_compare_flight(key, result, prompt_msgs, user_id)) as events:
+                async for event in events:
+                    yield _ndjson(event)
 
-    # считаем метрики только по этим кодам
-    result = compare_codes(codes)
-
-    # формируем текст LLM строго на основе этих метрик (без распознавания кодов)
-    template = ChatPromptTemplate.from_template(prompt_codes)
-    prompt_msgs = template.format_messages(
-        codes=", ".join(result["codes"]),
-        similarities="\n".join([f"{k}: {v}" for k, v in result["similarities"].items()]),
-        tfidf="\n".join([
-            f"{k}: {', '.join([f'{w} ({round(float(s), 2)})' for w, s in v])}"
-            for k, v in result["tfidf"].items()
-        ]),
-        topics="\n".join([
-            f"{k}: " + "; ".join([", ".join(t['keywords']) for t in v])
-            for k, v in result["topics"].items()
-        ]),
-        summaries="\n".join([f"{k}: {v}" for k, v in result.get("summaries", {}).items()])
-    )
-    text = (await llm.ainvoke(prompt_msgs)).content
-    return {"text": text, "codes": result["codes"], "level": _level(result["codes"][0])}
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
 #------
 
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+
 if __name__ == "__main__":
     uvicorn.run("main:app", port = 8000, host = "localhost", reload=True) # reload = True, чтобы сервер перезагружался при определенных изменениях
-    # uvicorn main:app --reload
\ No newline at end of file
+    # uvicorn main:app --reload
+    # прод с несколькими воркерами: python serve.py --workers 4
\ No newline at end of file
@@ -1,20 +1,250 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
 from langgraph.checkpoint.memory import MemorySaver
 
+from history import HistoryCompactor
+
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", "checkpoints.sqlite3")
+CHECKPOINT_TTL = float(os.getenv("CHECKPOINT_TTL", str(30 * 24 * 3600)))  # сек. без активности -> тред удаляется
+CHECKPOINT_EVICT_EVERY = float(os.getenv("CHECKPOINT_EVICT_EVERY", "600"))  # как часто чистить (сек.)
+
+
+def _compact_messages(checkpoint, compactor: HistoryCompactor):
+    ch = dict(checkpoint.get("channel_values", {}))  # не трогаем channel_values вызывающего
+    if "messages" in ch:
+        ch["messages"] = compactor.compact(ch["messages"])
+    checkpoint["channel_values"] = ch
+    return checkpoint
+
+
 class CappingMemorySaver(MemorySaver):
-    def __init__(self, max_messages: int = 15):
+    def __init__(self, max_messages: int = 15, compactor: HistoryCompactor | None = None):
         super().__init__()
         self.max_messages = max_messages
+        # по умолчанию — только лимит по числу сообщений, как раньше
+        self.compactor = compactor or HistoryCompactor(max_messages=max_messages, summarize=False)
 
     def put(self, config, checkpoint, metadata=None, new_versions=None):
-        ch = checkpoint.get("channel_values", {})
-        msgs = ch.get("messages", [])
-        
-        pinned = [m for m in msgs if getattr(m, "type", None) == "system"]
-        tail   = [m for m in msgs if getattr(m, "type", None) != "system"]
-
-        if len(tail) > self.max_messages:
-            tail = tail[-self.max_messages:]
-
-        ch["messages"] = pinned + tail
-        checkpoint["channel_values"] = ch
-        return super().put(config, checkpoint, metadata, new_versions)
\ No newline at end of file
+        checkpoint = _compact_messages(checkpoint, self.compactor)
+        return super().put(config, checkpoint, metadata, new_versions)
+
+
+class CappingSqliteSaver(BaseCheckpointSaver):
+    """
+    Чекпоинтер на SQLite (WAL): на каждый тред хранится только последний (сжатый compactor'ом) чекпоинт,
+    треды без активности дольше ttl удаляются. Файл можно делить между несколькими процессами
+    uvicorn — каждый открывает своё соединение.
+    История версий (time travel по checkpoint_id) не хранится: запрос старого checkpoint_id вернёт None.
+    """
+
+    def __init__(self, path: str = CHECKPOINT_DB_PATH, max_messages: int = 15, ttl: float = CHECKPOINT_TTL, *,
+                 compactor: HistoryCompactor | None = None, serde=None):
+        super().__init__(serde=serde)
+        self.path = path
+        self.max_messages = max_messages
+        self.compactor = compactor or HistoryCompactor(max_messages=max_messages, summarize=False)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._pid = None
+        self._last_evict = 0.0
+
+    def _db(self) -> sqlite3.Connection:
+        # соединение открывается лениво и заново после fork (соединения SQLite нельзя делить между процессами)
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS checkpoints (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL,
+                    checkpoint_id TEXT NOT NULL,
+                    parent_id TEXT,
+                    type TEXT NOT NULL,
+                    checkpoint BLOB NOT NULL,
+                    metadata_type TEXT NOT NULL,
+                    metadata BLOB NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (thread_id, checkpoint_ns)
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS checkpoints_updated_at ON checkpoints(updated_at)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS writes (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL,
+                    checkpoint_id TEXT NOT NULL,
+                    task_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    channel TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    task_path TEXT NOT NULL DEFAULT '',
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+                )"""
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    #---sync API---
+    def get_tuple(self, config):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                "SELECT checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata FROM checkpoints "
+                "WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns),
+            ).fetchone()
+            if row is None:
+                return None
+            checkpoint_id, parent_id, type_, blob, meta_type, meta_blob = row
+            wanted = get_checkpoint_id(config)
+            if wanted and wanted != checkpoint_id:
+                return None
+            writes = db.execute(
+                "SELECT task_id, channel, type, value FROM writes "
+                "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+                (thread_id, checkpoint_ns, checkpoint_id),
+            ).fetchall()
+        return self._tuple(thread_id, checkpoint_ns, checkpoint_id, parent_id, (type_, blob), (meta_type, meta_blob), writes)
+
+    def _tuple(self, thread_id, checkpoint_ns, checkpoint_id, parent_id, checkpoint, metadata, writes):
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed(checkpoint),
+            metadata=self.serde.loads_typed(metadata),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((t, v))) for task_id, channel, t, v in writes],
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}}
+                if parent_id else None
+            ),
+        )
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        query = "SELECT thread_id, checkpoint_ns FROM checkpoints"
+        params: tuple = ()
+        if config is not None:
+            query += " WHERE thread_id = ?"
+            params = (config["configurable"]["thread_id"],)
+        with self._lock:
+            keys = self._db().execute(query, params).fetchall()
+        count = 0
+        for thread_id, checkpoint_ns in keys:
+            if limit is not None and count >= limit:
+                return
+            tup = self.get_tuple({"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns}})
+            if tup is None:
+                continue
+            if before is not None and tup.config["configurable"]["checkpoint_id"] >= get_checkpoint_id(before):
+                continue
+            if filter and any(tup.metadata.get(k) != v for k, v in filter.items()):
+                continue
+            count += 1
+            yield tup
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint = _compact_messages(checkpoint.copy(), self.compactor)
+        type_, blob = self.serde.dumps_typed(checkpoint)
+        meta_type, meta_blob = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                db.execute(
+                    "INSERT OR REPLACE INTO checkpoints "
+                    "(thread_id, checkpoint_ns, checkpoint_id, parent_id, type, checkpoint, metadata_type, metadata, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+                     type_, blob, meta_type, meta_blob, now),
+                )
+                # pending writes нужны только последнему чекпоинту
+                db.execute(
+                    "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id != ?",
+                    (thread_id, checkpoint_ns, checkpoint["id"]),
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        if now - self._last_evict > CHECKPOINT_EVICT_EVERY:
+            self.evict_idle()
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # специальные каналы (ошибки, прерывания; idx < 0) перезаписываются, обычные — только первая запись
+        replace, ignore = [], []
+        for idx, (channel, value) in enumerate(writes):
+            type_, blob = self.serde.dumps_typed(value)
+            idx = WRITES_IDX_MAP.get(channel, idx)
+            (replace if idx < 0 else ignore).append(
+                (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type_, blob, task_path)
+            )
+        columns = "(thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value, task_path) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        with self._lock:
+            db = self._db()
+            db.executemany(f"INSERT OR REPLACE INTO writes {columns}", replace)
+            db.executemany(f"INSERT OR IGNORE INTO writes {columns}", ignore)
+
+    def delete_thread(self, thread_id):
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+            db.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+
+    def evict_idle(self, ttl: float | None = None) -> int:
+        """Удаляет треды без активности дольше ttl. Возвращает число удалённых чекпоинтов."""
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        self._last_evict = now
+        with self._lock:
+            db = self._db()
+            cur = db.execute("DELETE FROM checkpoints WHERE updated_at < ?", (now - ttl,))
+            db.execute(
+                "DELETE FROM writes WHERE NOT EXISTS (SELECT 1 FROM checkpoints c WHERE c.thread_id = writes.thread_id "
+                "AND c.checkpoint_ns = writes.checkpoint_ns AND c.checkpoint_id = writes.checkpoint_id)"
+            )
+            return cur.rowcount
+
+    def stats(self) -> dict:
+        with self._lock:
+            (threads,) = self._db().execute("SELECT COUNT(DISTINCT thread_id) FROM checkpoints").fetchone()
+        size = sum(os.path.getsize(p) for p in (self.path, f"{self.path}-wal") if os.path.exists(p))
+        return {"threads": threads, "bytes": size}
+
+    #---async API: SQLite блокирующий, выносим в поток, чтобы не держать event loop на busy_timeout---
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
@@ -0,0 +1,268 @@
+# metrics.py
+"""
+Метрики в текстовом формате Prometheus (/metrics в main.py, отдельный порт у bot.py) — без внешних зависимостей,
+поэтому модуль подключается и к API, и к боту.
+
+- Counter / Gauge / Histogram с метками; Gauge может брать значения из функции при каждом снятии
+  (очередь LLM, кэши — их счётчики уже есть в своих классах, дублировать не нужно)
+- stage("compare_codes") — таймер этапа запроса: пишет в гистограмму stage_seconds{stage}
+  и в Server-Timing текущего запроса (MetricsMiddleware), чтобы медленный ответ было видно сразу в клиенте
+- MetricsMiddleware — ASGI-обёртка: длительность и число запросов по маршруту (шаблону пути, а не самому пути)
+  и статусу, запросы в работе, заголовок Server-Timing
+"""
+import bisect
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+# секунды: от быстрых эндпоинтов (мс) до генерации LLM (минуты)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name}: метки {sorted(labels)} вместо {list(self.label_names)}")
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        head = f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n"
+        return head + "".join(f"{line}\n" for line in self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_labels(self.label_names, key)} {_num(value)}"
+
+
+class Gauge(_Metric):
+    """Значение, выставляемое set()/inc()/dec(), или fn() -> [(значения меток, значение)] при каждом снятии."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (),
+                 fn: Callable[[], Iterable[tuple[tuple, float]]] | None = None, kind: str = "gauge"):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+        self.fn = fn
+        self.kind = kind  # "counter" — для счётчиков, которые ведёт чужой объект (хиты кэша)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.fn is not None:
+            items = [(tuple(str(v) for v in key), value) for key, value in self.fn()]
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_labels(self.label_names, key)} {_num(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, list] = {}  # метки -> [счётчики по корзинам..., сумма, количество]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for key, row in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                le = f'le="{_num(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_labels(self.label_names, key, le)} {row[-1]}"
+            yield f"{self.name}_sum{_labels(self.label_names, key)} {_num(row[-2])}"
+            yield f"{self.name}_count{_labels(self.label_names, key)} {row[-1]}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"метрика {metric.name} уже есть")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Iterable[str] = (), fn=None, kind: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, help, labels, fn, kind))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        return "".join(m.render() for m in self._metrics.values())
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("stage_seconds", "Длительность этапов обработки запроса", ["stage"])
+
+# этапы текущего запроса: [(имя, секунды)] — для Server-Timing; вне запроса None
+_timings: contextvars.ContextVar[list | None] = contextvars.ContextVar("timings", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """Таймер этапа: гистограмма stage_seconds{stage=name} + запись в Server-Timing текущего запроса."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def server_timing(timings: list[tuple[str, float]]) -> str:
+    return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in timings)
+
+
+class InFlight:
+    """Сколько запросов сейчас в работе у каждого пользователя (для метрик — только сводка и top-N)."""
+
+    def __init__(self):
+        self.by_user: dict[str, int] = {}
+
+    @contextmanager
+    def track(self, user_id: str):
+        self.by_user[user_id] = self.by_user.get(user_id, 0) + 1
+        try:
+            yield
+        finally:
+            left = self.by_user[user_id] - 1
+            if left:
+                self.by_user[user_id] = left
+            else:
+                del self.by_user[user_id]
+
+    def top(self, n: int = 10) -> list[tuple[str, int]]:
+        return sorted(self.by_user.items(), key=lambda kv: -kv[1])[:n]
+
+
+class MetricsMiddleware:
+    """ASGI: http_requests_total / http_request_duration_seconds по маршруту и статусу, Server-Timing."""
+
+    def __init__(self, app, registry: Registry = REGISTRY):
+        self.app = app
+        self.requests = registry.counter("http_requests_total", "HTTP-запросы", ["method", "route", "status"])
+        self.duration = registry.histogram("http_request_duration_seconds", "Время ответа HTTP (до конца тела)",
+                                           ["method", "route"])
+        self.in_flight = registry.gauge("http_requests_in_flight", "HTTP-запросы в работе")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings: list[tuple[str, float]] = []
+        token = _timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timings.append(("app", time.perf_counter() - started))  # до заголовков; поток — дольше
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(timings).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        self.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.in_flight.dec()
+            _timings.reset(token)
+            route = scope.get("route")
+            # шаблон пути (/similar/{code}), а не сам путь — иначе метка растёт с каждым кодом
+            name = getattr(route, "path", None) or "unmatched"
+            self.requests.inc(method=scope["method"], route=name, status=status)
+            self.duration.observe(time.perf_counter() - started, method=scope["method"], route=name)
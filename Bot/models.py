@@ -5,4 +5,6 @@ class Input(BaseModel):
     user_id: str
 
 class CodesIn(BaseModel):
-    codes: list[str]
\ No newline at end of file
+    codes: list[str]
+    no_cache: bool = False  # True — не брать ответ LLM из кэша (свежий ответ всё равно сохраняется)
+    user_id: str | None = None  # для честной очереди к LLM; без него — по адресу клиента
\ No newline at end of file
@@ -0,0 +1,124 @@
+# neighbours.py
+"""
+Индекс ближайших соседей по embedding из ProfileStore («какие программы ближе всего к 09.03.01?»).
+Соседи ищутся только среди кодов того же уровня (_level).
+
+- exact: для каждого уровня заранее считается таблица top-K соседей (блочное произведение
+  нормированных матриц), запрос — просто чтение строки таблицы.
+- ivf:   приближённый индекс (сферический k-means + обход nprobe ближайших кластеров) для уровней,
+  где кодов десятки тысяч и полная таблица N×N слишком дорога при старте.
+- auto:  exact для небольших уровней, ivf — начиная с SIMILAR_IVF_THRESHOLD кодов.
+"""
+import functools
+import os
+
+import numpy as np
+
+from profile_store import ProfileStore, load_profile_store
+from codes import _level
+
+SIMILAR_INDEX = os.getenv("SIMILAR_INDEX", "auto")  # exact | ivf | auto
+SIMILAR_TOP_K = int(os.getenv("SIMILAR_TOP_K", "20"))  # сколько соседей держать в таблице exact
+SIMILAR_IVF_THRESHOLD = int(os.getenv("SIMILAR_IVF_THRESHOLD", "20000"))
+SIMILAR_IVF_NPROBE = int(os.getenv("SIMILAR_IVF_NPROBE", "8"))
+_BLOCK_ROWS = 1024
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Индексы k наибольших значений по последней оси, отсортированные по убыванию."""
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.zeros(scores.shape[:-1] + (0,), dtype=np.int64)
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.take_along_axis(scores, part, axis=-1).argsort(axis=-1)[..., ::-1]
+    return np.take_along_axis(part, order, axis=-1)
+
+
+class ExactIndex:
+    def __init__(self, unit: np.ndarray, top_k: int):
+        n = unit.shape[0]
+        self.top_k = min(top_k, max(n - 1, 0))
+        self.neighbours = np.zeros((n, self.top_k), dtype=np.int32)
+        self.scores = np.zeros((n, self.top_k), dtype=np.float32)
+        for start in range(0, n, _BLOCK_ROWS):
+            block = unit[start:start + _BLOCK_ROWS] @ unit.T
+            rows = np.arange(block.shape[0])
+            block[rows, rows + start] = -np.inf  # сам себе не сосед
+            idx = _top_k(block, self.top_k)
+            self.neighbours[start:start + len(rows)] = idx
+            self.scores[start:start + len(rows)] = np.take_along_axis(block, idx, axis=1)
+
+    def query(self, row: int, k: int) -> tuple[np.ndarray, np.ndarray]:
+        return self.neighbours[row, :k], self.scores[row, :k]
+
+
+class IVFIndex:
+    def __init__(self, unit: np.ndarray, nprobe: int = SIMILAR_IVF_NPROBE, iters: int = 10, seed: int = 42):
+        n = unit.shape[0]
+        self.unit = unit
+        self.nprobe = nprobe
+        nlist = max(1, min(n, int(4 * np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        centroids = np.array(unit[rng.choice(n, nlist, replace=False)], dtype=np.float32)
+        assign = np.zeros(n, dtype=np.int64)
+        for _ in range(iters):
+            assign = self._assign(centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, unit)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            empty = norms[:, 0] == 0
+            centroids = np.where(empty[:, None], centroids, sums / np.where(norms == 0, 1, norms))
+        self.centroids = centroids
+        assign = self._assign(centroids)
+        order = np.argsort(assign, kind="stable")
+        self.lists = np.split(order, np.searchsorted(assign[order], np.arange(1, nlist)))
+
+    def _assign(self, centroids: np.ndarray) -> np.ndarray:
+        assign = np.empty(self.unit.shape[0], dtype=np.int64)
+        for start in range(0, self.unit.shape[0], _BLOCK_ROWS):
+            assign[start:start + _BLOCK_ROWS] = (self.unit[start:start + _BLOCK_ROWS] @ centroids.T).argmax(axis=1)
+        return assign
+
+    def query(self, row: int, k: int) -> tuple[np.ndarray, np.ndarray]:
+        q = self.unit[row]
+        probes = _top_k(self.centroids @ q, self.nprobe)
+        candidates = np.concatenate([self.lists[p] for p in probes])
+        candidates = candidates[candidates != row]
+        scores = self.unit[candidates] @ q
+        best = _top_k(scores, k)
+        return candidates[best], scores[best]
+
+
+class NeighbourIndex:
+    def __init__(self, store: ProfileStore, kind: str = SIMILAR_INDEX, top_k: int = SIMILAR_TOP_K):
+        self.store = store
+        self.top_k = top_k
+        by_level: dict[int, list[str]] = {}
+        for code in store.codes:
+            if store.embedding(code) is not None:
+                by_level.setdefault(_level(code), []).append(code)
+
+        self.levels: dict[int, dict] = {}
+        self.position: dict[str, tuple[int, int]] = {}  # code -> (level, строка внутри уровня)
+        for lvl, codes in by_level.items():
+            unit = np.ascontiguousarray(store.unit[[store.row(c) for c in codes]])
+            use_ivf = kind == "ivf" or (kind == "auto" and len(codes) >= SIMILAR_IVF_THRESHOLD)
+            index = IVFIndex(unit) if use_ivf else ExactIndex(unit, top_k)
+            self.levels[lvl] = {"codes": codes, "index": index}
+            for i, c in enumerate(codes):
+                self.position[c] = (lvl, i)
+        self.query = functools.lru_cache(maxsize=4096)(self._query)
+
+    def _query(self, code: str, k: int = 5) -> tuple[tuple[str, float], ...]:
+        """Top-k ближайших кодов того же уровня: ((code, cosine), ...) по убыванию близости."""
+        if code not in self.position:
+            return ()
+        lvl, row = self.position[code]
+        level = self.levels[lvl]
+        idx, scores = level["index"].query(row, min(k, self.top_k))
+        return tuple((level["codes"][int(i)], float(s)) for i, s in zip(idx, scores))
+
+
+@functools.lru_cache(maxsize=None)
+def get_neighbour_index() -> NeighbourIndex:
+    return NeighbourIndex(load_profile_store())
@@ -0,0 +1,87 @@
+# png_cache.py
+"""
+Кэш отрендеренных PNG для /viz/*.
+Картинка зависит только от (эндпоинт, набор кодов, версия датасета), поэтому ключ —
+sha256 от этих трёх значений, он же ETag. Уровни:
+- память: LRU с ограничением по суммарному размеру в байтах
+- диск (необязательно, PNG_CACHE_DIR): переживает рестарт и общий для воркеров
+"""
+import hashlib
+import os
+import uuid
+from collections import OrderedDict
+
+PNG_CACHE_MAX_BYTES = int(os.getenv("PNG_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+PNG_CACHE_DIR = os.getenv("PNG_CACHE_DIR", "")  # пусто — только память
+
+
+def png_cache_key(endpoint: str, codes: list[str], version: str) -> str:
+    raw = "\x1f".join([endpoint, ",".join(sorted(codes)), version])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def etag_for(key: str) -> str:
+    return f'"{key[:32]}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+class PngCache:
+    def __init__(self, max_bytes: int = PNG_CACHE_MAX_BYTES, disk_dir: str = PNG_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.png")
+
+    def get(self, key: str) -> bytes | None:
+        png = self._items.get(key)
+        if png is not None:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return png
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "rb") as f:
+                    png = f.read()
+            except OSError:
+                png = None
+            if png is not None:
+                self._remember(key, png)
+                self.hits += 1
+                return png
+        self.misses += 1
+        return None
+
+    def put(self, key: str, png: bytes):
+        self._remember(key, png)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(png)
+            os.replace(tmp, path)  # атомарно: другие воркеры не увидят недописанный файл
+
+    def _remember(self, key: str, png: bytes):
+        if len(png) > self.max_bytes:
+            return
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._items[key] = png
+        self.size += len(png)
+        while self.size > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted)
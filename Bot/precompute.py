@@ -0,0 +1,155 @@
+# precompute.py
+"""
+Офлайн-предрасчёт для /compare (датасет статичен между пересборками ABS_FULL.pkl):
+- готовые строки промпта по каждому коду (tfidf / topics / summary) — запрос только склеивает их
+- полная матрица косинусной близости по каждому уровню (_level) — метки пар берутся из неё
+
+Результат лежит в <store>/precomputed/ и привязан к версии датасета: после пересборки
+хранилища он просто не подхватится, и всё считается на лету, как раньше.
+
+Запуск (из Bot/):
+    python precompute.py build              # фрагменты + матрицы
+    python precompute.py warmup --top-k 20  # заранее сгенерировать ответы LLM для самых частых наборов кодов
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+from profile_store import ProfileStore, load_profile_store
+from codes import _level
+
+PRECOMPUTE_MAX_LEVEL_SIZE = int(os.getenv("PRECOMPUTE_MAX_LEVEL_SIZE", "20000"))  # N×N float32 на уровень
+
+
+def format_tfidf(code: str, tfidf) -> str:
+    return f"{code}: {', '.join([f'{w} ({round(float(s), 2)})' for w, s in tfidf])}"
+
+
+def format_topics(code: str, topics) -> str:
+    return f"{code}: " + "; ".join([", ".join(t['keywords']) for t in topics])
+
+
+def format_summary(code: str, summary: str) -> str:
+    return f"{code}: {summary}"
+
+
+def code_fragments(code: str, item: dict) -> dict:
+    return {
+        "tfidf": format_tfidf(code, item["tfidf"]),
+        "topics": format_topics(code, item["topics"]),
+        "summary": format_summary(code, item.get("summary", "").strip() or "Описание отсутствует."),
+    }
+
+
+def precomputed_dir(store: ProfileStore) -> str:
+    return os.path.join(store.path, "precomputed")
+
+
+def build_precomputed(store: ProfileStore) -> str:
+    out_dir = precomputed_dir(store)
+    tmp_dir = f"{out_dir}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_dir)
+    try:
+        fragments = {code: code_fragments(code, store[code]) for code in store.codes}
+        with open(os.path.join(tmp_dir, "fragments.json"), "w", encoding="utf-8") as f:
+            json.dump(fragments, f, ensure_ascii=False)
+
+        by_level: dict[int, list[str]] = {}
+        for code in store.codes:
+            if store.embedding(code) is not None:
+                by_level.setdefault(_level(code), []).append(code)
+        levels = {}
+        for lvl, codes in sorted(by_level.items()):
+            if len(codes) > PRECOMPUTE_MAX_LEVEL_SIZE:
+                continue  # слишком большой уровень — считаем на лету
+            unit = np.asarray(store.unit[[store.row(c) for c in codes]])
+            sim = np.clip(unit @ unit.T, -1.0, 1.0).astype(np.float32)
+            np.save(os.path.join(tmp_dir, f"similarity_L{lvl}.npy"), sim)
+            levels[str(lvl)] = codes
+
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": store.version, "levels": levels}, f, ensure_ascii=False)
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        os.rename(tmp_dir, out_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_dir
+
+
+class Precomputed:
+    def __init__(self, path: str, manifest: dict):
+        self.path = path
+        with open(os.path.join(path, "fragments.json"), encoding="utf-8") as f:
+            self.fragments: dict[str, dict] = json.load(f)
+        self.levels: dict[int, dict] = {}
+        for lvl, codes in manifest["levels"].items():
+            self.levels[int(lvl)] = {
+                "index": {c: i for i, c in enumerate(codes)},
+                "matrix": np.load(os.path.join(path, f"similarity_L{lvl}.npy"), mmap_mode="r"),
+            }
+
+    def submatrix(self, codes: list[str]) -> np.ndarray | None:
+        """Кусок предрасчитанной матрицы для кодов одного уровня или None, если его нет."""
+        if not codes:
+            return None
+        level = self.levels.get(_level(codes[0]))
+        if level is None or any(c not in level["index"] for c in codes):
+            return None
+        idx = [level["index"][c] for c in codes]
+        return np.array(level["matrix"][np.ix_(idx, idx)])
+
+
+@functools.lru_cache(maxsize=None)
+def get_precomputed() -> Precomputed | None:
+    store = load_profile_store()
+    path = precomputed_dir(store)
+    try:
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != store.version:
+        return None  # собрано для другой версии датасета
+    return Precomputed(path, manifest)
+
+
+async def warmup(top_k: int):
+    """Генерирует и кладёт в LLM-кэш ответы для top_k самых запрашиваемых наборов кодов."""
+    from main import LLM_POOL, LLM_CACHE, KNOWN_CODES, _compare_prompt, _compare_cache_key
+
+    done = 0
+    for codes in LLM_CACHE.top_requested(top_k):
+        if any(c not in KNOWN_CODES for c in codes):
+            continue
+        key = _compare_cache_key(codes)
+        if LLM_CACHE.get(key) is not None:
+            continue
+        result, prompt_msgs = _compare_prompt(codes)
+        async with LLM_POOL.use() as backend:
+            text = (await backend.llm.ainvoke(prompt_msgs)).content
+        LLM_CACHE.put(key, result["codes"], text)
+        done += 1
+        print(f"{', '.join(codes)}: готово")
+    print(f"Сгенерировано ответов: {done}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Офлайн-предрасчёт для /compare")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("build", help="фрагменты промпта и матрицы близости по уровням")
+    p_warm = sub.add_parser("warmup", help="ответы LLM для самых частых наборов кодов")
+    p_warm.add_argument("--top-k", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.cmd == "build":
+        store = load_profile_store()
+        print(f"Готово: {build_precomputed(store)}")
+    else:
+        asyncio.run(warmup(args.top_k))
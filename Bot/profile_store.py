@@ -0,0 +1,224 @@
+# profile_store.py
+"""
+Компилированное хранилище профилей вместо pickle.load(ABS_FULL.pkl) в каждом модуле.
+
+Формат каталога (по умолчанию ABS_FULL.store/):
+- manifest.json     — версия формата, версия датасета (хэш pickle), размерность, отпечаток исходника
+- codes.json        — коды в порядке строк матрицы (code -> row строится при открытии)
+- embeddings.npy    — все embedding одной непрерывной float32-матрицей (N, D), открывается через mmap
+- unit.npy          — те же embedding, нормированные по L2 (для косинусной близости одним матричным произведением)
+- meta.bin          — tfidf/topics/summary: склеенные JSON-записи в UTF-8
+- meta_offsets.npy  — int64 (N + 1) смещения записей в meta.bin
+
+Все файлы открываются только на чтение через mmap, поэтому страницы общие
+для всех воркеров uvicorn (через page cache ОС), а старт не зависит от числа кодов.
+"""
+import functools
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import shutil
+import sys
+import uuid
+from collections.abc import Mapping
+
+import numpy as np
+
+FORMAT_VERSION = 2
+PROFILE_PKL_PATH = os.getenv("PROFILE_PKL_PATH", "ABS_FULL.pkl")
+PROFILE_STORE_PATH = os.getenv("PROFILE_STORE_PATH", "ABS_FULL.store")
+META_CACHE_SIZE = int(os.getenv("PROFILE_META_CACHE", "1024"))
+
+
+def _fingerprint(path: str) -> dict:
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _to_jsonable(obj):
+    # numpy-скаляры (np.float64 в tfidf) и массивы -> обычные python-типы
+    if isinstance(obj, dict):
+        return {k: _to_jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_jsonable(v) for v in obj]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return obj
+
+
+def build_store(pkl_path: str = PROFILE_PKL_PATH, out_dir: str = PROFILE_STORE_PATH) -> str:
+    """
+    Конвертирует ABS_FULL.pkl в компилированный каталог.
+    Пишет во временный каталог и атомарно переименовывает — несколько воркеров
+    могут запускать сборку одновременно, победит первый.
+    """
+    with open(pkl_path, "rb") as f:
+        data = pickle.load(f)  # { code: {"embedding": np.ndarray, "tfidf": [(word,score)], "topics": [...], "summary": str} }
+
+    codes = sorted(data.keys())
+    dims = {np.asarray(v["embedding"]).shape[-1] for v in data.values() if v.get("embedding") is not None}
+    if len(dims) > 1:
+        raise ValueError(f"Разная размерность embedding в {pkl_path}: {sorted(dims)}")
+    dim = dims.pop() if dims else 0
+
+    embeddings = np.zeros((len(codes), dim), dtype=np.float32)
+    has_embedding = np.zeros(len(codes), dtype=bool)
+    records, offsets = [], [0]
+    for row, code in enumerate(codes):
+        item = data[code]
+        if item.get("embedding") is not None:
+            embeddings[row] = np.asarray(item["embedding"], dtype=np.float32)
+            has_embedding[row] = True
+        meta = {k: v for k, v in item.items() if k != "embedding"}
+        blob = json.dumps(_to_jsonable(meta), ensure_ascii=False).encode("utf-8")
+        records.append(blob)
+        offsets.append(offsets[-1] + len(blob))
+
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    unit = np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms > 0)
+
+    tmp_dir = f"{out_dir}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_dir)
+    try:
+        np.save(os.path.join(tmp_dir, "embeddings.npy"), embeddings)
+        np.save(os.path.join(tmp_dir, "unit.npy"), unit.astype(np.float32))
+        np.save(os.path.join(tmp_dir, "has_embedding.npy"), has_embedding)
+        np.save(os.path.join(tmp_dir, "meta_offsets.npy"), np.asarray(offsets, dtype=np.int64))
+        with open(os.path.join(tmp_dir, "meta.bin"), "wb") as f:
+            for blob in records:
+                f.write(blob)
+        with open(os.path.join(tmp_dir, "codes.json"), "w", encoding="utf-8") as f:
+            json.dump(codes, f, ensure_ascii=False)
+        manifest = {
+            "format": FORMAT_VERSION,
+            "version": _file_sha256(pkl_path)[:16],
+            "count": len(codes),
+            "dim": dim,
+            "source": os.path.basename(pkl_path),
+            "source_fingerprint": _fingerprint(pkl_path),
+        }
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        _swap_dir(tmp_dir, out_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_dir
+
+
+def _swap_dir(tmp_dir: str, out_dir: str):
+    if os.path.isdir(out_dir):
+        # старую версию отодвигаем в сторону: открытые mmap у живых процессов остаются валидными
+        old_dir = f"{out_dir}.old-{uuid.uuid4().hex}"
+        try:
+            os.rename(out_dir, old_dir)
+        except OSError:
+            return  # другой процесс уже подменил каталог
+        shutil.rmtree(old_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, out_dir)
+    except OSError:
+        pass  # параллельная сборка успела раньше — её результат равнозначен
+
+
+def _read_manifest(store_dir: str) -> dict | None:
+    try:
+        with open(os.path.join(store_dir, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_stale(store_dir: str, pkl_path: str) -> bool:
+    manifest = _read_manifest(store_dir)
+    if manifest is None or manifest.get("format") != FORMAT_VERSION:
+        return True
+    if not os.path.exists(pkl_path):
+        return False  # исходника нет — работаем с тем, что собрано
+    return manifest.get("source_fingerprint") != _fingerprint(pkl_path)
+
+
+class ProfileStore(Mapping):
+    """
+    Read-only отображение code -> {"embedding", "tfidf", "topics", "summary"} поверх mmap.
+    Совместимо с прежним dict из pickle: PROFILE_DATA[code]["tfidf"] и т.п. работают как раньше.
+    """
+
+    def __init__(self, store_dir: str):
+        self.path = store_dir
+        manifest = _read_manifest(store_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"Нет manifest.json в {store_dir}")
+        self.manifest = manifest
+        self.version: str = manifest["version"]
+        self.dim: int = manifest["dim"]
+
+        with open(os.path.join(store_dir, "codes.json"), encoding="utf-8") as f:
+            self.codes: list[str] = json.load(f)
+        self.index: dict[str, int] = {c: i for i, c in enumerate(self.codes)}
+
+        self.embeddings: np.ndarray = np.load(os.path.join(store_dir, "embeddings.npy"), mmap_mode="r")
+        self.unit: np.ndarray = np.load(os.path.join(store_dir, "unit.npy"), mmap_mode="r")
+        self.has_embedding: np.ndarray = np.load(os.path.join(store_dir, "has_embedding.npy"), mmap_mode="r")
+        self._offsets = np.load(os.path.join(store_dir, "meta_offsets.npy"), mmap_mode="r")
+        with open(os.path.join(store_dir, "meta.bin"), "rb") as f:
+            self._meta = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        self.meta = functools.lru_cache(maxsize=META_CACHE_SIZE)(self._load_meta)
+
+    def _load_meta(self, code: str) -> dict:
+        row = self.index[code]
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        return json.loads(self._meta[start:end].decode("utf-8"))
+
+    def row(self, code: str) -> int:
+        return self.index[code]
+
+    def embedding(self, code: str) -> np.ndarray | None:
+        row = self.index[code]
+        return self.embeddings[row] if self.has_embedding[row] else None
+
+    def __getitem__(self, code: str) -> dict:
+        if code not in self.index:
+            raise KeyError(code)
+        # копия, чтобы вызывающий код не портил закэшированную запись
+        return {**self.meta(code), "embedding": self.embedding(code)}
+
+    def __contains__(self, code) -> bool:
+        return code in self.index
+
+    def __iter__(self):
+        return iter(self.codes)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+
+@functools.lru_cache(maxsize=None)
+def load_profile_store(store_dir: str = PROFILE_STORE_PATH, pkl_path: str = PROFILE_PKL_PATH) -> ProfileStore:
+    """
+    Единый на процесс экземпляр хранилища (main.py и compare_codes.py получают один и тот же объект).
+    Если каталога нет или pickle обновился — пересобирает его из pickle.
+    """
+    if _is_stale(store_dir, pkl_path):
+        build_store(pkl_path, store_dir)
+    return ProfileStore(store_dir)
+
+
+if __name__ == "__main__":
+    # python profile_store.py [ABS_FULL.pkl] [ABS_FULL.store]
+    src = sys.argv[1] if len(sys.argv) > 1 else PROFILE_PKL_PATH
+    dst = sys.argv[2] if len(sys.argv) > 2 else PROFILE_STORE_PATH
+    build_store(src, dst)
+    store = ProfileStore(dst)
+    print(f"{dst}: {len(store)} кодов, dim={store.dim}, version={store.version}")
@@ -21,7 +21,10 @@ prompt_codes = """Ты — эксперт по образовательным п
    Рекомендация: если тебе ближе [тема] — выбирай [код1]. Если интереснее [тема] — выбирай [код2].
 """
 
-system_prompt = """"[PROMPT_V1]\n"
+# Версия системного промпта: при изменении текста поднимите номер — старые треды /chat получат новый промпт
+PROMPT_TAG = "[PROMPT_V1]"
+
+system_prompt = f""""{PROMPT_TAG}\n"
     Ты — ассистент для абитуриентов и студентов. Отвечай строго по-русски, кратко и структурно,\n
     Не используй никаких средств выделения текста, включая звездочки и другие символы форматирования.\n
     Функции: сравнение профилей/направлений/УГС (только одного уровня за раз), 
@@ -0,0 +1,106 @@
+# rag.py
+"""
+Поиск по аннотациям дисциплин (Chroma из testRAG_Preprocdata/data_to_db.py) для /chat и /search.
+- модель эмбеддингов и коллекция загружаются один раз (get_retriever, прогрев — в lifespan main.py)
+- эмбеддинги запросов кэшируются (LRU на RAG_QUERY_CACHE запросов): повторный вопрос не гоняет модель
+- если в запросе есть коды (09.03.01 / 09.03 / 09), поиск сразу ограничивается ими по метаданным
+  (profile_code / direction_code / group_code — по уровню кода)
+- в контекст попадает не больше RAG_K кусков и не больше RAG_CONTEXT_TOKENS токенов
+
+Зависимости (langchain-chroma, langchain-huggingface) необязательные: без них или без базы
+инструмент просто не подключается, а /search (search.py) ищет без семантики. Инструменты требуют модели с поддержкой tool calling
+(llama3.1, qwen2.5, mistral …) — поэтому по умолчанию RAG выключен (RAG_ENABLED=1 — включить).
+"""
+import functools
+import importlib.util
+import os
+
+from history import estimate_tokens
+from codes import CODE_RE, _level
+
+RAG_ENABLED = os.getenv("RAG_ENABLED", "0") == "1"
+RAG_PERSIST_DIR = os.getenv("RAG_PERSIST_DIR", os.path.join(os.path.dirname(__file__), "..", "testRAG_Preprocdata", "chroma_db"))
+RAG_COLLECTION = os.getenv("RAG_COLLECTION", "rag_data")
+RAG_EMBEDDING_MODEL = os.getenv("RAG_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+RAG_K = int(os.getenv("RAG_K", "4"))
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "800"))
+RAG_QUERY_CACHE = int(os.getenv("RAG_QUERY_CACHE", "1024"))
+
+_LEVEL_KEY = {1: "group_code", 2: "direction_code", 3: "profile_code"}
+
+
+def store_available() -> bool:
+    """Есть база и зависимости для неё — без загрузки модели."""
+    return (
+        os.path.isdir(RAG_PERSIST_DIR)
+        and all(importlib.util.find_spec(m) is not None for m in ("langchain_chroma", "langchain_huggingface"))
+    )
+
+
+def rag_available() -> bool:
+    """RAG включён и есть всё нужное (для решения, подключать ли инструмент к /chat)."""
+    return RAG_ENABLED and store_available()
+
+
+def codes_filter(codes: list[str]) -> dict | None:
+    """Фильтр Chroma по метаданным: коды группируются по уровню, уровни объединяются через $or."""
+    by_key: dict[str, list[str]] = {}
+    for code in dict.fromkeys(codes):
+        key = _LEVEL_KEY.get(_level(code))
+        if key:
+            by_key.setdefault(key, []).append(code)
+    clauses = [{key: {"$in": values}} for key, values in by_key.items()]
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+class Retriever:
+    def __init__(self, persist_dir: str = RAG_PERSIST_DIR, collection: str = RAG_COLLECTION,
+                 model: str = RAG_EMBEDDING_MODEL, cache_size: int = RAG_QUERY_CACHE):
+        from langchain_chroma import Chroma
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        self.embeddings = HuggingFaceEmbeddings(model_name=model)
+        self.vectorstore = Chroma(collection_name=collection, embedding_function=self.embeddings,
+                                  persist_directory=persist_dir)
+        self._embed = functools.lru_cache(maxsize=cache_size)(self._embed_query)
+
+    def _embed_query(self, query: str) -> tuple[float, ...]:
+        return tuple(self.embeddings.embed_query(query))
+
+    def embed_query(self, query: str) -> list[float]:
+        return list(self._embed(" ".join(query.lower().split())))  # регистр и пробелы не влияют на кэш
+
+    def search(self, query: str, codes: list[str] | None = None, k: int = RAG_K):
+        return self.vectorstore.similarity_search_by_vector(
+            self.embed_query(query), k=k, filter=codes_filter(codes) if codes else None
+        )
+
+    def context(self, query: str, codes: list[str] | None = None, k: int = RAG_K,
+                max_tokens: int = RAG_CONTEXT_TOKENS) -> str:
+        """Куски аннотаций одной строкой: по убыванию близости, без повторов, в пределах max_tokens."""
+        parts, used, seen = [], 0, set()
+        for doc in self.search(query, codes, k):
+            if doc.page_content in seen:
+                continue
+            seen.add(doc.page_content)
+            part = f"[{doc.metadata.get('profile_code', '?')}] {doc.page_content}"
+            cost = estimate_tokens(part)
+            if parts and used + cost > max_tokens:
+                break
+            if not parts and cost > max_tokens:
+                part = part[:max_tokens * 3]  # первый кусок обрезаем, а не выбрасываем
+                cost = estimate_tokens(part)
+            parts.append(part)
+            used += cost
+        return "\n\n".join(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def get_retriever() -> Retriever | None:
+    return Retriever() if store_available() else None
+
+
+def extract_codes(text: str, known) -> list[str]:
+    return [c for c in dict.fromkeys(CODE_RE.findall(text)) if c in known]
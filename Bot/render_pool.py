@@ -0,0 +1,98 @@
+# render_pool.py
+"""
+Пул процессов для matplotlib-рендера.
+pyplot держит глобальное состояние и не потокобезопасен, а рендер занимает сотни мс CPU —
+в event loop он блокировал бы /chat и /compare для всех остальных. Поэтому:
+- рендер идёт в отдельных процессах (spawn), функции — из utils_viz (pickle-совместимые)
+- число задач в работе + в очереди ограничено capacity; сверх него — RenderBusy (-> 503 + Retry-After)
+- у каждой задачи таймаут (-> 504); слот освобождается только когда процесс реально закончил,
+  чтобы back-pressure не врал о загрузке
+- если процесс упал посреди задачи (BrokenProcessPool), пул пересоздаётся и задача повторяется один раз;
+  упал и повтор — RenderBusy
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+RENDER_QUEUE_DEPTH = int(os.getenv("RENDER_QUEUE_DEPTH", "16"))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "30"))
+RENDER_RETRY_AFTER = int(os.getenv("RENDER_RETRY_AFTER", "2"))
+
+
+class RenderBusy(Exception):
+    """Очередь рендера переполнена."""
+
+
+class RenderTimeout(Exception):
+    """Рендер не уложился в таймаут."""
+
+
+class RenderPool:
+    def __init__(self, workers: int = RENDER_WORKERS, queue_depth: int = RENDER_QUEUE_DEPTH,
+                 timeout: float = RENDER_TIMEOUT, initializer=None):
+        self.workers = workers
+        self.initializer = initializer  # выполняется в каждом процессе при старте (тяжёлые импорты)
+        self.capacity = workers + queue_depth
+        self.timeout = timeout
+        self.in_flight = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=self.initializer,
+            )
+        return self._executor
+
+    async def warmup(self) -> int:
+        """Поднимает все процессы заранее (с initializer в каждом) — первый рендер не ждёт старта и импортов."""
+        loop = asyncio.get_running_loop()
+        executor = self.start()
+        pids = await asyncio.gather(*(loop.run_in_executor(executor, os.getpid) for _ in range(self.workers)))
+        return len(set(pids))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _release(self, _fut=None):
+        self.in_flight -= 1
+
+    def _restart(self, executor):
+        # процесс-воркер упал (OOM и т.п.) — пул сломан целиком; пересоздаём, если соседняя задача ещё не успела
+        if self._executor is executor:
+            self.shutdown()
+
+    def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        executor = self.start()
+        try:
+            fut = loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            self._restart(executor)
+            executor = self.start()
+            fut = loop.run_in_executor(executor, fn, *args)
+        self.in_flight += 1
+        fut.add_done_callback(self._release)
+        return executor, fut
+
+    async def submit(self, fn, *args):
+        if self.in_flight >= self.capacity:
+            raise RenderBusy()
+        for _ in range(2):
+            executor, fut = self._run(fn, *args)
+            try:
+                # shield: при таймауте задача дорабатывает в процессе и освобождает слот сама
+                return await asyncio.wait_for(asyncio.shield(fut), self.timeout)
+            except asyncio.TimeoutError:
+                raise RenderTimeout()
+            except BrokenProcessPool:
+                # процесс упал посреди задачи — повторяем её один раз на новом пуле
+                self._restart(executor)
+        raise RenderBusy()  # упал и повтор: для клиента — 503 с Retry-After, а не 500
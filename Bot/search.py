@@ -0,0 +1,189 @@
+# search.py
+"""
+Поиск программ по свободному тексту («хочу backend и базы данных») для /search.
+- лексика: BM25 по инвертированному индексу. Документ кода — его tfidf-слова, ключевые слова тем и summary
+  (с весами полей), плюс тексты аннотаций из SEARCH_ANNOTATIONS_CSV, если он задан
+- семантика: ближайшие куски аннотаций из Chroma (rag.Retriever); ранг кода — место его первого куска.
+  Без Chroma (или SEARCH_SEMANTIC=0) ищем только по BM25
+- ранжирования сливаются через RRF (reciprocal rank fusion), результат — лучшие коды на каждом уровне _level
+
+Слова приводятся к основе простой обрезкой окончаний («базы данных» ~ «базами данными»).
+Индекс строится один раз при старте (get_search_index), запрос — несколько сложений numpy-массивов;
+ответы кэшируются (LRU на SEARCH_CACHE запросов).
+"""
+import csv
+import functools
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from profile_store import ProfileStore, load_profile_store
+from rag import get_retriever, store_available
+from codes import _level
+
+SEARCH_SEMANTIC = os.getenv("SEARCH_SEMANTIC", "1") == "1"
+SEARCH_ANNOTATIONS_CSV = os.getenv("SEARCH_ANNOTATIONS_CSV", "")  # clear_data.csv (code,text); пусто — без аннотаций
+SEARCH_SEMANTIC_K = int(os.getenv("SEARCH_SEMANTIC_K", "50"))  # сколько кусков брать из Chroma
+SEARCH_MAX_K = int(os.getenv("SEARCH_MAX_K", "10"))
+SEARCH_CACHE = int(os.getenv("SEARCH_CACHE", "4096"))
+RRF_K = 60  # стандартная константа RRF: сглаживает разницу между первыми местами
+BM25_K1 = 1.5
+BM25_B = 0.75
+# вес слова из поля: tfidf-слова описывают код лучше всего, summary — общий текст
+FIELD_WEIGHTS = {"tfidf": 3.0, "topics": 2.0, "summary": 1.0, "annotation": 1.0}
+
+WORD_RE = re.compile(r"[а-яёa-z0-9]+")
+_ENDINGS = tuple(sorted(
+    "ами ями ого его ому ему ыми ими ых их ах ях ов ев ой ей ий ый ая яя ое ее ые ие ую юю ом ем ам ям "
+    "ия ию ью ы и а я о е у ю ь".split(), key=len, reverse=True,
+))
+_MIN_STEM = 3
+# служебные слова и «хочу/интересует» из запросов — не должны находить программы сами по себе
+STOP_WORDS = frozenset(
+    "как что это для или при так там тут где когда кто чем чтобы если уже еще очень все мне меня мой моя "
+    "хочу хочется хотел хотела интересует интересно нравится люблю можно нужно надо буду стать быть есть "
+    "про над под без его она они оно был была были дела".split()
+)
+
+
+def stem(word: str) -> str:
+    for end in _ENDINGS:
+        if word.endswith(end) and len(word) - len(end) >= _MIN_STEM:
+            return word[:-len(end)]
+    return word
+
+
+def words(text: str) -> list[str]:
+    return [w for w in WORD_RE.findall(text.lower().replace("ё", "е")) if len(w) > 2 and w not in STOP_WORDS]
+
+
+def tokenize(text: str) -> list[str]:
+    return [stem(w) for w in words(text)]
+
+
+def _profile_fields(profile: dict):
+    """(поле, текст) документа кода из записи хранилища."""
+    for word, _ in profile.get("tfidf", []):
+        yield "tfidf", word
+    for topic in profile.get("topics", []):
+        yield "topics", " ".join(topic.get("keywords", []))
+    yield "summary", profile.get("summary", "")
+
+
+def _iter_annotations(path: str):
+    """(code, text) из CSV аннотаций потоком; коды всех уровней, к которым относится профиль."""
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            code, text = row.get("code") or "", row.get("text") or ""
+            parts = code.split(".")
+            for n in range(1, len(parts) + 1):
+                yield ".".join(parts[:n]), text
+
+
+class Bm25Level:
+    """BM25 по кодам одного уровня: для каждого слова заранее посчитан вклад в каждый документ."""
+
+    def __init__(self, codes: list[str], docs: list[Counter]):
+        self.codes = codes
+        self.position = {c: i for i, c in enumerate(codes)}
+        lengths = np.array([sum(d.values()) for d in docs], dtype=np.float32)
+        avgdl = float(lengths.mean()) if len(docs) else 1.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(avgdl, 1e-9))
+        postings: dict[str, tuple[list[int], list[float]]] = {}
+        for i, doc in enumerate(docs):
+            for term, tf in doc.items():
+                ids, tfs = postings.setdefault(term, ([], []))
+                ids.append(i)
+                tfs.append(tf)
+        n = len(docs)
+        self.postings: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        for term, (ids, tfs) in postings.items():
+            ids = np.asarray(ids, dtype=np.int32)
+            tfs = np.asarray(tfs, dtype=np.float32)
+            idf = np.log1p((n - len(ids) + 0.5) / (len(ids) + 0.5))
+            self.postings[term] = (ids, (idf * tfs * (BM25_K1 + 1) / (tfs + norm[ids])).astype(np.float32))
+
+    def rank(self, terms: list[str]) -> list[int]:
+        """Номера документов с ненулевым счётом, по убыванию BM25."""
+        scores = np.zeros(len(self.codes), dtype=np.float32)
+        for term in dict.fromkeys(terms):
+            hit = self.postings.get(term)
+            if hit is not None:
+                scores[hit[0]] += hit[1]
+        found = np.flatnonzero(scores)
+        return found[np.argsort(-scores[found], kind="stable")].tolist()
+
+    def matches(self, i: int, terms: list[str]) -> list[str]:
+        return [t for t in terms if t in self.postings and i in self.postings[t][0]]
+
+
+class SearchIndex:
+    def __init__(self, store: ProfileStore, annotations_csv: str = SEARCH_ANNOTATIONS_CSV,
+                 semantic: bool = SEARCH_SEMANTIC, cache_size: int = SEARCH_CACHE):
+        docs: dict[str, Counter] = {}
+        for code in store:
+            doc = docs[code] = Counter()
+            for field, text in _profile_fields(store[code]):
+                for term in tokenize(text):
+                    doc[term] += FIELD_WEIGHTS[field]
+        if annotations_csv and os.path.exists(annotations_csv):
+            for code, text in _iter_annotations(annotations_csv):
+                if code in docs:
+                    docs[code].update({t: c * FIELD_WEIGHTS["annotation"] for t, c in Counter(tokenize(text)).items()})
+        by_level: dict[int, list[str]] = {}
+        for code in docs:
+            by_level.setdefault(_level(code), []).append(code)
+        self.levels = {lvl: Bm25Level(codes, [docs[c] for c in codes]) for lvl, codes in sorted(by_level.items())}
+        self.semantic = semantic and store_available()
+        self.search = functools.lru_cache(maxsize=cache_size)(self._search)
+
+    def _semantic_ranks(self, query: str) -> dict[int, dict[str, int]]:
+        """Уровень -> {код: ранг (с 1)} по ближайшим кускам аннотаций."""
+        ranks: dict[int, dict[str, int]] = {lvl: {} for lvl in self.levels}
+        retriever = get_retriever() if self.semantic else None
+        if retriever is None:
+            return ranks
+        for doc in retriever.search(query, k=SEARCH_SEMANTIC_K):
+            for key in ("group_code", "direction_code", "profile_code"):
+                code = doc.metadata.get(key)
+                if code:
+                    level_ranks = ranks.setdefault(_level(code), {})
+                    level_ranks.setdefault(code, len(level_ranks) + 1)
+        return ranks
+
+    def _search(self, query: str, k: int = 3, level: int | None = None) -> tuple[dict, ...]:
+        """Лучшие k кодов на каждом уровне (или на одном level): RRF по рангам BM25 и семантики."""
+        by_term = {stem(w): w for w in words(query)}  # основа -> слово запроса (для "matched")
+        terms = list(by_term)
+        semantic = self._semantic_ranks(query)
+        out = []
+        for lvl, index in self.levels.items():
+            if level is not None and lvl != level:
+                continue
+            lexical = {index.codes[i]: r for r, i in enumerate(index.rank(terms), 1)}
+            dense = {c: r for c, r in semantic.get(lvl, {}).items() if c in index.position}
+            fused = {c: 1 / (RRF_K + r) for c, r in lexical.items()}
+            for c, r in dense.items():
+                fused[c] = fused.get(c, 0.0) + 1 / (RRF_K + r)
+            best = sorted(fused, key=lambda c: -fused[c])[:k]
+            out.append({
+                "level": lvl,
+                "results": [
+                    {
+                        "code": c,
+                        "score": round(fused[c], 5),
+                        "bm25_rank": lexical.get(c),
+                        "semantic_rank": dense.get(c),
+                        "matched": [by_term[t] for t in index.matches(index.position[c], terms)],
+                    }
+                    for c in best
+                ],
+            })
+        return tuple(out)
+
+
+@functools.lru_cache(maxsize=None)
+def get_search_index() -> SearchIndex:
+    return SearchIndex(load_profile_store())
@@ -0,0 +1,178 @@
+# serve.py
+"""
+Прод-запуск API с несколькими воркерами (prefork) вместо `uvicorn.run(..., reload=True)` из main.py.
+
+- мастер открывает сокет, импортирует main и строит индексы (similarity / neighbours / search) до fork:
+  хранилище профилей — mmap, индексы — numpy, поэтому после gc.freeze() страницы остаются общими
+  для всех воркеров (copy-on-write), а не копируются N раз
+- каждый воркер — свой event loop uvicorn на общем сокете; клиенты LLM, процессы рендера и прогрев
+  (main.lifespan) поднимаются уже в воркере — потоки и соединения через fork не переживают
+- общее между воркерами: история (CHECKPOINT_BACKEND=sqlite), замки пользователей (SHARED_STATE=sqlite —
+  выставляется по умолчанию при --workers > 1), LLM-кэш и PNG-кэш на диске
+- упавший воркер перезапускается; SIGTERM / SIGINT — плавная остановка всех воркеров
+- генераций LLM не больше LLM_MAX_IN_FLIGHT на сервер Ollama на все воркеры: слоты в SHARED_STATE (llm_scheduler)
+- процессы рендера (RENDER_WORKERS) делятся между воркерами до fork (split_limits) по max(1, лимит // N),
+  очередь рендера (RENDER_QUEUE_DEPTH) остаётся на каждый воркер — в неё должен помещаться бандл /viz/bundle;
+  при RENDER_WORKERS меньше N или очереди меньше бандла — предупреждение при старте
+
+/metrics отдаёт счётчики того воркера, который принял запрос.
+
+Запуск (из Bot/):
+    python serve.py --workers 4 --port 8000
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+SERVE_HOST = os.getenv("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.getenv("SERVE_PORT", "8000"))
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", str(os.cpu_count() or 1)))
+SERVE_BACKLOG = int(os.getenv("SERVE_BACKLOG", "2048"))
+RESTART_BACKOFF_MAX = 30.0  # сек.: воркер, падающий сразу после старта, перезапускается всё реже
+BUNDLE_MAX_IMAGES = 2 + 2 * 5  # /viz/bundle из 5 кодов: проекция, тепловая карта и по 2 картинки на код
+
+
+def split_limits(workers: int) -> list[str]:
+    """
+    Делит процессы рендера между воркерами через env (до импорта main — модули читают env при импорте).
+    Возвращает предупреждения: процессов меньше, чем воркеров (у каждого всё равно 1), или в воркер не помещается
+    бандл из 5 кодов (RenderPool отказывает сразу — часть картинок вернётся ошибкой при соседних запросах).
+    """
+    total = int(os.getenv("RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+    per_worker = max(1, total // workers)
+    os.environ["RENDER_WORKERS"] = str(per_worker)
+    depth = int(os.getenv("RENDER_QUEUE_DEPTH", "16"))  # не делится: очередь своя у каждого воркера
+    warnings = []
+    if total < workers:
+        warnings.append(f"RENDER_WORKERS={total} меньше --workers {workers}: у каждого воркера будет 1, всего {workers}")
+    if per_worker + depth < BUNDLE_MAX_IMAGES:
+        warnings.append(f"рендер воркера вмещает {per_worker + depth} задач (RENDER_WORKERS {per_worker} + "
+                        f"RENDER_QUEUE_DEPTH {depth}) — меньше бандла из 5 кодов ({BUNDLE_MAX_IMAGES} картинок)")
+    return warnings
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(SERVE_BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+def preload():
+    """Всё, что можно разделить между воркерами: данные и индексы. Возвращает модуль main."""
+    started = time.perf_counter()
+    import main
+    main.get_similarity_engine()
+    main.get_neighbour_index()
+    main.get_search_index()
+    gc.collect()
+    gc.freeze()  # объекты мастера — вне сборщика мусора: его проходы не трогают общие страницы в воркерах
+    print(f"[serve] предзагрузка: {time.perf_counter() - started:.2f} с, кодов: {len(main.KNOWN_CODES)}", flush=True)
+    return main
+
+
+def _run_worker(app, sock: socket.socket, log_level: str):
+    import asyncio
+    import uvicorn
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, signal.SIG_DFL)  # обработчики мастера не нужны — uvicorn ставит свои
+    server = uvicorn.Server(uvicorn.Config(app, log_level=log_level))
+    asyncio.run(server.serve(sockets=[sock]))
+
+
+class Supervisor:
+    def __init__(self, app, sock: socket.socket, workers: int, log_level: str = "info"):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.log_level = log_level
+        self.children: dict[int, int] = {}  # pid -> номер воркера
+        self.started_at: dict[int, float] = {}  # номер воркера -> время последнего запуска
+        self.backoff: dict[int, float] = {}
+        self.stopping = False
+
+    def spawn(self, n: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(self.app, self.sock, self.log_level)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)  # не выполнять finally/atexit мастера в ребёнке
+        self.children[pid] = n
+        self.started_at[n] = time.monotonic()
+        print(f"[serve] воркер {n}: pid {pid}", flush=True)
+
+    def stop(self, signum, _frame=None):
+        if not self.stopping:
+            print(f"[serve] сигнал {signal.Signals(signum).name}: останавливаю воркеры", flush=True)
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for n in range(self.workers):
+            self.spawn(n)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            n = self.children.pop(pid, None)
+            if n is None or self.stopping:
+                continue
+            # упал сразу после старта — ждём дольше (не крутить fork в цикле при ошибке в коде/конфиге)
+            quick = time.monotonic() - self.started_at[n] < 10
+            delay = min(self.backoff.get(n, 0.5) * 2, RESTART_BACKOFF_MAX) if quick else 1.0
+            self.backoff[n] = delay
+            print(f"[serve] воркер {n} (pid {pid}) завершился с кодом {os.waitstatus_to_exitcode(status)}, "
+                  f"перезапуск через {delay:.1f} с", flush=True)
+            time.sleep(delay)
+            if not self.stopping:
+                self.spawn(n)
+        self.sock.close()
+        return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API с несколькими воркерами и общей предзагрузкой данных")
+    parser.add_argument("--host", default=SERVE_HOST)
+    parser.add_argument("--port", type=int, default=SERVE_PORT)
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()  # .env — до split_limits и импорта main: лимиты делятся от значений из него
+    if args.workers > 1:
+        # без общего состояния воркеры не видят замки и историю друг друга
+        os.environ.setdefault("SHARED_STATE", "sqlite")
+        if os.getenv("CHECKPOINT_BACKEND", "sqlite") != "sqlite":
+            sys.exit("serve.py: при --workers > 1 нужен CHECKPOINT_BACKEND=sqlite — иначе у каждого воркера своя история")
+        if os.environ["SHARED_STATE"] == "local":
+            sys.exit("serve.py: при --workers > 1 нужен общий SHARED_STATE (sqlite) — иначе замки у каждого воркера свои")
+        for warning in split_limits(args.workers):
+            print(f"[serve] внимание: {warning}", flush=True)
+
+    sock = _bind(args.host, args.port)  # до импорта main: порт занят — узнаём сразу, а не после загрузки
+    app = preload().app
+    print(f"[serve] http://{args.host}:{args.port}, воркеров: {args.workers}", flush=True)
+    sys.exit(Supervisor(app, sock, args.workers, args.log_level).run())
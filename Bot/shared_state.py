@@ -0,0 +1,229 @@
+# shared_state.py
+"""
+Состояние, которое должно быть общим для всех воркеров API (serve.py) и реплик бота:
+замки на пользователя и флаги «ответ ещё готовится». В одном процессе хватает словаря,
+но при N процессах каждый видел бы только свои замки — пользователь обходил бы защиту,
+отправив второй запрос в соседний воркер.
+
+Бэкенды (SHARED_STATE):
+- local  — словарь в памяти процесса: один воркер / одна реплика, как было раньше
+- sqlite — файл SHARED_STATE_PATH (WAL), общий для процессов на одной машине; каждый открывает своё соединение
+
+Каждая запись — ключ, владелец и срок жизни (ttl): если процесс-владелец упал, не освободив замок,
+запись просто истекает. Освободить или продлить запись может только её владелец.
+Поверх записей: shared_lock (замок с ожиданием), busy_flag (флаг без ожидания), SharedSlots (семафор на N
+процессов — общий лимит генераций LLM для всех воркеров, см. llm_scheduler).
+Другой бэкенд (Redis и т.п.) — класс с теми же методами try_acquire / release / count в get_shared_state().
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+SHARED_STATE = os.getenv("SHARED_STATE", "local")
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "shared_state.sqlite3")
+SHARED_LOCK_TTL = float(os.getenv("SHARED_LOCK_TTL", "60"))  # сек.: замок упавшего процесса освобождается сам
+SHARED_LOCK_POLL = 0.05  # сек.: первый интервал опроса занятого замка (дальше растёт до 0.5)
+
+
+class LockTimeout(Exception):
+    """Не дождались общего замка."""
+
+
+def new_owner() -> str:
+    """Уникальный владелец записи: процесс + случайный хвост (pid после fork переиспользуется)."""
+    return f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+
+
+class LocalState:
+    """Словарь в памяти процесса — поведение по умолчанию при одном воркере."""
+
+    def __init__(self):
+        self._items: dict[str, tuple[str, float]] = {}  # ключ -> (владелец, момент истечения)
+
+    def try_acquire(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.monotonic()
+        held = self._items.get(key)
+        if held is not None and held[0] != owner and held[1] > now:
+            return False
+        self._items[key] = (owner, now + ttl)
+        return True
+
+    def release(self, key: str, owner: str) -> bool:
+        held = self._items.get(key)
+        if held is None or held[0] != owner:
+            return False
+        del self._items[key]
+        return True
+
+    def count(self, prefix: str) -> int:
+        now = time.monotonic()
+        for key in [k for k, (_, expires) in self._items.items() if expires <= now]:
+            del self._items[key]
+        return sum(1 for k in self._items if k.startswith(prefix))
+
+    async def atry_acquire(self, key: str, owner: str, ttl: float) -> bool:
+        return self.try_acquire(key, owner, ttl)
+
+    async def arelease(self, key: str, owner: str) -> bool:
+        return self.release(key, owner)
+
+
+class SqliteState:
+    """Таблица (ключ, владелец, истечение) в SQLite: общая для всех процессов, открывающих тот же файл."""
+
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._pid = None
+
+    def _db(self) -> sqlite3.Connection:
+        # соединение открывается лениво и заново после fork (соединения SQLite нельзя делить между процессами)
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS shared_state (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )"""
+            )
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def try_acquire(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.time()  # не monotonic: сравнивается между процессами
+        with self._lock:
+            # одна инструкция: вставить, либо перехватить истёкшую / свою запись; чужая живая — не трогаем
+            cur = self._db().execute(
+                "INSERT INTO shared_state (key, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE shared_state.expires_at <= ? OR shared_state.owner = excluded.owner",
+                (key, owner, now + ttl, now),
+            )
+            return cur.rowcount == 1
+
+    def release(self, key: str, owner: str) -> bool:
+        with self._lock:
+            cur = self._db().execute("DELETE FROM shared_state WHERE key = ? AND owner = ?", (key, owner))
+            return cur.rowcount == 1
+
+    def count(self, prefix: str) -> int:
+        with self._lock:
+            (n,) = self._db().execute(
+                "SELECT COUNT(*) FROM shared_state WHERE substr(key, 1, ?) = ? AND expires_at > ?",
+                (len(prefix), prefix, time.time()),
+            ).fetchone()
+        return n
+
+    #---async API: SQLite блокирующий (busy_timeout при записи из соседнего процесса), выносим в поток---
+    async def atry_acquire(self, key: str, owner: str, ttl: float) -> bool:
+        return await asyncio.to_thread(self.try_acquire, key, owner, ttl)
+
+    async def arelease(self, key: str, owner: str) -> bool:
+        return await asyncio.to_thread(self.release, key, owner)
+
+
+@asynccontextmanager
+async def shared_lock(state, key: str, ttl: float = SHARED_LOCK_TTL, timeout: float | None = None):
+    """
+    Замок по ключу поверх try_acquire: опрос с нарастающим интервалом, пока не освободится или не истечёт ttl.
+    Держать его дольше ttl нельзя — запись истечёт и замок достанется другому процессу.
+    """
+    owner = new_owner()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = SHARED_LOCK_POLL
+    while not await state.atry_acquire(key, owner, ttl):
+        if deadline is not None and time.monotonic() + delay > deadline:
+            raise LockTimeout(key)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    try:
+        yield
+    finally:
+        await state.arelease(key, owner)
+
+
+@asynccontextmanager
+async def busy_flag(state, key: str, ttl: float):
+    """
+    Флаг «занято» без ожидания: отдаёт False, если ключ держит кто-то другой.
+    Пока блок выполняется, запись продлевается каждые ttl/3 — ответ может идти дольше ttl,
+    а флаг упавшей реплики всё равно истечёт не позже чем через ttl.
+    """
+    owner = new_owner()
+    if not await state.atry_acquire(key, owner, ttl):
+        yield False
+        return
+    task = asyncio.create_task(_renew(state, key, owner, ttl))
+    try:
+        yield True
+    finally:
+        task.cancel()
+        await state.arelease(key, owner)
+
+
+async def _renew(state, key: str, owner: str, ttl: float):
+    while True:
+        await asyncio.sleep(ttl / 3)
+        await state.atry_acquire(key, owner, ttl)
+
+
+class SharedSlots:
+    """
+    Семафор на все процессы: slots записей prefix:0 … prefix:{slots-1}. Занятый слот продлевается каждые ttl/3,
+    пока его не отпустят; слот упавшего процесса истекает сам через ttl.
+    Порядка между процессами нет (ожидающие опрашивают слоты) — очередь и честность остаются локальными.
+    """
+
+    def __init__(self, state, prefix: str, slots: int, ttl: float = SHARED_LOCK_TTL):
+        self.state = state
+        self.prefix = prefix
+        self.slots = slots
+        self.ttl = ttl
+        self._renewals: dict[str, asyncio.Task] = {}  # владелец -> продление
+        self._releasing: set[asyncio.Task] = set()
+
+    async def acquire(self, timeout: float | None = None) -> tuple[str, str]:
+        """(ключ, владелец) свободного слота; LockTimeout — не дождались за timeout сек."""
+        owner = new_owner()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = SHARED_LOCK_POLL
+        while True:
+            first = random.randrange(self.slots)  # процессы начинают с разных слотов — меньше спорят за первый
+            for i in range(self.slots):
+                key = f"{self.prefix}:{(first + i) % self.slots}"
+                if await self.state.atry_acquire(key, owner, self.ttl):
+                    self._renewals[owner] = asyncio.create_task(_renew(self.state, key, owner, self.ttl))
+                    return key, owner
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise LockTimeout(self.prefix)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def release(self, key: str, owner: str):
+        """Без ожидания (зовётся из синхронного кода): продление останавливается сразу, запись удаляется в фоне."""
+        task = self._renewals.pop(owner, None)
+        if task is not None:
+            task.cancel()
+        task = asyncio.ensure_future(self.state.arelease(key, owner))
+        self._releasing.add(task)
+        task.add_done_callback(self._releasing.discard)
+
+    def count(self) -> int:
+        return self.state.count(f"{self.prefix}:")
+
+
+def get_shared_state(backend: str = SHARED_STATE, path: str = SHARED_STATE_PATH):
+    if backend == "local":
+        return LocalState()
+    if backend == "sqlite":
+        return SqliteState(path)
+    raise ValueError(f"SHARED_STATE={backend!r}: ожидается local или sqlite")
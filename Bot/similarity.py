@@ -0,0 +1,77 @@
+# similarity.py
+"""
+Векторизованная косинусная близость по нормированным embedding из ProfileStore.
+Один запрос на N кодов = одно матричное произведение (N, D) @ (D, N),
+результат кэшируется по кортежу кодов, поэтому /compare, /viz/heatmap.png
+и /viz/position.png для одного набора кодов считают матрицу один раз.
+"""
+import functools
+import os
+
+import numpy as np
+
+from profile_store import ProfileStore, load_profile_store
+from precompute import get_precomputed
+
+SIMILARITY_CACHE_SIZE = int(os.getenv("SIMILARITY_CACHE_SIZE", "4096"))
+
+# Пороги косинусной близости -> текстовая метка (верхняя граница включительно)
+THRESHOLDS = (
+    (0.93, "Очень сильно отличаются"),
+    (0.95, "Отличаются"),
+    (0.99, "Похожи, но с разными акцентами"),
+)
+IDENTICAL_LABEL = "Идентичны"
+NO_EMBEDDING_LABEL = "Нет данных для сравнения (embedding)"
+
+
+def similarity_label(sim: float) -> str:
+    for bound, label in THRESHOLDS:
+        if sim <= bound:
+            return label
+    return IDENTICAL_LABEL
+
+
+class SimilarityEngine:
+    def __init__(self, store: ProfileStore):
+        self.store = store
+        self.compare = functools.lru_cache(maxsize=SIMILARITY_CACHE_SIZE)(self._compare)
+
+    def matrix(self, codes: list[str]) -> np.ndarray:
+        """Матрица косинусной близости (N, N) для кодов с embedding."""
+        pre = get_precomputed()
+        if pre is not None:
+            sim = pre.submatrix(codes)
+            if sim is not None:
+                return sim
+        rows = [self.store.row(c) for c in codes]
+        unit = np.asarray(self.store.unit[rows])  # fancy-индексация копирует только N строк из mmap
+        sim = unit @ unit.T
+        np.clip(sim, -1.0, 1.0, out=sim)
+        return sim
+
+    def _compare(self, codes: tuple[str, ...]) -> dict:
+        """
+        Возвращает:
+        - codes: коды, для которых есть embedding (в исходном порядке)
+        - missing: коды без embedding
+        - matrix: np.ndarray (N, N), только для чтения
+        - scores: {"a vs b": float} и labels: {"a vs b": метка} для пар i < j
+        """
+        valid = [c for c in codes if self.store.embedding(c) is not None]
+        missing = [c for c in codes if c not in valid]
+        sim = self.matrix(valid) if valid else np.zeros((0, 0), dtype=np.float32)
+        sim.setflags(write=False)  # результат общий для всех вызывающих из кэша
+
+        scores, labels = {}, {}
+        iu, ju = np.triu_indices(len(valid), k=1)
+        for i, j in zip(iu.tolist(), ju.tolist()):
+            pair = f"{valid[i]} vs {valid[j]}"
+            scores[pair] = float(sim[i, j])
+            labels[pair] = similarity_label(scores[pair])
+        return {"codes": valid, "missing": missing, "matrix": sim, "scores": scores, "labels": labels}
+
+
+@functools.lru_cache(maxsize=None)
+def get_similarity_engine() -> SimilarityEngine:
+    return SimilarityEngine(load_profile_store())
@@ -0,0 +1,92 @@
+# singleflight.py
+"""
+Склейка одинаковых одновременных запросов (single-flight).
+Пока по ключу идёт работа, остальные запросы с тем же ключом не запускают свою,
+а ждут тот же результат: N одинаковых /compare = одна генерация LLM, N одинаковых /viz = один рендер.
+
+Работа идёт в отдельной задаче, поэтому отмена одного из ожидающих (клиент отключился)
+не обрывает её для остальных. Поток с cancel_orphaned=True отменяется, когда ушёл последний
+подписчик, — генерация, которую никто не ждёт, не занимает очередь к LLM.
+"""
+import asyncio
+from collections.abc import AsyncIterator, Awaitable, Callable, Hashable
+
+
+class _SharedStream:
+    """Один источник async-итератора, который могут читать несколько подписчиков с начала."""
+
+    def __init__(self, source: AsyncIterator, on_orphan: Callable[[], None] | None = None):
+        self.items: list = []
+        self.finished = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self._on_orphan = on_orphan
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(source))
+
+    async def _pump(self, source: AsyncIterator):
+        try:
+            async for item in source:
+                self.items.append(item)
+                self._notify()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator:
+        i = 0
+        self.subscribers += 1
+        try:
+            while True:
+                changed = self._changed
+                while i < len(self.items):
+                    yield self.items[i]
+                    i += 1
+                if self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.finished and self._on_orphan is not None:
+                self._on_orphan()
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+        self._streams: dict[Hashable, _SharedStream] = {}
+
+    def in_flight(self) -> int:
+        return len(self._calls) + len(self._streams)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        """Результат fn() — один на всех одновременных вызывающих с этим ключом."""
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda _f: self._calls.pop(key, None))
+        return await asyncio.shield(fut)
+
+    def stream(self, key: Hashable, fn: Callable[[], AsyncIterator], cancel_orphaned: bool = False) -> AsyncIterator:
+        """Подписка на общий поток: первый вызывающий запускает fn(), остальные читают тот же поток с начала."""
+        shared = self._streams.get(key)
+        if shared is None:
+            def orphaned():
+                # сразу убираем ключ: следующий запрос запустит новую работу, а не подпишется на отменённую
+                if self._streams.get(key) is shared:
+                    del self._streams[key]
+                shared.task.cancel()
+
+            shared = _SharedStream(fn(), orphaned if cancel_orphaned else None)
+            self._streams[key] = shared
+            shared.task.add_done_callback(lambda _t: self._streams.get(key) is shared and self._streams.pop(key))
+        return shared.subscribe()
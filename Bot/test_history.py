@@ -0,0 +1,64 @@
+# test_history.py
+"""Тесты HistoryCompactor (history.py): бюджет токенов, целые ходы, закреплённое [SUMMARY]."""
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+from history import SUMMARY_ID, SUMMARY_TAG, HistoryCompactor, context_window, estimate_tokens, message_tokens
+
+
+def _dialog(turns: int, words: int = 20, topic: str = "слово") -> list:
+    msgs = [SystemMessage(content="[PROMPT_V1] системный промпт")]
+    for i in range(turns):
+        msgs += [HumanMessage(content=f"вопрос {i} " + f"{topic} " * words),
+                 AIMessage(content=f"ответ {i} " + f"{topic} " * words)]
+    return msgs
+
+
+def test_context_window_and_estimate():
+    assert context_window("llama3.1:8b") == 131072  # самый длинный префикс, а не llama3
+    assert context_window("llama3:latest") == 8192
+    assert context_window("unknown") == 4096
+    # кириллица дробится мельче латиницы
+    assert estimate_tokens("а" * 100) > estimate_tokens("a" * 100)
+
+
+def test_fits_budget_and_keeps_system_prompt():
+    msgs = _dialog(20)
+    compactor = HistoryCompactor(budget=300, max_messages=100, summarize=False)
+    out = compactor.compact(msgs)
+    assert out[0] is msgs[0]
+    assert sum(message_tokens(m) for m in out) <= 300
+    assert out[-1] is msgs[-1]
+    assert out[1].type == "human"  # отбрасываются целые ходы
+
+
+def test_max_messages_without_budget():
+    out = HistoryCompactor(max_messages=4, summarize=False).compact(_dialog(10))
+    assert [m.content.split()[1] for m in out[1:]] == ["8", "8", "9", "9"]
+
+
+def test_last_turn_is_kept_even_over_budget():
+    msgs = _dialog(3) + [HumanMessage(content="длинный " * 500), AIMessage(content="call", id="a"),
+                         ToolMessage(content="результат " * 500, tool_call_id="t")]
+    out = HistoryCompactor(budget=50, summarize=False).compact(msgs)
+    assert out[1:] == msgs[-3:]
+
+
+def test_summary_is_pinned_and_rolling():
+    compactor = HistoryCompactor(budget=400, max_messages=100, summary_budget=120)
+    out = compactor.compact(_dialog(20))
+    summary = out[1]
+    assert summary.type == "system" and summary.id == SUMMARY_ID
+    assert summary.content.startswith(SUMMARY_TAG)
+    assert "- Пользователь: вопрос" in summary.content
+    assert sum(estimate_tokens(line) + 1 for line in summary.content.split("\n")[2:]) <= 120
+
+    # повторное сжатие дописывает в то же [SUMMARY], а не добавляет второе
+    again = compactor.compact(out + _dialog(10, topic="другое")[1:])
+    summaries = [m for m in again if m.type == "system" and m.content.startswith(SUMMARY_TAG)]
+    assert len(summaries) == 1
+    assert "другое" in summaries[0].content
+
+
+def test_no_summary_when_nothing_dropped():
+    msgs = _dialog(2)
+    assert HistoryCompactor(budget=10_000).compact(msgs) == msgs
@@ -0,0 +1,111 @@
+# test_llm_pool.py
+"""Тесты LLMPool (llm_pool.py): sticky-маршрутизация, circuit breaker, переход на другой сервер."""
+import asyncio
+
+import pytest
+
+import llm_pool
+from llm_pool import LLM_BREAKER_FAILURES, LLMPool, NoBackend, backend_urls
+
+URLS = ["http://a:11434", "http://b:11434", "http://c:11434"]
+
+
+def _pool(urls=URLS) -> LLMPool:
+    return LLMPool(urls, make_llm=lambda url: f"llm@{url}")
+
+
+async def _fail(pool: LLMPool, backend, times: int):
+    for _ in range(times):
+        with pytest.raises(RuntimeError):
+            async with pool.use(exclude=tuple(b for b in pool.backends if b is not backend)):
+                raise RuntimeError("ollama down")
+
+
+def test_backend_urls(monkeypatch):
+    monkeypatch.setenv("OLLAMA_BASE_URLS", " http://a:11434/, http://b:11434 ,")
+    assert backend_urls("http://x") == ["http://a:11434", "http://b:11434"]
+    monkeypatch.delenv("OLLAMA_BASE_URLS")
+    assert backend_urls("http://x/") == ["http://x"]
+
+
+def test_sticky_by_user_and_lazy_llm():
+    pool = _pool()
+    first = pool.pick("user-1")
+    assert all(pool.pick("user-1") is first for _ in range(10))
+    assert first._llm is None and first.llm == f"llm@{first.url}"
+
+
+def test_sticky_yields_to_least_loaded():
+    pool = _pool()
+    sticky = pool.pick("user-1")
+    sticky.outstanding = llm_pool.LLM_STICKY_SLACK + 1
+    assert pool.pick("user-1") is not sticky
+
+
+def test_breaker_opens_then_half_open_probe():
+    async def run():
+        pool = _pool(URLS[:1])
+        (backend,) = pool.backends
+        await _fail(pool, backend, LLM_BREAKER_FAILURES)
+        assert backend.stats()["breaker"] == "open"
+        with pytest.raises(NoBackend):
+            pool.pick()
+
+        backend.open_until = 0  # пауза прошла
+        assert backend.stats()["breaker"] == "half-open"
+        async with pool.use() as probe:
+            assert probe is backend
+            with pytest.raises(NoBackend):
+                pool.pick()  # пока идёт пробный запрос, второй не пускаем
+        assert backend.stats()["breaker"] == "closed"
+        assert backend.failures == 0 and backend.served == 1
+
+    asyncio.run(run())
+
+
+def test_failed_probe_reopens_breaker():
+    async def run():
+        pool = _pool(URLS[:1])
+        (backend,) = pool.backends
+        await _fail(pool, backend, LLM_BREAKER_FAILURES)
+        backend.open_until = 0
+        await _fail(pool, backend, 1)
+        assert backend.stats()["breaker"] == "open"
+        assert not backend.probing
+
+    asyncio.run(run())
+
+
+def test_cancellation_is_not_a_failure():
+    async def run():
+        pool = _pool(URLS[:1])
+        with pytest.raises(asyncio.CancelledError):
+            async with pool.use():
+                raise asyncio.CancelledError
+        (backend,) = pool.backends
+        assert backend.failures == 0 and backend.outstanding == 0
+
+    asyncio.run(run())
+
+
+def test_failover_skips_broken_and_excluded_backends():
+    async def run():
+        pool = _pool()
+        broken = pool.pick("user-1")
+        await _fail(pool, broken, LLM_BREAKER_FAILURES)
+        # как в main.py: упавший сервер исключается, запрос уходит на следующий
+        for _ in range(20):
+            assert pool.pick("user-1") is not broken
+        other = pool.pick("user-1")
+        third = pool.pick("user-1", exclude=(other,))
+        assert third not in (broken, other)
+        with pytest.raises(NoBackend):
+            pool.pick("user-1", exclude=(other, third))
+
+    asyncio.run(run())
+
+
+def test_unhealthy_backend_is_skipped():
+    pool = _pool(URLS[:2])
+    pool.backends[0].healthy = False
+    assert all(pool.pick(f"user-{i}") is pool.backends[1] for i in range(20))
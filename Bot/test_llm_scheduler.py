@@ -0,0 +1,160 @@
+# test_llm_scheduler.py
+"""Тесты LLMScheduler (llm_scheduler.py): лимит, приоритет и честность, отмена, дедлайн, переполнение."""
+import asyncio
+
+import pytest
+
+from shared_state import SharedSlots, SqliteState
+from llm_scheduler import CHAT, COMPARE, ClientGone, LLMScheduler, QueueFull, QueueTimeout, cancel_on_disconnect
+
+
+def test_limit_and_release_grants_next():
+    async def run():
+        s = LLMScheduler(max_in_flight=1)
+        first = s.enqueue("a", CHAT)
+        second = s.enqueue("b", CHAT)
+        assert first.granted and not second.granted
+        assert second.position == 1 and s.waiting() == 1
+        first.release()
+        assert second.granted and s.in_flight == 1
+        second.release()
+        assert s.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_chat_first_round_robin_and_burst():
+    async def run():
+        s = LLMScheduler(max_in_flight=1, chat_burst=2)
+        busy = s.enqueue("x", COMPARE)
+        compare = s.enqueue("c", COMPARE)
+        a1, a2, b1 = s.enqueue("a", CHAT), s.enqueue("a", CHAT), s.enqueue("b", CHAT)
+        # /chat раньше /compare, пользователи по кругу, после chat_burst /chat — очередь /compare
+        assert [t.position for t in (a1, b1, compare, a2)] == [1, 2, 3, 4]
+        order = []
+        current = busy
+        for _ in range(4):
+            current.release()
+            current = next(t for t in (a1, a2, b1, compare) if t.granted and not t.released)
+            order.append(current)
+        assert order == [a1, b1, compare, a2]
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def run():
+        s = LLMScheduler(max_in_flight=1)
+        busy = s.enqueue("a", CHAT)
+
+        async def client():
+            async with s.slot("b", CHAT):
+                pass
+
+        task = asyncio.ensure_future(client())
+        await asyncio.sleep(0.01)
+        assert s.waiting() == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert s.waiting() == 0
+        busy.release()
+        assert s.in_flight == 0  # слот не ушёл ушедшему клиенту
+
+    asyncio.run(run())
+
+
+def test_deadline_rejects_upfront_by_estimate():
+    async def run():
+        s = LLMScheduler(max_in_flight=1)
+        s.enqueue("a", COMPARE)
+        s.enqueue("b", COMPARE)
+        # впереди одна генерация /compare (~30 с по стартовой оценке) — 5 с не дождаться
+        with pytest.raises(QueueTimeout):
+            s.enqueue("c", COMPARE, timeout=5)
+        assert s.waiting() == 1 and s.rejected == 1
+
+    asyncio.run(run())
+
+
+def test_deadline_expires_while_waiting():
+    async def run():
+        s = LLMScheduler(max_in_flight=1)
+        s.service_time = {CHAT: 0.01, COMPARE: 0.01}  # оценка пропускает, но слот так и не освобождается
+        s.enqueue("a", CHAT)
+        with pytest.raises(QueueTimeout):
+            async with s.slot("b", CHAT, timeout=0.05):
+                pass
+        assert s.waiting() == 0
+
+    asyncio.run(run())
+
+
+def test_shared_slots_cap_in_flight_across_schedulers(tmp_path):
+    async def run():
+        path = str(tmp_path / "state.sqlite3")
+        # два воркера API: у каждого свой лимит 1, но общий на оба — тоже 1
+        workers = [LLMScheduler(max_in_flight=1, shared=SharedSlots(SqliteState(path), "llm:slot", 1)) for _ in range(2)]
+        running, peak = 0, 0
+
+        async def generate(s: LLMScheduler, user: str):
+            nonlocal running, peak
+            async with s.slot(user, CHAT, timeout=5):
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.05)
+                running -= 1
+
+        await asyncio.gather(*(generate(workers[i % 2], f"u{i}") for i in range(4)))
+        assert peak == 1
+        assert all(s.in_flight == 0 for s in workers)
+
+        # общий слот занят другим процессом дольше дедлайна — QueueTimeout, локальный слот освобождается
+        held = await workers[0].shared.acquire()
+        with pytest.raises(QueueTimeout):
+            async with workers[1].slot("u", CHAT, timeout=0.1):
+                pass
+        assert workers[1].in_flight == 0
+        workers[0].shared.release(*held)
+
+    asyncio.run(run())
+
+
+def test_queue_full():
+    async def run():
+        s = LLMScheduler(max_in_flight=1, max_queue=1)
+        s.service_time = {CHAT: 0.0, COMPARE: 0.0}
+        s.enqueue("a", CHAT)
+        s.enqueue("b", CHAT)
+        with pytest.raises(QueueFull):
+            s.enqueue("c", CHAT)
+
+    asyncio.run(run())
+
+
+def test_cancel_on_disconnect():
+    class Request:
+        def __init__(self):
+            self.gone = False
+
+        async def is_disconnected(self):
+            return self.gone
+
+    async def run():
+        assert await cancel_on_disconnect(Request(), asyncio.sleep(0, "ok"), poll=0.01) == "ok"
+
+        request, cancelled = Request(), asyncio.Event()
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        asyncio.get_running_loop().call_later(0.02, lambda: setattr(request, "gone", True))
+        with pytest.raises(ClientGone):
+            await cancel_on_disconnect(request, work(), poll=0.01)
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+    asyncio.run(run())
@@ -0,0 +1,83 @@
+# test_memory.py
+"""Тесты CappingSqliteSaver (memory.py): лимит истории, TTL, writes последнего чекпоинта, общий файл."""
+import time
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langgraph.checkpoint.base import empty_checkpoint
+
+from memory import CappingSqliteSaver
+
+
+def _cfg(thread_id: str, **extra) -> dict:
+    return {"configurable": {"thread_id": thread_id, "checkpoint_ns": "", **extra}}
+
+
+def _put(saver: CappingSqliteSaver, thread_id: str, messages: list) -> dict:
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {"messages": messages}
+    return saver.put(_cfg(thread_id), checkpoint, {"source": "loop", "step": 1}, {})
+
+
+def _dialog(turns: int) -> list:
+    msgs = [SystemMessage(content="[PROMPT_V1] системный промпт")]
+    for i in range(turns):
+        msgs += [HumanMessage(content=f"вопрос {i}"), AIMessage(content=f"ответ {i}")]
+    return msgs
+
+
+def test_put_caps_messages_and_keeps_system_prompt(tmp_path):
+    saver = CappingSqliteSaver(str(tmp_path / "ck.sqlite3"), max_messages=4)
+    saved = _put(saver, "u1", _dialog(10))
+
+    tup = saver.get_tuple(_cfg("u1"))
+    msgs = tup.checkpoint["channel_values"]["messages"]
+    assert msgs[0].content.startswith("[PROMPT_V1]")
+    assert [m.content for m in msgs[1:]] == ["вопрос 8", "ответ 8", "вопрос 9", "ответ 9"]
+    assert tup.config["configurable"]["checkpoint_id"] == saved["configurable"]["checkpoint_id"]
+    assert tup.metadata["step"] == 1
+
+
+def test_only_latest_checkpoint_is_stored(tmp_path):
+    saver = CappingSqliteSaver(str(tmp_path / "ck.sqlite3"))
+    first = _put(saver, "u1", _dialog(1))
+    saver.put_writes(first, [("messages", "pending")], "task-1")
+    assert saver.get_tuple(first).pending_writes == [("task-1", "messages", "pending")]
+
+    second = _put(saver, "u1", _dialog(2))
+    assert saver.get_tuple(first) is None  # старый checkpoint_id не хранится
+    tup = saver.get_tuple(_cfg("u1"))
+    assert tup.config["configurable"]["checkpoint_id"] == second["configurable"]["checkpoint_id"]
+    assert tup.pending_writes == []  # writes старого чекпоинта удалены
+    assert len(list(saver.list(None))) == 1
+
+
+def test_evict_idle_removes_only_stale_threads(tmp_path):
+    saver = CappingSqliteSaver(str(tmp_path / "ck.sqlite3"), ttl=60)
+    old = _put(saver, "old", _dialog(1))
+    saver.put_writes(old, [("messages", "pending")], "task-1")
+    _put(saver, "fresh", _dialog(1))
+    saver._db().execute("UPDATE checkpoints SET updated_at = ? WHERE thread_id = 'old'", (time.time() - 120,))
+
+    assert saver.evict_idle() == 1
+    assert saver.get_tuple(_cfg("old")) is None
+    assert saver.get_tuple(_cfg("fresh")) is not None
+    (writes,) = saver._db().execute("SELECT COUNT(*) FROM writes").fetchone()
+    assert writes == 0
+    assert saver.stats()["threads"] == 1
+
+
+def test_delete_thread(tmp_path):
+    saver = CappingSqliteSaver(str(tmp_path / "ck.sqlite3"))
+    _put(saver, "u1", _dialog(1))
+    _put(saver, "u2", _dialog(1))
+    saver.delete_thread("u1")
+    assert saver.get_tuple(_cfg("u1")) is None
+    assert saver.get_tuple(_cfg("u2")) is not None
+
+
+def test_file_is_shared_between_savers(tmp_path):
+    path = str(tmp_path / "ck.sqlite3")
+    _put(CappingSqliteSaver(path), "u1", _dialog(3))
+    # второй процесс uvicorn открывает тот же файл своим соединением
+    tup = CappingSqliteSaver(path).get_tuple(_cfg("u1"))
+    assert [m.content for m in tup.checkpoint["channel_values"]["messages"]][-1] == "ответ 2"
@@ -0,0 +1,153 @@
+# test_shared_state.py
+"""Тесты shared_state.py: замки и флаги «занято» с TTL для бэкендов local и sqlite."""
+import asyncio
+import multiprocessing
+import time
+
+import pytest
+
+from shared_state import LocalState, LockTimeout, SharedSlots, SqliteState, busy_flag, get_shared_state, shared_lock
+
+
+@pytest.fixture(params=["local", "sqlite"])
+def state(request, tmp_path):
+    return get_shared_state(request.param, str(tmp_path / "state.sqlite3"))
+
+
+def test_acquire_release_owner_only(state):
+    assert state.try_acquire("lock:u1", "a", 10)
+    assert not state.try_acquire("lock:u1", "b", 10)
+    assert state.try_acquire("lock:u1", "a", 10)  # свой замок продлевается
+    assert not state.release("lock:u1", "b")  # чужой не освободить
+    assert state.release("lock:u1", "a")
+    assert state.try_acquire("lock:u1", "b", 10)
+
+
+def test_expired_entry_is_taken_over_and_not_counted(state):
+    assert state.try_acquire("busy:u1", "a", 0.05)
+    assert state.try_acquire("busy:u2", "a", 10)
+    assert state.count("busy:") == 2
+    time.sleep(0.1)
+    assert state.count("busy:") == 1
+    assert state.try_acquire("busy:u1", "b", 10)  # владелец «упал» — запись истекла
+    assert not state.release("busy:u1", "a")
+
+
+def test_count_by_prefix(state):
+    for key in ("busy:1", "busy:2", "lock:1", "busy_other"):
+        state.try_acquire(key, "a", 10)
+    assert state.count("busy:") == 2
+    assert state.count("lock:") == 1
+
+
+def test_sqlite_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    first, second = SqliteState(path), SqliteState(path)
+    assert first.try_acquire("lock:u1", "a", 10)
+    assert not second.try_acquire("lock:u1", "b", 10)
+    assert second.count("lock:") == 1
+    assert first.release("lock:u1", "a")
+    assert second.try_acquire("lock:u1", "b", 10)
+
+
+def _acquire_in_child(state: SqliteState, queue):
+    queue.put((state.try_acquire("lock:u1", "child", 10), state.try_acquire("lock:u2", "child", 10)))
+
+
+def test_sqlite_after_fork(tmp_path):
+    state = SqliteState(str(tmp_path / "state.sqlite3"))
+    assert state.try_acquire("lock:u1", "parent", 10)  # соединение открыто до fork
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    child = ctx.Process(target=_acquire_in_child, args=(state, queue))
+    child.start()
+    assert queue.get(timeout=10) == (False, True)
+    child.join(10)
+    assert state.count("lock:") == 2
+
+
+def test_shared_lock_mutual_exclusion(state):
+    async def run():
+        inside, peak = 0, 0
+
+        async def worker():
+            nonlocal inside, peak
+            async with shared_lock(state, "lock:u1", ttl=5):
+                inside += 1
+                peak = max(peak, inside)
+                await asyncio.sleep(0.02)
+                inside -= 1
+
+        await asyncio.gather(*(worker() for _ in range(4)))
+        assert peak == 1
+        assert state.count("lock:") == 0
+
+    asyncio.run(run())
+
+
+def test_shared_lock_timeout(state):
+    async def run():
+        state.try_acquire("lock:u1", "other", 10)
+        with pytest.raises(LockTimeout):
+            async with shared_lock(state, "lock:u1", timeout=0.1):
+                pass
+
+    asyncio.run(run())
+
+
+def test_busy_flag_rejects_second_and_renews(state):
+    async def run():
+        async with busy_flag(state, "busy:u1", ttl=0.15) as first:
+            assert first
+            async with busy_flag(state, "busy:u1", ttl=0.15) as second:
+                assert not second
+            await asyncio.sleep(0.4)  # дольше ttl: флаг держится продлением
+            assert state.count("busy:") == 1
+            assert not await state.atry_acquire("busy:u1", "other", 1)
+        assert state.count("busy:") == 0
+
+    asyncio.run(run())
+
+
+def test_shared_slots_cap_across_processes(tmp_path):
+    async def run():
+        path = str(tmp_path / "state.sqlite3")
+        # два «воркера» — свои соединения к одному файлу
+        first, second = SharedSlots(SqliteState(path), "llm:slot", 2), SharedSlots(SqliteState(path), "llm:slot", 2)
+        a = await first.acquire()
+        b = await second.acquire()
+        assert a[0] != b[0] and first.count() == 2
+        with pytest.raises(LockTimeout):
+            await second.acquire(timeout=0.1)
+
+        waiter = asyncio.ensure_future(second.acquire(timeout=5))
+        await asyncio.sleep(0.05)
+        first.release(*a)
+        c = await waiter
+        assert c[0] == a[0]
+        for slot in (b, c):
+            second.release(*slot)
+        await asyncio.sleep(0.05)  # запись удаляется в фоне
+        assert first.count() == 0
+
+    asyncio.run(run())
+
+
+def test_shared_slots_renewed_while_held():
+    async def run():
+        slots = SharedSlots(LocalState(), "llm:slot", 1, ttl=0.15)
+        held = await slots.acquire()
+        await asyncio.sleep(0.4)  # дольше ttl: слот держится продлением
+        with pytest.raises(LockTimeout):
+            await slots.acquire(timeout=0)
+        slots.release(*held)
+        await asyncio.sleep(0)
+        assert (await slots.acquire(timeout=0))[0] == held[0]
+
+    asyncio.run(run())
+
+
+def test_unknown_backend():
+    assert isinstance(get_shared_state("local"), LocalState)
+    with pytest.raises(ValueError):
+        get_shared_state("redis")
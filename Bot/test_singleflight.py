@@ -0,0 +1,134 @@
+# test_singleflight.py
+"""Тесты singleflight.py: склейка одинаковых вызовов и отмена (запуск из Bot/: python -m pytest -q)."""
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_do_coalesces_concurrent_calls():
+    async def run():
+        sf = SingleFlight()
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        results = await asyncio.gather(*(sf.do("k", work) for _ in range(5)))
+        assert results == [1] * 5
+        assert calls == 1
+        assert sf.in_flight() == 0
+        # после завершения ключ свободен — следующий вызов запускает новую работу
+        assert await sf.do("k", work) == 2
+
+    asyncio.run(run())
+
+
+def test_do_shares_errors_and_separates_keys():
+    async def run():
+        sf = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        async def ok():
+            return "ok"
+
+        a, b, c = await asyncio.gather(sf.do("bad", fail), sf.do("bad", fail), sf.do("good", ok),
+                                       return_exceptions=True)
+        assert isinstance(a, ValueError) and a is b
+        assert c == "ok"
+
+    asyncio.run(run())
+
+
+def test_do_cancelled_waiter_does_not_cancel_work():
+    async def run():
+        sf = SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "done"
+
+        first = asyncio.ensure_future(sf.do("k", work))
+        second = asyncio.ensure_future(sf.do("k", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        release.set()
+        assert await second == "done"
+
+    asyncio.run(run())
+
+
+async def _numbers(n: int, started: list, cancelled: list, delay: float = 0.01):
+    started.append(1)
+    try:
+        for i in range(n):
+            await asyncio.sleep(delay)
+            yield i
+    except asyncio.CancelledError:
+        cancelled.append(1)
+        raise
+
+
+def test_stream_subscribers_read_from_start():
+    async def run():
+        sf = SingleFlight()
+        started, cancelled = [], []
+
+        async def read(delay: float):
+            await asyncio.sleep(delay)
+            return [i async for i in sf.stream("k", lambda: _numbers(5, started, cancelled))]
+
+        # второй подписчик приходит, когда часть потока уже прочитана, и всё равно получает всё с начала
+        a, b = await asyncio.gather(read(0), read(0.025))
+        assert a == b == list(range(5))
+        assert len(started) == 1
+        assert sf.in_flight() == 0
+
+    asyncio.run(run())
+
+
+def test_stream_cancel_orphaned_stops_source_and_frees_key():
+    async def run():
+        sf = SingleFlight()
+        started, cancelled = [], []
+        make = lambda: _numbers(100, started, cancelled)
+
+        it = sf.stream("k", make, cancel_orphaned=True)
+        assert await it.__anext__() == 0
+        await it.aclose()  # последний подписчик ушёл
+        await asyncio.sleep(0.01)
+        assert cancelled == [1]
+        assert sf.in_flight() == 0
+
+        # новый запрос не подписывается на отменённый поток, а запускает свой
+        it = sf.stream("k", make, cancel_orphaned=True)
+        assert await it.__anext__() == 0
+        assert len(started) == 2
+        await it.aclose()
+
+    asyncio.run(run())
+
+
+def test_stream_without_cancel_orphaned_keeps_running():
+    async def run():
+        sf = SingleFlight()
+        started, cancelled = [], []
+
+        it = sf.stream("k", lambda: _numbers(3, started, cancelled))
+        assert await it.__anext__() == 0
+        await it.aclose()
+        await asyncio.sleep(0.06)
+        assert cancelled == []
+        assert sf.in_flight() == 0  # поток дочитан до конца и ключ убран
+
+    asyncio.run(run())
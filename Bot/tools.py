@@ -1,8 +1,10 @@
 from langchain_core.tools import tool
-from compare_codes import compare_codes
+from compare_codes import compare_codes, prompt_fields, profile_data
+from rag import get_retriever, extract_codes
 from typing import List
 from prompts import prompt_codes
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig
 
 @tool
 def compare_directions_by_codes(codes: List[str]) -> dict:
@@ -29,22 +31,30 @@ def compare_directions_by_codes(codes: List[str]) -> dict:
     template = ChatPromptTemplate.from_template(prompt_codes)
     result = compare_codes(codes=codes)
 
-    prompt_result = template.format_messages(
-        codes=", ".join(codes),
-        similarities="\n".join([f"{k}: {v}" for k, v in result["similarities"].items()]),
-        tfidf="\n".join([
-            f"{k}: {', '.join([f'{word} ({round(score, 2)})' for word, score in v])}"
-            for k, v in result["tfidf"].items()
-        ]),
-        topics="\n".join([
-            f"{k}: " + "; ".join(
-                [", ".join(t['keywords']) for t in v]
-            ) for k, v in result["topics"].items()
-        ]),
-        summaries="\n".join([f"{k}: {v}" for k, v in result["summaries"].items()])
-    )
+    prompt_result = template.format_messages(**prompt_fields(result))
 
     return prompt_result
 
+@tool
+def search_annotations(query: str, codes: List[str] = [], config: RunnableConfig = None) -> str:
+    """
+    Ищет фрагменты аннотаций дисциплин, относящиеся к вопросу пользователя.
+    Используй, когда нужно ответить, что изучают на программе, какие там дисциплины,
+    цели и компетенции, — чтобы ответ опирался на реальные аннотации.
+
+    Аргументы:
+    query — вопрос или ключевые слова (например, "базы данных и backend")
+    codes — коды программ, которыми ограничить поиск (например, ["09.03.01"]); если пусто —
+            берутся коды, упомянутые в query, иначе поиск по всем программам
+    """
+    retriever = get_retriever()
+    if retriever is None:
+        return "Поиск по аннотациям недоступен."
+    # config модели не виден (его подставляет LangGraph): коды из сообщения пользователя кладёт /chat —
+    # модель могла пересказать вопрос без них, а искать надо по той программе, о которой спросили
+    asked = (config or {}).get("configurable", {}).get("request_codes", [])
+    codes = [c for c in dict.fromkeys([*codes, *asked]) if c in profile_data] or extract_codes(query, profile_data)
+    return retriever.context(query, codes) or "Ничего не найдено."
+
 #if __name__ == "__main__":
 #    print(compare_directions_by_codes(["09.03", "15.03"]))
\ No newline at end of file
@@ -1,14 +1,20 @@
 
 from fastapi import HTTPException
 import asyncio
-from prompts import system_prompt
+import os
+import re
+import time
+from codes import _level
+from shared_state import LocalState, shared_lock
+from prompts import system_prompt, PROMPT_TAG
 from langchain_core.messages import SystemMessage
 
-def _cfg(user_id: str) -> dict:
-    return {"configurable": {"thread_id": user_id}}
+USER_IDLE_TTL = float(os.getenv("USER_IDLE_TTL", "3600"))  # сек. без запросов -> замок пользователя выкидывается
+_PROMPT_TAG_RE = re.compile(r"\[PROMPT_V\d+\]")
 
-def _level(code: str) -> int:
-    return len(code.split("."))  # 2 -> УГС, 2 parts -> направление, 3 parts -> профиль
+def _cfg(user_id: str) -> dict:
+    # metadata попадает в каждый чекпоинт треда: по prompt_tag видно, что промпт уже добавлен
+    return {"configurable": {"thread_id": user_id}, "metadata": {"prompt_tag": PROMPT_TAG}}
 
 def _validate_codes(codes: list[str], KNOWN_CODES):
     if not (2 <= len(codes) <= 5):
@@ -20,39 +26,87 @@ def _validate_codes(codes: list[str], KNOWN_CODES):
     if missing:
         raise HTTPException(404, f"Нет данных для: {', '.join(missing)}")
 
-def _get_lock(user_id: str, _user_locks) -> asyncio.Lock:
-    if user_id not in _user_locks:
-        _user_locks[user_id] = asyncio.Lock()
-    return _user_locks[user_id]
+class _UserSlot:
+    __slots__ = ("lock", "prompt_tag", "last_used")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.prompt_tag: str | None = None  # тег системного промпта, уже лежащего в треде
+        self.last_used = time.monotonic()
+
+class UserLocks:
+    """
+    Замок и отметка «системный промпт на месте» на каждого пользователя.
+    Свободные записи, не использовавшиеся дольше idle_ttl, выкидываются — таблица не растёт бесконечно.
+    idle_ttl должен быть меньше CHECKPOINT_TTL: отметка не переживёт удалённый тред.
+    Замок в памяти упорядочивает запросы внутри процесса, shared (shared_state) — между воркерами serve.py;
+    отметка остаётся локальной: при промахе её подтверждают метаданные чекпоинта в общей истории.
+    """
+
+    def __init__(self, idle_ttl: float = USER_IDLE_TTL, sweep_every: float = 60.0, shared=None):
+        self.shared = shared if shared is not None else LocalState()
+        self.idle_ttl = idle_ttl
+        self.sweep_every = sweep_every
+        self._slots: dict[str, _UserSlot] = {}
+        self._last_sweep = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def get(self, user_id: str) -> _UserSlot:
+        now = time.monotonic()
+        if now - self._last_sweep > self.sweep_every:
+            self.evict_idle(now)
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = _UserSlot()
+        slot.last_used = now
+        return slot
 
-async def ensure_system_prompt(user_id: str, agent, _user_locks):
+    def evict_idle(self, now: float | None = None) -> int:
+        now = time.monotonic() if now is None else now
+        self._last_sweep = now
+        idle = [k for k, s in self._slots.items() if not s.lock.locked() and now - s.last_used > self.idle_ttl]
+        for k in idle:
+            del self._slots[k]
+        return len(idle)
+
+def _find_system_prompt(messages) -> SystemMessage | None:
+    """Системный промпт треда (любой версии), [SUMMARY] и прочие системные сообщения не считаются."""
+    for m in messages:
+        if isinstance(m, SystemMessage) and isinstance(m.content, str) and _PROMPT_TAG_RE.search(m.content):
+            return m
+    return None
+
+async def ensure_system_prompt(user_id: str, agent, _user_locks: UserLocks):
     """
-    Атомарно проверяет, есть ли системный промпт.
-    Если нет — добавляет его через update_state (без вызова LLM).
+    Проверяет, что в треде пользователя лежит системный промпт текущей версии (PROMPT_TAG).
+    Горячий путь — отметка в памяти процесса; при промахе — тег из метаданных последнего чекпоинта
+    (его пишет _cfg), и только для старых тредов без тега — просмотр сообщений.
+    Если промпта нет — добавляет его через update_state (без вызова LLM),
+    если он старой версии — заменяет на месте (то же id сообщения).
     """
+    slot = _user_locks.get(user_id)
+    if slot.prompt_tag == PROMPT_TAG:
+        return
     config = _cfg(user_id)
-    lock = _get_lock(user_id, _user_locks)
-    async with lock:
-        # Получаем текущее состояние
-        try:
-            state = agent.get_state(config)
-        except Exception:
-            state = None
-
-        # Проверяем, есть ли уже нужный системный промпт
-        if state is not None:
-            messages = state.values.get("messages", [])
-            already_has_prompt = any(
-                isinstance(m, SystemMessage)
-                and isinstance(m.content, str)
-                and "[PROMPT_V1]" in m.content
-                for m in messages
-            )
-            if already_has_prompt:
-                return
-
-        # Если нет — добавляем системное сообщение через update_state
-        agent.update_state(
+    async with slot.lock, shared_lock(_user_locks.shared, f"prompt:{user_id}"):
+        if slot.prompt_tag == PROMPT_TAG:  # проставил конкурентный запрос, пока ждали замок
+            return
+        tup = await agent.checkpointer.aget_tuple(config)
+        if tup is not None and (tup.metadata or {}).get("prompt_tag") == PROMPT_TAG:
+            slot.prompt_tag = PROMPT_TAG
+            return
+
+        messages = tup.checkpoint["channel_values"].get("messages", []) if tup is not None else []
+        current = _find_system_prompt(messages)
+        if current is not None and PROMPT_TAG in current.content:
+            # старый тред (до отметки в метаданных): промпт уже есть, следующий чекпоинт получит тег
+            slot.prompt_tag = PROMPT_TAG
+            return
+        # нет промпта или он старой версии: с тем же id add_messages заменит сообщение, а не допишет второе
+        await agent.aupdate_state(
             config,
-            {"messages": [SystemMessage(content=system_prompt)]}
-        )
\ No newline at end of file
+            {"messages": [SystemMessage(content=system_prompt, id=current.id if current is not None else None)]}
+        )
+        slot.prompt_tag = PROMPT_TAG
@@ -1,29 +1,51 @@
 # utils_viz.py
+import functools
 import io
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.metrics.pairwise import cosine_distances
-from sklearn.manifold import MDS
-from sklearn.decomposition import PCA
+
+# matplotlib и sklearn импортируются при первом рисовании (≈2 с): main.py берёт отсюда только ссылки на функции
+# для render_pool, а сами картинки строятся в его процессах — там модули подгружает preload() при старте воркера
+@functools.cache
+def _plt():
+    import matplotlib
+    matplotlib.use("Agg")  # рендер без GUI, в т.ч. в процессах render_pool
+    import matplotlib.pyplot as plt
+    return plt
+
+def preload():
+    """Инициализатор процессов render_pool: тяжёлые импорты до первого запроса, а не в нём."""
+    _plt()
+    from sklearn.manifold import MDS  # noqa: F401
+    try:
+        import seaborn  # noqa: F401
+    except ImportError:
+        pass
 
 def _to_png(fig) -> bytes:
+    plt = _plt()
     buf = io.BytesIO()
     fig.savefig(buf, format="png", dpi=180, bbox_inches="tight")
     plt.close(fig)
     buf.seek(0)
     return buf.getvalue()
 
-def project_2d(embs: np.ndarray) -> np.ndarray:
-    n = embs.shape[0]
+def project_2d(sim: np.ndarray) -> np.ndarray:
+    """2D-координаты по готовой матрице косинусной близости (см. similarity.SimilarityEngine)."""
+    n = sim.shape[0]
     if n >= 3:
-        D = cosine_distances(embs)
+        D = np.clip(1.0 - sim, 0.0, None)
+        np.fill_diagonal(D, 0.0)
+        from sklearn.manifold import MDS
         return MDS(n_components=2, dissimilarity="precomputed", random_state=42).fit_transform(D)
     elif n == 2:
-        return PCA(n_components=2).fit_transform(embs)
+        # две точки на оси X на евклидовом расстоянии нормированных векторов
+        d = float(np.sqrt(max(2.0 - 2.0 * sim[0, 1], 0.0)))
+        return np.array([[-d / 2, 0.0], [d / 2, 0.0]])
     else:
-        return np.hstack([embs, np.zeros((n,1))])[:, :2]
+        return np.zeros((n, 2))
 
 def plot_positions_2d(coords: np.ndarray, labels: list[str]) -> bytes:
+    plt = _plt()
     fig = plt.figure(figsize=(6, 5))
     plt.scatter(coords[:,0], coords[:,1])
     for i, lbl in enumerate(labels):
@@ -33,6 +55,7 @@ def plot_positions_2d(coords: np.ndarray, labels: list[str]) -> bytes:
     return _to_png(fig)
 
 def plot_tfidf_bars(tfidf_items: list[tuple[str,float]], code: str, top_k: int = 10) -> bytes:
+    plt = _plt()
     words = [w for w, _ in tfidf_items[:top_k]]
     scores = [float(s) for _, s in tfidf_items[:top_k]]
     y = np.arange(len(words))
@@ -45,6 +68,7 @@ def plot_tfidf_bars(tfidf_items: list[tuple[str,float]], code: str, top_k: int =
     return _to_png(fig)
 
 def plot_topics_text(topics: list[dict], code: str, top_topics: int = 3, top_words: int = 6) -> bytes:
+    plt = _plt()
     blocks = []
     for t in topics[:top_topics]:
         kws = ", ".join(t.get("keywords", [])[:top_words])
@@ -57,10 +81,9 @@ def plot_topics_text(topics: list[dict], code: str, top_topics: int = 3, top_wor
     plt.tight_layout()
     return _to_png(fig)
 
-def plot_similarity_heatmap(codes: list[str], embs: np.ndarray) -> bytes:
+def plot_similarity_heatmap(codes: list[str], sim: np.ndarray) -> bytes:
+    plt = _plt()
     import seaborn as sns  # если не хочешь seaborn — убери, сделай plt.imshow
-    from sklearn.metrics.pairwise import cosine_similarity
-    sim = cosine_similarity(embs)
     fig = plt.figure(figsize=(5, 4))
     try:
         sns.heatmap(sim, annot=True, fmt=".2f", xticklabels=codes, yticklabels=codes)
@@ -71,3 +94,10 @@ def plot_similarity_heatmap(codes: list[str], embs: np.ndarray) -> bytes:
     plt.title("Семантическое сходство")
     plt.tight_layout()
     return _to_png(fig)
+
+# Точки входа для render_pool: принимают только простые данные, выполняются в процессе-воркере
+def render_position(codes: list[str], sim: np.ndarray) -> bytes:
+    return plot_positions_2d(project_2d(sim), codes)
+
+def render_heatmap(codes: list[str], sim: np.ndarray) -> bytes:
+    return plot_similarity_heatmap(codes, sim)
@@ -0,0 +1,237 @@
+"""
+Сборка ABS_FULL.pkl (профили для Bot/) из очищенных аннотаций data/clear_data.csv (см. preproc_data.py).
+
+Для каждого кода всех трёх уровней (профиль 09.03.01 -> направление 09.03 -> УГС 09, через parse_code):
+- embedding — среднее эмбеддингов его документов
+- tfidf     — топ-10 слов TF-IDF (документ = все тексты кода, корпус = коды того же уровня)
+- topics    — три самые частые темы BERTopic среди его документов
+- summary   — из --summaries (CSV code,summary), иначе из прежнего ABS_FULL.pkl
+
+Инкрементально:
+- эмбеддинги документов кэшируются (SQLite, ключ — модель + текст): пересчитываются только новые/изменённые
+- если входы и параметры не менялись с прошлой сборки, ничего не делается
+Параллельно (joblib): выборка топ-слов TF-IDF и распределения тем по кодам.
+
+Запуск:
+    python build_profiles.py --output ../Bot/ABS_FULL.pkl --store ../Bot/ABS_FULL.store
+    python build_profiles.py --skip-topics   # без BERTopic: темы берутся из прежнего pkl
+
+Воспроизводимость: UMAP внутри BERTopic запускается с --seed, так что темы при тех же входах не меняются
+от сборки к сборке (seed входит в отпечаток сборки).
+
+Пороги близости в Bot/similarity.py подбирались на эмбеддингах исходного датасета (размерность 1536).
+Если размерность новой модели (--embedding-model; у all-MiniLM-L6-v2 — 384) не совпадает с прежним pkl,
+сборка останавливается до расчёта эмбеддингов; --allow-dim-change — осознанная смена модели (пороги перепроверить).
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.feature_extraction.text import TfidfVectorizer
+from tools import parse_code, topic_summary
+
+EMBEDDING_MODEL = os.getenv("PROFILE_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+LEVELS = ("group_code", "direction_code", "profile_code")
+TFIDF_TOP = 10
+TOPICS_TOP = 3
+SEED = 42
+
+
+class EmbeddingCache:
+    """Эмбеддинги документов по sha256(модель + текст) — между сборками пересчитываются только новые тексты."""
+
+    def __init__(self, path: str, model: str):
+        self.model = model
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vec BLOB NOT NULL)")
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, np.ndarray]:
+        found = {}
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            q = f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})"
+            for k, blob in self.conn.execute(q, part):
+                found[k] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items: dict[str, np.ndarray]):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+            [(k, len(v), np.asarray(v, dtype=np.float32).tobytes()) for k, v in items.items()],
+        )
+        self.conn.commit()
+
+
+def embed_documents(texts: list[str], cache: EmbeddingCache, batch_size: int) -> np.ndarray:
+    keys = [cache.key(t) for t in texts]
+    known = cache.get_many(list(dict.fromkeys(keys)))
+    todo = list(dict.fromkeys(k for k in keys if k not in known))
+    print(f"Эмбеддинги: {len(known)} из кэша, {len(todo)} посчитать")
+    if todo:
+        from langchain_huggingface import HuggingFaceEmbeddings  # тянет torch — только если есть что считать
+
+        embeddings = HuggingFaceEmbeddings(model_name=cache.model)
+        text_by_key = dict(zip(keys, texts))
+        started = time.perf_counter()
+        for i in range(0, len(todo), batch_size):
+            part = todo[i:i + batch_size]
+            vecs = embeddings.embed_documents([text_by_key[k] for k in part])
+            fresh = dict(zip(part, (np.asarray(v, dtype=np.float32) for v in vecs)))
+            cache.put_many(fresh)  # после каждой пачки: упавшая сборка не теряет посчитанное
+            known.update(fresh)
+            done = i + len(part)
+            print(f"  {done}/{len(todo)} ({done / (time.perf_counter() - started):.1f} док/с)")
+    return np.stack([known[k] for k in keys])
+
+
+def fit_topics(texts: list[str], doc_embeddings: np.ndarray, seed: int = SEED):
+    """BERTopic на уже посчитанных эмбеддингах: (тема каждого документа, слова каждой темы)."""
+    from bertopic import BERTopic
+    from umap import UMAP
+
+    # параметры UMAP по умолчанию BERTopic, но с random_state: без него темы меняются при каждой сборке
+    umap_model = UMAP(n_neighbors=15, n_components=5, min_dist=0.0, metric="cosine", random_state=seed)
+    model = BERTopic(language="multilingual", umap_model=umap_model)
+    topics, _ = model.fit_transform(texts, embeddings=doc_embeddings)
+    words = {t: [w for w, _ in model.get_topic(t)] for t in set(topics)}
+    return np.asarray(topics), words
+
+
+def _top_terms(rows, terms: np.ndarray, k: int) -> list[list[tuple[str, float]]]:
+    out = []
+    for row in rows:
+        row = row.tocoo()
+        order = np.argsort(-row.data, kind="stable")[:k]
+        out.append([(str(terms[row.col[i]]), float(row.data[i])) for i in order])
+    return out
+
+
+def level_tfidf(codes: list[str], texts: list[str], n_jobs: int) -> dict[str, list]:
+    # max_df отсекает слова, встречающиеся почти у всех кодов уровня (аналог стоп-слов)
+    vectorizer = TfidfVectorizer(lowercase=True, token_pattern=r"(?u)\b[а-яёa-z]{3,}\b", max_df=0.8 if len(codes) > 2 else 1.0)
+    try:
+        matrix = vectorizer.fit_transform(texts).tocsr()
+    except ValueError:  # на маленьком уровне max_df выкинул все слова
+        vectorizer.set_params(max_df=1.0)
+        matrix = vectorizer.fit_transform(texts).tocsr()
+    terms = vectorizer.get_feature_names_out()
+    step = max(1, len(codes) // max(1, n_jobs * 4))
+    parts = Parallel(n_jobs=n_jobs)(
+        delayed(_top_terms)(matrix[i:i + step], terms, TFIDF_TOP) for i in range(0, len(codes), step)
+    )
+    return dict(zip(codes, (t for part in parts for t in part)))
+
+
+def input_fingerprint(paths: list[str], params: dict) -> str:
+    h = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8"))
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def build(args) -> bool:
+    inputs = [args.input] + ([args.summaries] if args.summaries else [])
+    params = {"model": args.embedding_model, "topics": not args.skip_topics, "seed": args.seed, "format": 1}
+    fingerprint = input_fingerprint(inputs, params)
+    meta_path = f"{args.output}.build.json"
+    if os.path.exists(args.output) and os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            if json.load(f).get("fingerprint") == fingerprint:
+                print("Входы не менялись — сборка не нужна")
+                return False
+
+    df = pd.read_csv(args.input, dtype={"code": str}).dropna(subset=["text"])  # str: "09.03" не должен стать 9.03
+    df["text"] = df["text"].astype(str)
+    df = pd.concat([df.reset_index(drop=True), pd.DataFrame(list(df["code"].map(parse_code)))], axis=1)
+    print(f"Документов: {len(df)}, профилей: {df['profile_code'].nunique()}")
+
+    previous = {}
+    if os.path.exists(args.output):
+        with open(args.output, "rb") as f:
+            previous = pickle.load(f)
+    summaries = {}
+    if args.summaries:
+        s = pd.read_csv(args.summaries, dtype=str).fillna("")
+        summaries = dict(zip(s.iloc[:, 0], s.iloc[:, 1]))
+
+    cache = EmbeddingCache(args.embedding_cache, args.embedding_model)
+    old_dim = next((len(v["embedding"]) for v in previous.values()), None)
+    # размерность модели — по одному документу, до расчёта (и кэширования) всего корпуса
+    new_dim = embed_documents(df["text"].tolist()[:1], cache, 1).shape[1]
+    if old_dim is not None and old_dim != new_dim:
+        if not args.allow_dim_change:
+            sys.exit(f"Размерность эмбеддингов {new_dim} ({args.embedding_model}) вместо прежней {old_dim}: "
+                     f"профили и пороги similarity.py несовместимы. Другая модель — --embedding-model, "
+                     f"осознанная смена — --allow-dim-change")
+        print(f"Внимание: размерность эмбеддингов {new_dim} вместо прежней {old_dim} — проверьте пороги similarity.py")
+    doc_emb = embed_documents(df["text"].tolist(), cache, args.batch_size)
+
+    topic_words = {}
+    if not args.skip_topics:
+        df["topic"], topic_words = fit_topics(df["text"].tolist(), doc_emb, args.seed)
+
+    profiles: dict[str, dict] = {}
+    for level in LEVELS:
+        groups = df.groupby(level, sort=True).indices  # код -> номера строк его документов
+        codes = list(groups)
+        tfidf = level_tfidf(codes, [" ".join(df["text"].values[groups[c]]) for c in codes], args.jobs)
+        if topic_words:
+            topics = Parallel(n_jobs=args.jobs)(
+                delayed(topic_summary)(df["topic"].values[groups[c]].tolist(), topic_words, TOPICS_TOP) for c in codes
+            )
+        for i, code in enumerate(codes):
+            profiles[code] = {
+                "tfidf": tfidf[code],
+                "embedding": doc_emb[groups[code]].mean(axis=0).astype(np.float32),
+                "topics": topics[i] if topic_words else previous.get(code, {}).get("topics", []),
+                "summary": summaries.get(code, previous.get(code, {}).get("summary", "")),
+            }
+        print(f"{level}: {len(codes)} кодов")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    tmp = f"{args.output}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(profiles, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, args.output)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "codes": len(profiles), "built_at": time.time()}, f)
+    print(f"Готово: {args.output} ({len(profiles)} кодов)")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сборка ABS_FULL.pkl из очищенных аннотаций")
+    parser.add_argument("--input", default="data/clear_data.csv")
+    parser.add_argument("--output", default="../Bot/ABS_FULL.pkl")
+    parser.add_argument("--summaries", default=None, help="CSV code,summary с описаниями программ")
+    parser.add_argument("--store", default=None, help="сразу пересобрать mmap-хранилище Bot/ (например ../Bot/ABS_FULL.store)")
+    parser.add_argument("--embedding-model", default=EMBEDDING_MODEL)
+    parser.add_argument("--embedding-cache", default="data/embeddings_cache.sqlite3")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--jobs", type=int, default=-1, help="процессов для TF-IDF/тем (-1 — все ядра)")
+    parser.add_argument("--skip-topics", action="store_true", help="не обучать BERTopic, темы — из прежнего pkl")
+    parser.add_argument("--seed", type=int, default=SEED, help="random_state UMAP в BERTopic (воспроизводимые темы)")
+    parser.add_argument("--allow-dim-change", action="store_true",
+                        help="разрешить модель с другой размерностью эмбеддингов, чем у прежнего pkl")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.embedding_cache)), exist_ok=True)
+    if build(args) and args.store:
+        # профили читает Bot/ через profile_store.py — собираем хранилище его же конвертером
+        converter = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Bot", "profile_store.py")
+        subprocess.run([sys.executable, converter, args.output, args.store], check=True)
@@ -1,3 +1,25 @@
+"""
+Загрузка аннотаций (data/clear_data.csv) в Chroma — инкрементально и с возобновлением.
+- CSV читается кусками (--read-chunk строк), а не целиком
+- куски текста эмбеддятся пачками (--batch-size)
+- id куска в Chroma — хэш содержимого (модель эмбеддингов + код + текст куска): неизменившиеся куски
+  пропускаются без пересчёта эмбеддинга, повторная запись того же куска ничего не меняет
+- прогресс (сколько строк CSV пройдено) и список загруженных кусков лежат в манифесте (SQLite рядом с базой):
+  после падения запуск продолжается с места остановки
+- в конце полного прохода куски, которых больше нет в CSV (программу убрали или текст изменился), удаляются
+
+Запуск:
+    python data_to_db.py                      # инкрементально
+    python data_to_db.py --batch-size 128
+    python data_to_db.py --rebuild            # удалить коллекцию и манифест, загрузить всё заново
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+import uuid
+
 import pandas as pd
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
@@ -5,43 +27,187 @@ from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.documents import Document
 from tools import parse_code
 
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+COLLECTION = "rag_data"
+PERSIST_DIR = "./chroma_db"
+
+
+def chunk_id(code: str, text: str) -> str:
+    return hashlib.sha256(f"{EMBEDDING_MODEL}\0{code}\0{text}".encode("utf-8")).hexdigest()[:32]
+
+
+def file_fingerprint(path: str) -> str:
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+class Manifest:
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS chunks (
+                id TEXT PRIMARY KEY,
+                profile_code TEXT NOT NULL,
+                run_id TEXT NOT NULL
+            )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS progress (
+                source TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                run_id TEXT NOT NULL,
+                rows_done INTEGER NOT NULL
+            )"""
+        )
+        self.conn.commit()
+
+    def start(self, source: str, fingerprint: str) -> tuple[str, int]:
+        """(run_id, сколько строк уже пройдено). Незаконченный проход того же файла продолжается."""
+        row = self.conn.execute("SELECT fingerprint, run_id, rows_done FROM progress WHERE source = ?", (source,)).fetchone()
+        if row is not None and row[0] == fingerprint and row[2] >= 0:
+            return row[1], row[2]
+        run_id = uuid.uuid4().hex
+        self.conn.execute("INSERT OR REPLACE INTO progress VALUES (?, ?, ?, 0)", (source, fingerprint, run_id))
+        self.conn.commit()
+        return run_id, 0
+
+    def known(self, ids: list[str]) -> set[str]:
+        found = set()
+        for i in range(0, len(ids), 500):  # лимит параметров SQLite
+            part = ids[i:i + 500]
+            q = f"SELECT id FROM chunks WHERE id IN ({','.join('?' * len(part))})"
+            found.update(r[0] for r in self.conn.execute(q, part))
+        return found
+
+    def touch(self, ids: list[str], run_id: str):
+        self.conn.executemany("UPDATE chunks SET run_id = ? WHERE id = ?", [(run_id, i) for i in ids])
 
-df = pd.read_csv('data/clear_data.csv')
-df = df.dropna(subset=["text"]).copy()
-df["text"] = df["text"].astype(str)
+    def add(self, rows: list[tuple[str, str]], run_id: str):
+        self.conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?)", [(i, code, run_id) for i, code in rows])
 
-parsed_df = df["code"].apply(parse_code).apply(pd.Series)
-df = pd.concat([df, parsed_df], axis=1)
+    def checkpoint(self, source: str, rows_done: int):
+        self.conn.execute("UPDATE progress SET rows_done = ? WHERE source = ?", (rows_done, source))
+        self.conn.commit()
 
-splitter = RecursiveCharacterTextSplitter(
-    chunk_size=2000,
-    chunk_overlap=200,
-    add_start_index = True
-)
+    def stale(self, run_id: str) -> list[str]:
+        return [r[0] for r in self.conn.execute("SELECT id FROM chunks WHERE run_id != ?", (run_id,))]
 
-all_splits = []
+    def finish(self, source: str, stale: list[str]):
+        self.conn.executemany("DELETE FROM chunks WHERE id = ?", [(i,) for i in stale])
+        self.conn.execute("UPDATE progress SET rows_done = -1 WHERE source = ?", (source,))  # проход завершён
+        self.conn.commit()
 
-for _, row in df.iterrows():
-    chunks = splitter.create_documents(
-        texts=[row["text"]],
-        metadatas=[{
-            "level": "discipline",
-            "type": "annotation",
-            "group_code": row["group_code"],
-            "direction_code": row["direction_code"],
-            "profile_code": row["profile_code"],
-        }]
+
+class Throughput:
+    def __init__(self, every: float = 5.0):
+        self.started = self.last_report = time.perf_counter()
+        self.every = every  # сек. между промежуточными отчётами
+        self.rows = self.chunks = self.embedded = self.skipped = 0
+
+    def report(self, final: bool = False):
+        now = time.perf_counter()
+        if not final and now - self.last_report < self.every:
+            return
+        self.last_report = now
+        dt = max(now - self.started, 1e-9)
+        print(
+            f"{'Итого' if final else 'Прогресс'}: строк {self.rows} ({self.rows / dt:.1f}/с), "
+            f"кусков {self.chunks}, эмбеддинг {self.embedded} ({self.embedded / dt:.1f}/с), "
+            f"пропущено без изменений {self.skipped}, {dt:.1f} с"
+        )
+
+
+def iter_rows(csv_path: str, read_chunk: int, skip_rows: int):
+    """(номер строки, code, text) по кускам CSV; первые skip_rows строк пропускаются."""
+    n = 0
+    for frame in pd.read_csv(csv_path, chunksize=read_chunk, usecols=["code", "text"]):
+        if n + len(frame) <= skip_rows:
+            n += len(frame)
+            continue
+        for code, text in zip(frame["code"], frame["text"]):
+            n += 1
+            if n <= skip_rows or pd.isna(text):
+                continue
+            yield n, str(code), str(text)
+
+
+def ingest(csv_path: str, persist_dir: str, batch_size: int, read_chunk: int, rebuild: bool = False):
+    manifest_path = os.path.join(persist_dir, "ingest_manifest.sqlite3")
+    os.makedirs(persist_dir, exist_ok=True)
+    if rebuild and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    manifest = Manifest(manifest_path)
+    source = os.path.abspath(csv_path)
+    run_id, rows_done = manifest.start(source, file_fingerprint(csv_path))
+    if rows_done:
+        print(f"Продолжаем с строки {rows_done + 1}")
+
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=2000,
+        chunk_overlap=200,
+        add_start_index = True
+    )
+    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    vectorstore = Chroma(collection_name=COLLECTION,
+        embedding_function=embeddings,
+        persist_directory=persist_dir,
     )
-    all_splits.extend(chunks)
+    if rebuild:
+        # без манифеста неизвестно, какие куски в коллекции устарели, — удаляем её целиком и создаём пустую
+        vectorstore.delete_collection()
+        vectorstore = Chroma(collection_name=COLLECTION,
+            embedding_function=embeddings,
+            persist_directory=persist_dir,
+        )
+
+    stats = Throughput()
+    pending: list[tuple[str, Document]] = []
+    last_row = rows_done
+
+    def flush():
+        nonlocal pending
+        if not pending:
+            return
+        ids = [i for i, _ in pending]
+        known = manifest.known(ids)
+        manifest.touch([i for i in ids if i in known], run_id)
+        fresh = {i: doc for i, doc in pending if i not in known}  # dict — дубли внутри пачки схлопываются
+        if fresh:
+            vectorstore.add_documents(list(fresh.values()), ids=list(fresh.keys()))
+            manifest.add([(i, doc.metadata["profile_code"]) for i, doc in fresh.items()], run_id)
+        stats.embedded += len(fresh)
+        stats.skipped += len(pending) - len(fresh)
+        # строки до last_row целиком записаны — после падения начнём с last_row + 1
+        manifest.checkpoint(source, last_row)
+        pending = []
+        stats.report()
 
-print(f"Total splits: {len(all_splits)}")
+    for n, code, text in iter_rows(csv_path, read_chunk, rows_done):
+        meta = {"level": "discipline", "type": "annotation", **parse_code(code)}
+        for doc in splitter.create_documents(texts=[text], metadatas=[meta]):
+            pending.append((chunk_id(code, doc.page_content), doc))
+        stats.rows += 1
+        stats.chunks = stats.embedded + stats.skipped + len(pending)
+        last_row = n
+        if len(pending) >= batch_size:
+            flush()
+    flush()
 
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    stale = manifest.stale(run_id)
+    if stale:
+        vectorstore.delete(ids=stale)
+        print(f"Удалено устаревших кусков: {len(stale)}")
+    manifest.finish(source, stale)
+    stats.report(final=True)
 
-vectorstore = Chroma(collection_name="rag_data", 
-    embedding_function=embeddings, 
-    persist_directory="./chroma_db",
-)
 
-ids = vectorstore.add_documents(all_splits)
-print(f"Total persisted documents: {len(ids)}")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Инкрементальная загрузка аннотаций в Chroma")
+    parser.add_argument("--csv", default="data/clear_data.csv")
+    parser.add_argument("--persist-dir", default=PERSIST_DIR)
+    parser.add_argument("--batch-size", type=int, default=64, help="кусков текста на один вызов эмбеддинга")
+    parser.add_argument("--read-chunk", type=int, default=1000, help="строк CSV за одно чтение")
+    parser.add_argument("--rebuild", action="store_true", help="удалить коллекцию и манифест и загрузить всё заново")
+    args = parser.parse_args()
+    ingest(args.csv, args.persist_dir, args.batch_size, args.read_chunk, args.rebuild)
@@ -1,19 +1,84 @@
+"""
+Очистка аннотаций: Excel/CSV (code, text) -> data/clear_data.csv.
+- вход читается потоком (CSV — кусками pandas, Excel — openpyxl в режиме read_only), выход дописывается
+  кусками — целиком в памяти не держится ни вход, ни результат
+- очистка (tools.clean_annotation) идёт пачками по --chunk-rows строк в нескольких процессах (--workers)
+- дубли (code, text) отбрасываются по хэшу, как раньше drop_duplicates
+
+Запуск:
+    python preproc_data.py
+    python preproc_data.py --input data/work_programs.csv --workers 8
+"""
+import argparse
+import hashlib
+import os
+from collections import Counter
+from multiprocessing import Pool
+
 import pandas as pd
-from tools import extract_cleaned_text
-import re
-
-df = pd.read_excel('./data/very_very_low_data.xlsx')
-df.columns = ['code', 'text']
-df['text'] = df['text'].apply(extract_cleaned_text)
-df['text'] = df['text'].str.replace(r'\s+', ' ', regex=True)
-df['text'] = df['text'].str.replace(r'_x000C_', '', regex=False)
-df['text'] = df['text'].str.replace(r'•', '', regex=False)
-df['text'] = df['text'].str.replace(r';', '.', regex=False)
-df['text'] = df['text'].str.replace(r'', '', regex=False)
-df['text'] = df['text'].str.replace(r'\uf0b7', '', regex=False)
-df['text'] = df['text'].str.strip()
-df = df.dropna(subset=['text'])
-df = df.drop_duplicates()
-
-print(df['code'].value_counts())
-df.to_csv('data/clear_data.csv', index=False)
+from tools import clean_annotation
+
+
+def read_rows(path, chunk_rows):
+    """Пачки [(code, text)] из первых двух столбцов файла (первая строка — заголовок)."""
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook  # только для Excel
+
+        wb = load_workbook(path, read_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(min_row=2, max_col=2, values_only=True)
+            batch = []
+            for code, text in rows:
+                batch.append((code, text))
+                if len(batch) >= chunk_rows:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            wb.close()
+    else:
+        for frame in pd.read_csv(path, chunksize=chunk_rows):
+            yield list(zip(frame.iloc[:, 0], frame.iloc[:, 1]))
+
+
+def clean_batch(batch):
+    return [(code, clean_annotation(text)) for code, text in batch]
+
+
+def preprocess(input_path, output_path, workers, chunk_rows):
+    seen = set()
+    counts = Counter()
+    header = True
+    tmp_path = f"{output_path}.tmp"
+    with Pool(workers) as pool:
+        # imap сохраняет порядок строк и держит в работе не больше пачек, чем успевает записываться
+        for cleaned in pool.imap(clean_batch, read_rows(input_path, chunk_rows)):
+            rows = []
+            for code, text in cleaned:
+                key = hashlib.blake2b(f"{code}\0{text}".encode("utf-8"), digest_size=16).digest()
+                if key in seen:
+                    continue
+                seen.add(key)
+                counts[code] += 1
+                rows.append((code, text))
+            pd.DataFrame(rows, columns=["code", "text"]).to_csv(
+                tmp_path, mode="w" if header else "a", header=header, index=False
+            )
+            header = False
+    if header:  # пустой вход — пустой результат с заголовком
+        pd.DataFrame(columns=["code", "text"]).to_csv(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Очистка аннотаций")
+    parser.add_argument("--input", default="./data/very_very_low_data.xlsx")
+    parser.add_argument("--output", default="data/clear_data.csv")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-rows", type=int, default=500, help="строк в одной пачке для процесса")
+    args = parser.parse_args()
+
+    counts = preprocess(args.input, args.output, args.workers, args.chunk_rows)
+    print(pd.Series(counts, name="count").sort_values(ascending=False))
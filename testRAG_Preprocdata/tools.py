@@ -1,29 +1,59 @@
 import re
+from collections import Counter
 
-def get_topic_distributions(df, topic_model, top_n=3):
-    result = {}
+def topic_summary(topics, topic_words, top_n=3):
+    """top_n самых частых тем набора документов: [{"topic_id", "weight_percent", "keywords"}]."""
+    topic_counts = Counter(topics)
+    total = sum(topic_counts.values())
 
-    for code in df['code'].unique():
-        subset = df[df['code'] == code]
-        topic_counts = Counter(subset['topic'])
-        total = sum(topic_counts.values())
+    # Получаем top_n тем с их долей
+    top_topics = topic_counts.most_common(top_n)
+    summary = []
 
-        # Получаем top_n тем с их долей
-        top_topics = topic_counts.most_common(top_n)
-        topic_summary = []
+    for topic_id, count in top_topics:
+        weight = round((count / total) * 100, 1)  # процент
+        summary.append({
+            "topic_id": topic_id,
+            "weight_percent": weight,
+            "keywords": topic_words[topic_id][:10]  # топ-10 слов
+        })
 
-        for topic_id, count in top_topics:
-            weight = round((count / total) * 100, 1)  # процент
-            words = [w for w, _ in topic_model.get_topic(topic_id)[:10]]  # топ-5 слов
-            topic_summary.append({
-                "topic_id": topic_id,
-                "weight_percent": weight,
-                "keywords": words
-            })
+    return summary
 
-        result[code] = topic_summary
+def get_topic_distributions(df, topic_model, top_n=3):
+    # одна группировка вместо фильтрации всего df на каждый код
+    topic_words = {t: [w for w, _ in topic_model.get_topic(t)] for t in df['topic'].unique()}
+    return {
+        code: topic_summary(topics, topic_words, top_n)
+        for code, topics in df.groupby('code', sort=False)['topic']
+    }
 
-    return result
+# Шаблоны компилируются один раз при импорте, а не на каждый документ
+_STOP = r'(?:Перечень формируемых компетенций:|Общая трудоемкость дисциплины:|Форма итогового контроля|$)'
+_TITLE_RE = re.compile(r'АННОТАЦИЯ\s+к\s+рабочей\s+программе\s+дисциплины\s+[«"]([^»"]+)[»"]', re.IGNORECASE)
+_TITLE_PRACTICE_RE = re.compile(r'АННОТАЦИЯ\s+к\s+рабочей\s+программе\s+практики\s+[«"]([^»"]+)[»"]', re.IGNORECASE)
+_GOAL_RE = re.compile(
+    r'(Цел(?:ь|и)?(?:\s+изучения)?\s+дисциплины[:\s]*)(.*?)(?:Задачи изучения дисциплины:|Перечень формируемых компетенций:|Общая трудоемкость дисциплины:|Форма итогового контроля|$)',
+    re.DOTALL | re.IGNORECASE)
+_TASK_RE = re.compile(r'Задачи\s+изучения\s+дисциплины:(.*?)' + _STOP, re.DOTALL | re.IGNORECASE)
+_TASK_PRACTICE_RE = re.compile(r'Задачи\s+изучения\s+практики:(.*?)' + _STOP, re.DOTALL | re.IGNORECASE)
+_COMP_RE = re.compile(
+    r'Перечень\s+формируемых\s+компетенций:(.*?)(?:Общая трудоемкость дисциплины:|Форма итогового контроля|$)',
+    re.DOTALL | re.IGNORECASE)
+
+# Нормализация за один проход: пробелы -> один пробел, мусор из Excel/PDF (_x000C_, маркеры списков) — убрать, ";" -> "."
+_NORMALIZE_RE = re.compile(r'\s+|_x000C_|[•\uf02d]|;')
+_NORMALIZE_MAP = {'_x000C_': '', '•': '', '\uf02d': '', ';': '.'}
+# прежний конвейер удалял текст «\uf0b7» (6 символов, r-строка), а не сам символ U+F0B7, и последним шагом:
+# замены выше могут склеить его из кусков, поэтому — отдельный проход после них
+_LITERAL_UF0B7 = r'\uf0b7'
+
+def normalize_text(text):
+    return _NORMALIZE_RE.sub(lambda m: _NORMALIZE_MAP.get(m.group(0), ' '), text).replace(_LITERAL_UF0B7, '').strip()
+
+def clean_annotation(text):
+    """extract_cleaned_text + normalize_text — полный путь очистки одной аннотации."""
+    return normalize_text(extract_cleaned_text(text))
 
 def extract_cleaned_text(text):
     """
@@ -37,31 +67,19 @@ def extract_cleaned_text(text):
         return ""
 
     # 1. Название дисциплины
-    title_match = re.search(r'АННОТАЦИЯ\s+к\s+рабочей\s+программе\s+дисциплины\s+[«"]([^»"]+)[»"]', text, re.IGNORECASE)
-    if title_match == None:
-      title_match = re.search(r'АННОТАЦИЯ\s+к\s+рабочей\s+программе\s+практики\s+[«"]([^»"]+)[»"]', text, re.IGNORECASE)
+    title_match = _TITLE_RE.search(text) or _TITLE_PRACTICE_RE.search(text)
     title = f"{title_match.group(1)}" if title_match else ""
 
     # 2. Цель дисциплины
-    goal_match = re.search(r'(Цел(?:ь|и)?(?:\s+изучения)?\s+дисциплины[:\s]*)(.*?)(?:Задачи изучения дисциплины:|Перечень формируемых компетенций:|Общая трудоемкость дисциплины:|Форма итогового контроля|$)',
-      text,
-      re.DOTALL | re.IGNORECASE)
+    goal_match = _GOAL_RE.search(text)
     goal = goal_match.group(2).strip() if goal_match else ""
 
     # 3. Задачи дисциплины
-    task_match = re.search(
-        r'Задачи\s+изучения\s+дисциплины:(.*?)(Перечень формируемых компетенций:|Общая трудоемкость дисциплины:|Форма итогового контроля|$)',
-        text, re.DOTALL | re.IGNORECASE)
-    if task_match == None:
-      task_match = re.search(
-        r'Задачи\s+изучения\s+практики:(.*?)(Перечень формируемых компетенций:|Общая трудоемкость дисциплины:|Форма итогового контроля|$)',
-        text, re.DOTALL | re.IGNORECASE)
+    task_match = _TASK_RE.search(text) or _TASK_PRACTICE_RE.search(text)
     tasks = task_match.group(1).strip() if task_match else ""
 
     # 4. Компетенции (если есть)
-    comp_match = re.search(
-        r'Перечень\s+формируемых\s+компетенций:(.*?)(Общая трудоемкость дисциплины:|Форма итогового контроля|$)',
-        text, re.DOTALL | re.IGNORECASE)
+    comp_match = _COMP_RE.search(text)
     competences = comp_match.group(1).strip() if comp_match else ""
 
     # Сборка итогового текста
@@ -78,6 +96,8 @@ def extract_cleaned_text(text):
     return "\n".join(cleaned_parts).strip()
 
 def get_mean_embedding(df, code):
+    import torch  # тяжёлый импорт — только там, где нужен
+
     embs = torch.stack(df[df['code'] == code]['embedding'].tolist())
     return embs.mean(dim=0)
 